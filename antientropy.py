@@ -0,0 +1,84 @@
+'''
+Keeps the replicas of a key in sync after store_value() returns, packets are lost and
+nodes come and go, and without this some replicas would never learn about a value.
+
+Every so often a node picks one of its closest neighbours and compares the keys they
+both ought to hold: the keys in the smallest subtree of the id space which contains the
+two of them. Rather than sending a list of its keys it splits that range into parts and
+sends a digest of each part, the xor of a hash of every (key, version) it holds there.
+The neighbour computes the same digests, and answers with the keys and versions it holds
+in the parts which differ. Then each side only has to transfer the values the other is
+missing, or holds an older version of.
+'''
+import hashlib
+import typing
+
+import core
+import idspace
+
+# the most parts a digest may split its range into
+MAX_PARTS = 256
+
+
+Entry = typing.Tuple[int, core.Version]  # a key, and the version of it which we hold
+
+
+def shared_range(first: core.ID, second: core.ID) -> typing.Tuple[int, int]:
+    '''
+    The smallest subtree which holds both ids, as (prefix, depth): the keys whose first
+    depth bits are the same as prefix's
+    '''
+    depth = idspace.ID_BITS - (first.value ^ second.value).bit_length()
+    return idspace.prefix_of(first.value, depth), depth
+
+
+def part_of(key: int, prefix: int, depth: int, parts: int) -> int:
+    'Which of the parts of the subtree this key falls into'
+    return (key - prefix) * parts >> (idspace.ID_BITS - depth)
+
+
+def entry_hash(key: int, version: core.Version) -> int:
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(key.to_bytes(20, byteorder='big'))
+    hasher.update(version.timestamp.to_bytes(8, byteorder='big'))
+    hasher.update(version.publisher)
+    return int.from_bytes(hasher.digest(), byteorder='big')
+
+
+def partition(entries: typing.Iterable[Entry], prefix: int, depth: int,
+              parts: int) -> typing.List[typing.List[Entry]]:
+    'Splits the entries, which must all fall into the subtree, into its parts'
+    result: typing.List[typing.List[Entry]] = [list() for _ in range(parts)]
+    for key, version in entries:
+        result[part_of(key, prefix, depth, parts)].append((key, version))
+    return result
+
+
+def digest(partitioned: typing.Sequence[typing.Sequence[Entry]]) -> typing.List[int]:
+    'A 64-bit hash of each part, which only matches if both sides hold the same entries'
+    hashes = []
+    for part in partitioned:
+        combined = 0
+        for key, version in part:
+            combined ^= entry_hash(key, version)
+        hashes.append(combined)
+    return hashes
+
+
+def differences(mine: typing.Iterable[Entry], theirs: typing.Iterable[Entry]
+                ) -> typing.Tuple[typing.List[int], typing.List[int]]:
+    '''
+    Compares the entries we hold in some parts with the ones a neighbour holds in the same
+    parts. Returns (push, pull): the keys they're missing or hold an older version of,
+    and the keys we're missing or hold an older version of.
+    '''
+    mine, theirs = dict(mine), dict(theirs)
+    push = [
+        key for key, version in mine.items()
+        if key not in theirs or version > theirs[key]
+    ]
+    pull = [
+        key for key, version in theirs.items()
+        if key not in mine or version > mine[key]
+    ]
+    return push, pull
@@ -0,0 +1,89 @@
+'''
+Synchronous routing computations over many node ids at once, for offline analysis of
+routing tables (replica placement, capacity planning) rather than for a running node.
+
+Node ids are held in numpy structured arrays of ID_DTYPE, each 160-bit id is split into
+a 32-bit high word and two 64-bit words. This module needs numpy, which the rest of the
+package does not.
+'''
+import typing
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+import core
+
+
+if numpy is not None:
+    ID_DTYPE = numpy.dtype([('high', numpy.uint32), ('middle', numpy.uint64), ('low', numpy.uint64)])
+
+    # the layout of ID.to_bytes(), used to convert many ids at once
+    _BYTES_DTYPE = numpy.dtype([('high', '>u4'), ('middle', '>u8'), ('low', '>u8')])
+
+WORDS = ('high', 'middle', 'low')
+
+IDLike = typing.Union[core.ID, int]
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('the batch module requires numpy, try `pip install numpy`')
+
+
+def ids_to_array(ids: typing.Iterable[IDLike]) -> 'numpy.ndarray':
+    'Packs node ids (IDs or ints) into an array of ID_DTYPE'
+    _require_numpy()
+    as_ints = (nodeid.value if isinstance(nodeid, core.ID) else nodeid for nodeid in ids)
+    as_bytes = b''.join(value.to_bytes(20, byteorder='big') for value in as_ints)
+    return numpy.frombuffer(as_bytes, dtype=_BYTES_DTYPE).astype(ID_DTYPE)
+
+
+def array_to_ids(array: 'numpy.ndarray') -> typing.List[core.ID]:
+    _require_numpy()
+    as_bytes = array.astype(_BYTES_DTYPE).tobytes()
+    return [core.ID.from_bytes(as_bytes[i:i+20]) for i in range(0, len(as_bytes), 20)]
+
+
+def table_to_array(table: core.RoutingTable) -> 'numpy.ndarray':
+    'Returns the ids of every node in the routing table'
+    return ids_to_array(node.nodeid for node in table.nodes())
+
+
+def xor_distances(ids: 'numpy.ndarray', target: IDLike) -> 'numpy.ndarray':
+    'Returns the distance of each id from target, also as an array of ID_DTYPE'
+    _require_numpy()
+    target = ids_to_array([target])[0]
+    distances = numpy.empty(len(ids), dtype=ID_DTYPE)
+    for word in WORDS:
+        distances[word] = ids[word] ^ target[word]
+    return distances
+
+
+def closest(ids: 'numpy.ndarray', targets: typing.Sequence[IDLike], n: int,
+            chunk_size: int = 1024) -> 'numpy.ndarray':
+    '''
+    For each target, returns the indexes into ids of the n ids closest to it, ordered by
+    xor distance. The result has shape (len(targets), min(n, len(ids))).
+
+    Targets are ranked chunk_size at a time, which bounds memory use to a few arrays of
+    chunk_size * len(ids) words.
+    '''
+    _require_numpy()
+    if not isinstance(targets, numpy.ndarray):
+        targets = ids_to_array(targets)
+
+    n = min(n, len(ids))
+    result = numpy.empty((len(targets), n), dtype=numpy.intp)
+
+    for start in range(0, len(targets), chunk_size):
+        chunk = targets[start:start+chunk_size]
+        high, middle, low = (
+            ids[word][numpy.newaxis, :] ^ chunk[word][:, numpy.newaxis] for word in WORDS
+        )
+        # lexsort sorts by the last key first
+        order = numpy.lexsort((low, middle, high), axis=-1)
+        result[start:start+len(chunk)] = order[:, :n]
+
+    return result
@@ -0,0 +1,105 @@
+'''
+Measures how long a node takes to start, from a cold process.
+
+    $ python bench_startup.py --runs 20
+
+--runs times starts a seed node, then a fresh python process which imports kademlia,
+constructs a Node, listens and bootstraps off the seed. Reports how long after the process
+was started each of those steps finished. Each run gets its own seed, so that nodes from
+earlier runs, which have since exited, don't slow the bootstrap down.
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+import typing
+
+
+STEPS = ('imported', 'constructed', 'listening', 'bootstrapped')
+
+
+async def _child(port: int, seed_port: typing.Optional[int], started: float):
+    # everything before this line is the cost of starting python, the rest is ours
+    import asyncio
+    import kademlia
+    times = {'imported': time.time()}
+
+    node = kademlia.Node('127.0.0.1', port)
+    times['constructed'] = time.time()
+
+    await node.listen()
+    times['listening'] = time.time()
+
+    if seed_port is None:
+        print('ready', flush=True)
+        await asyncio.Event().wait()  # until we're killed
+
+    await node.bootstrap('127.0.0.1', seed_port)
+    times['bootstrapped'] = time.time()
+    node.stop()
+
+    print(json.dumps({step: when - started for step, when in times.items()}), flush=True)
+
+
+def _spawn(*args) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, __file__, *map(str, args)], stdout=subprocess.PIPE, text=True
+    )
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--base-port', type=int, default=7500)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    parser.add_argument('--child', nargs=3, metavar=('PORT', 'SEED_PORT', 'STARTED'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        import asyncio
+        port, seed_port, started = args.child
+        seed_port = None if seed_port == '-' else int(seed_port)
+        asyncio.run(_child(int(port), seed_port, float(started)))
+        return {}
+
+    # not at the top, the children shouldn't pay for importing kademlia before they're timed
+    from loadtest import percentile
+
+    seed_port, port = args.base_port, args.base_port + 1
+    runs: typing.Dict[str, typing.List[float]] = {step: list() for step in STEPS}
+    for _ in range(args.runs):
+        seed = _spawn('--child', seed_port, '-', time.time())
+        try:
+            assert seed.stdout.readline().strip() == 'ready', 'the seed node did not start'
+            child = _spawn('--child', port, seed_port, time.time())
+            output, _ = child.communicate(timeout=60)
+        finally:
+            seed.kill()
+            seed.wait()
+        for step, elapsed in json.loads(output).items():
+            runs[step].append(elapsed)
+
+    report = {}
+    for step, samples in runs.items():
+        samples.sort()
+        report[step] = {
+            'min_ms': samples[0] * 1000,
+            'p50_ms': percentile(samples, 0.5) * 1000,
+            'p90_ms': percentile(samples, 0.9) * 1000,
+            'max_ms': samples[-1] * 1000,
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f'{args.runs} runs, milliseconds since the process was started:')
+        for step, stats in report.items():
+            print(f"{step:>13}: min {stats['min_ms']:.1f} p50 {stats['p50_ms']:.1f} "
+                  f"p90 {stats['p90_ms']:.1f} max {stats['max_ms']:.1f}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+'''
+Decides how many RPCs our lookups keep in flight, from the timeouts and round trip times
+we observe, instead of always sending Constants.alpha queries per round.
+
+There are two knobs:
+
+- a global window, the most lookup RPCs we'll have in flight at once. It grows by one
+  every window's worth of responses, and is halved (at most once per round trip) while
+  we see signs of congestion: round trips taking much longer than the fastest ones.
+- each lookup's alpha. Timeouts while round trip times stay flat look like a lossy
+  network rather than a congested one, so we query more nodes per round, enough that
+  about alpha of them can be expected to answer. No lookup gets more than its share of
+  the window though.
+
+It also decides when a lookup should hedge: when a peer is slower to answer than
+hedge_percentile of recent round trips, the lookup asks another peer the same question
+and takes whichever answer arrives first. Every RPC a lookup sends earns hedge_budget
+hedges, so hedging adds at most that fraction of extra load.
+'''
+import asyncio
+import bisect
+import collections
+import math
+import time
+import typing
+
+import core
+
+
+# how quickly the smoothed loss rate and round trip time follow new samples
+GAIN = 1 / 8
+
+# round trips this many times slower than the fastest we've seen mean a queue is building
+# up somewhere
+RTT_TOLERANCE = 2
+
+# peers are near and far, and routes change, so the fastest round trip we remember slowly
+# follows the typical one
+MIN_RTT_DRIFT = 1 / 256
+
+# we don't hedge until we've seen enough round trips to know what a slow one looks like
+HEDGE_MIN_SAMPLES = 16
+
+# how many unspent hedges can build up, so a burst of slow peers can't all be hedged
+HEDGE_BURST = 10
+
+
+class AdaptiveConcurrency:
+    def __init__(self, constants: core.Constants, clock=time.monotonic):
+        self.constants = constants
+        self.clock = clock
+
+        self.window: float = constants.inflight_window
+        self.inflight = 0
+        self.lookups = 0  # how many lookups are sharing the window
+        self.waiters: typing.Deque[asyncio.Future] = collections.deque()
+
+        self.loss = 0.0  # a moving average of the fraction of RPCs which time out
+        self.srtt: typing.Optional[float] = None  # smoothed round trip time
+        self.min_rtt: typing.Optional[float] = None
+        self.last_decrease: float = -math.inf
+
+        self.rtts: typing.Deque[float] = collections.deque(maxlen=256)  # the most recent
+        self.sorted_rtts: typing.List[float] = list()  # the same ones, sorted
+        self.hedge_tokens = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.constants.adaptive_concurrency
+
+    def alpha(self) -> int:
+        'How many queries a lookup should send in its next round'
+        alpha = self.constants.alpha
+        if not self.enabled:
+            return alpha
+
+        delivered = max(1 - self.loss, 1e-3)
+        wanted = max(alpha, min(self.constants.max_alpha, round(alpha / delivered)))
+        share = int(self.window // max(1, self.lookups))
+        return max(1, min(wanted, share))
+
+    # Observations
+
+    def _congested(self) -> bool:
+        return self.srtt is not None and self.srtt > RTT_TOLERANCE * self.min_rtt
+
+    def _resize(self, window: float):
+        bounds = self.constants.min_inflight_window, self.constants.max_inflight_window
+        self.window = max(bounds[0], min(bounds[1], window))
+        self._wake()
+
+    def _decrease(self):
+        now = self.clock()
+        # all the RPCs in flight during a bout of congestion will tell us about it, but one
+        # decrease per round trip is enough
+        if now - self.last_decrease < (self.srtt or self.constants.rpc_timeout):
+            return
+        self.last_decrease = now
+        self._resize(self.window / 2)
+
+    def responded(self, rtt: float):
+        if len(self.rtts) == self.rtts.maxlen:
+            del self.sorted_rtts[bisect.bisect_left(self.sorted_rtts, self.rtts[0])]
+        self.rtts.append(rtt)
+        bisect.insort(self.sorted_rtts, rtt)
+        self.loss -= GAIN * self.loss
+        if self.srtt is None:
+            self.srtt = self.min_rtt = rtt
+        else:
+            self.srtt += GAIN * (rtt - self.srtt)
+            self.min_rtt = min(rtt, self.min_rtt + MIN_RTT_DRIFT * (self.srtt - self.min_rtt))
+
+        if self._congested():
+            self._decrease()
+        else:
+            self._resize(self.window + 1 / self.window)
+
+    def timed_out(self):
+        self.loss += GAIN * (1 - self.loss)
+        if self._congested():
+            self._decrease()
+
+    # Hedging
+
+    def hedge_delay(self) -> typing.Optional[float]:
+        'How long to wait for an answer before hedging, None if we should not hedge'
+        rtts = self.sorted_rtts
+        if self.constants.hedge_budget == 0 or len(rtts) < HEDGE_MIN_SAMPLES:
+            return None
+        rank = min(len(rtts) - 1, int(self.constants.hedge_percentile * len(rtts)))
+        return rtts[rank]
+
+    def primary_sent(self):
+        self.hedge_tokens = min(HEDGE_BURST, self.hedge_tokens + self.constants.hedge_budget)
+
+    def take_hedge(self) -> bool:
+        'Returns whether there is budget for another hedged request, and spends it'
+        if self.hedge_tokens < 1 - 1e-9:  # ten tenths should make a whole
+            return False
+        self.hedge_tokens -= 1
+        return True
+
+    # The window
+
+    def _wake(self):
+        while self.waiters and self.inflight < self.window:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        'Waits until there is room in the window for another RPC'
+        if not self.enabled or (self.inflight < self.window and not self.waiters):
+            self.inflight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # we were given a slot we'll never use
+            raise
+
+    def release(self):
+        self.inflight -= 1
+        self._wake()
+
+    def metrics(self) -> dict:
+        return {
+            'window': self.window,
+            'inflight': self.inflight,
+            'waiting': len(self.waiters),
+            'alpha': self.alpha(),
+            'loss': self.loss,
+            'srtt': self.srtt,
+            'min_rtt': self.min_rtt,
+            'hedge_delay': self.hedge_delay(),
+        }
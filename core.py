@@ -7,14 +7,162 @@ import functools
 import ipaddress
 import itertools
 import random
+import time
 import typing
 
+import idspace
+
 Address = typing.Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
 
 
-class Constants(typing.NamedTuple):
-    alpha = 3
-    k = 2
+@dataclasses.dataclass
+class Constants:
+    '''
+    Everything about a node which can be tuned. All times are in seconds.
+
+    The fields in TUNABLE may be changed while a node is running, through
+    Server.tune(), the others are only read when a node starts.
+    '''
+    alpha: int = 3  # how many nodes a lookup queries at once
+    k: int = 2  # the size of each bucket, and how many replicas each value is stored on
+
+    bucket_splitting: bool = False  # use a TreeRoutingTable rather than a RoutingTable
+
+    rpc_timeout: float = 2  # how long we wait for a response before giving up on a peer
+
+    # lookup concurrency, see concurrency.py. When it's adaptive alpha is the least a
+    # lookup sends per round
+    adaptive_concurrency: bool = True
+    max_alpha: int = 8
+    inflight_window: int = 64  # lookup RPCs in flight at once, where the window starts
+    min_inflight_window: int = 4
+    max_inflight_window: int = 1024
+
+    # hedged lookup RPCs, see concurrency.py
+    hedge_percentile: float = 0.95  # hedge RPCs which take longer than this many do
+    hedge_budget: float = 0.1  # at most this many extra RPCs per RPC, 0 turns it off
+
+    # transports
+    max_datagram_size: int = 1200  # larger messages are sent over a stream
+    stream_transport: bool = True  # also listen for streams, and use them when we have to
+    stream_fallback_after: int = 2  # use a stream once a peer ignores this many datagrams
+    stream_fallback_ttl: float = 600  # after this many seconds try datagrams again
+    stream_fallback_memory: int = 4096  # how many peers' timeouts we remember
+    stream_pool_size: int = 64  # how many outgoing connections we keep open
+
+    # outgoing messages, see protocol.Outbox. Rates are in messages per second
+    send_batch: int = 256  # the most messages sent per iteration of the event loop
+    send_queue_limit: int = 4096  # the most messages of each priority waiting to be sent
+    response_send_rate: float = 10000
+    interactive_send_rate: float = 5000
+    maintenance_send_rate: float = 200
+
+    # bucket refreshes
+    refresh_interval: float = 3600  # a bucket is stale once it's been quiet for this long
+    refresh_check_interval: float = 60  # how often we look for stale buckets
+    refresh_concurrency: int = 3  # how many refresh lookups may run at once
+    refresh_budget: int = 8  # the most refresh lookups we'll start during a single check
+    refresh_timeout: float = 30
+
+    # incoming requests, rates are in requests per second
+    peer_request_rate: float = 50  # per source ip and message type
+    peer_request_burst: float = 100
+    global_request_rate: float = 5000
+    global_request_burst: float = 10000
+    overload_reserve: float = 0.2  # below this fraction of the global burst we only
+                                   # serve Store and FindValue
+
+    # storage
+    storage_budget: int = 64 * 1024 * 1024  # bytes
+    storage_shards: int = 16
+    storage_eviction: str = 'lru'  # or 'distance', which keeps the keys closest to us
+    max_version_skew: float = 60  # refuse versions from further in the future, seconds
+
+    # replica maintenance, see antientropy.py
+    read_repair: bool = True  # value lookups store what they find on the replicas they
+                              # passed which were missing it
+    sync_interval: float = 60  # how often we compare our keys with a neighbour's
+    sync_parts: int = 16  # how many parts a digest splits the shared keys into, <= 256
+    sync_max_keys: int = 64  # the most keys a digest response lists
+    sync_concurrency: int = 4  # how many values a sync transfers at once
+    handoff: bool = True  # give new nodes the keys they're now among the k closest to
+    handoff_batch: int = 8  # how many STOREs a handoff sends at once
+    handoff_rate: float = 100  # and the most it sends per second
+
+    # signing, which needs the cryptography package
+    signed_messages: bool = False  # sign what we send, drop what isn't signed
+    verify_cache_size: int = 10000  # how many peers' public keys we remember checking
+    verify_threads: int = 2  # signatures are checked on this many threads
+
+    # S/Kademlia's crypto puzzles, how many leading zero bits each hash needs, see
+    # puzzles.py. 0 turns a puzzle off
+    static_puzzle_bits: int = 0
+    dynamic_puzzle_bits: int = 0
+
+    TUNABLE: typing.ClassVar[typing.FrozenSet[str]] = frozenset({
+        'alpha', 'k', 'rpc_timeout', 'max_datagram_size', 'stream_fallback_after',
+        'stream_fallback_ttl', 'stream_fallback_memory',
+        'adaptive_concurrency', 'max_alpha', 'min_inflight_window', 'max_inflight_window',
+        'hedge_percentile', 'hedge_budget',
+        'send_batch', 'send_queue_limit',
+        'response_send_rate', 'interactive_send_rate', 'maintenance_send_rate',
+        'refresh_interval', 'refresh_check_interval', 'refresh_concurrency',
+        'refresh_budget', 'refresh_timeout',
+        'peer_request_rate', 'peer_request_burst', 'global_request_rate',
+        'global_request_burst', 'overload_reserve',
+        'storage_budget', 'storage_eviction', 'max_version_skew',
+        'read_repair', 'sync_interval', 'sync_parts', 'sync_max_keys', 'sync_concurrency',
+        'handoff', 'handoff_batch', 'handoff_rate',
+    })
+
+    def __post_init__(self):
+        self.validate()
+
+    def validate(self):
+        positive = (
+            'alpha', 'k', 'rpc_timeout', 'max_datagram_size', 'stream_fallback_after',
+            'stream_fallback_ttl', 'stream_fallback_memory',
+            'max_alpha', 'inflight_window', 'min_inflight_window', 'max_inflight_window',
+            'stream_pool_size', 'send_batch', 'send_queue_limit',
+            'response_send_rate', 'interactive_send_rate',
+            'maintenance_send_rate', 'refresh_interval', 'refresh_check_interval',
+            'refresh_concurrency', 'refresh_budget', 'refresh_timeout',
+            'peer_request_rate', 'peer_request_burst', 'global_request_rate',
+            'global_request_burst', 'storage_budget', 'storage_shards', 'max_version_skew',
+            'verify_cache_size', 'verify_threads', 'sync_interval', 'sync_max_keys',
+            'sync_concurrency', 'handoff_batch', 'handoff_rate',
+        )
+        for name in positive:
+            if getattr(self, name) <= 0:
+                raise ValueError(f'{name} must be positive, not {getattr(self, name)}')
+        if self.min_inflight_window > self.max_inflight_window:
+            raise ValueError('min_inflight_window is larger than max_inflight_window')
+        if not 0 < self.hedge_percentile <= 1:
+            raise ValueError('hedge_percentile must be in (0, 1]')
+        if self.hedge_budget < 0:
+            raise ValueError('hedge_budget may not be negative')
+        if not 0 <= self.overload_reserve < 1:
+            raise ValueError('overload_reserve must be in [0, 1)')
+        for name in ('static_puzzle_bits', 'dynamic_puzzle_bits'):
+            if not 0 <= getattr(self, name) <= 160:
+                raise ValueError(f'{name} must be in [0, 160]')
+        if not 1 <= self.sync_parts <= 256:  # antientropy.MAX_PARTS
+            raise ValueError('sync_parts must be in [1, 256]')
+        if self.storage_eviction not in ('lru', 'distance'):
+            raise ValueError(f'unknown eviction policy {self.storage_eviction}')
+
+    def tune(self, **changes):
+        '''
+        Changes the given settings in place. Raises (and changes nothing) if any of them
+        may not be changed at runtime or the new values are invalid.
+        '''
+        fixed = set(changes) - self.TUNABLE
+        if fixed:
+            raise ValueError(f'{", ".join(sorted(fixed))} cannot be changed at runtime')
+
+        dataclasses.replace(self, **changes)  # raises if the new values are invalid
+        for name, value in changes.items():
+            setattr(self, name, value)
 
 
 def newnonce():
@@ -49,17 +197,13 @@ def bucket_ranges(bucket_index: int) -> typing.Tuple[int, int]:
     assert bucket_index >= 0
     assert bucket_index < 160
 
-    return (
-        2**bucket_index,
-        (2**(bucket_index+1)) - 1
-    )
+    return idspace.BUCKET_BOUNDS[bucket_index]
 
 
 def random_key_in_bucket(myid: ID, bucket_index: int) -> ID:
     'Returns a random key which belongs in the given bucket'
-    distances = bucket_ranges(bucket_index) # everything in the bucket is this far from us
-    distance = random.randrange(*distances)
-    return ID(myid.value ^ distance)
+    assert 0 <= bucket_index < 160
+    return ID(myid.value ^ idspace.random_distance(bucket_index))
 
 
 class Node(typing.NamedTuple):
@@ -68,10 +212,38 @@ class Node(typing.NamedTuple):
     nodeid: ID
 
 
+class Version(typing.NamedTuple):
+    '''
+    Orders the writes to a key, a newer version replaces an older one. Versions are ordered
+    by their timestamp, ties between publishers are broken by the publishers' ids.
+    '''
+    timestamp: int = 0  # microseconds since the epoch
+    publisher: bytes = b''
+
+    @classmethod
+    def now(cls, publisher: ID) -> Version:
+        return cls(time.time_ns() // 1000, publisher.to_bytes())
+
+    def too_new(self, skew: float) -> bool:
+        '''
+        Whether this claims to be more than skew seconds newer than our clock. We refuse
+        those, or a single write could make a key impossible to ever change again.
+        '''
+        return self.timestamp > time.time_ns() // 1000 + skew * 1000000
+
+
+# the version of values stored by nodes which don't version them
+NO_VERSION = Version()
+
+
 class RoutingEntry(typing.NamedTuple):
     node: Node
     last_seen: datetime.datetime
 
+    # when the node claims an address other than the one its messages come from, node
+    # holds the address we observed and this holds the (addr, port) it claimed
+    claimed: typing.Optional[typing.Tuple[str, int]] = None
+
     def update_last_seen(self):
         now = datetime.datetime.utcnow()
         return self._replace(last_seen=now)
@@ -85,13 +257,33 @@ class NoRoomInBucket(Exception):
         self.entry = entry
 
 
+class NotAdmitted(Exception):
+    '''
+    Raised by RoutingTable.node_seen, the node may not join our routing table
+    '''
+
+
+# decides whether a node, given its id and the puzzle solution it sent, may join
+Admission = typing.Callable[[ID, typing.Optional[bytes]], bool]
+
+
 class RoutingTable:
     Bucket = typing.MutableMapping[ID, RoutingEntry]  # Actually, an OrderedDict
 
-    def __init__(self, k: int, mynodeid: ID):
+    def __init__(self, k: int, mynodeid: ID, admission: Admission = None):
         self.k = k
         self.nodeid = mynodeid
+        self.admission = admission
+
+        # which buckets, by distance from us, hold any nodes
+        self.occupancy = idspace.Occupancy()
+        self._init_buckets()
 
+        # when we last heard from a node in (or performed a lookup into) each bucket
+        self.created = datetime.datetime.utcnow()
+        self.bucket_activity: typing.Dict[int, datetime.datetime] = dict()
+
+    def _init_buckets(self):
         Buckets = typing.List[self.Bucket]
         self.buckets: Buckets = collections.defaultdict(collections.OrderedDict)
 
@@ -108,41 +300,67 @@ class RoutingTable:
 
     def _bucket_for(self, nodeid: ID) -> RoutingTable.Bucket:
         bucket_index = self._bucket_index_for(nodeid)
+        if bucket_index not in self.occupancy:
+            return collections.OrderedDict()  # don't leave an empty bucket behind
         return self.buckets[bucket_index]
     
+    def entry_for(self, nodeid: ID) -> RoutingEntry:
+        bucket = self._bucket_for(nodeid)
+        return bucket[nodeid]  # may raise KeyError if nodeid is not known
+
     def last_seen_for(self, nodeid: ID) -> datetime.datetime:
-        bucket_index = self._bucket_index_for(nodeid)
-        bucket = self.buckets[bucket_index]
-        entry = bucket[nodeid]  # may raise KeyError if nodeid is not known
-        return entry.last_seen
+        return self.entry_for(nodeid).last_seen
+
+    def nodes(self) -> typing.Iterator[Node]:
+        'Every node in the routing table, in no particular order'
+        for bucket in list(self.buckets.values()):
+            for entry in bucket.values():
+                yield entry.node
+
+    def touch_bucket(self, bucket_index: int, when: datetime.datetime = None):
+        'Records that there has been activity in this bucket'
+        if when is None:
+            when = datetime.datetime.utcnow()
+        self.bucket_activity[bucket_index] = when
+
+    def lookup_performed(self, targetnodeid: ID):
+        'A node lookup for targetnodeid refreshes the bucket it falls into'
+        if targetnodeid == self.nodeid:
+            return
+        self.touch_bucket(self._bucket_index_for(targetnodeid))
+
+    def stale_buckets(self, max_age: datetime.timedelta,
+                      now: datetime.datetime = None) -> typing.List[int]:
+        '''
+        Returns the buckets, from our closest neighbor outwards, which have not seen any
+        activity for max_age. The ones which have been quiet the longest come first.
+        '''
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        try:
+            closest = self.first_occupied_bucket()
+        except IndexError:
+            return []  # we don't know anybody, a lookup would go nowhere
+
+        last_activity = lambda index: self.bucket_activity.get(index, self.created)
+        stale = [
+            index for index in range(closest, idspace.BUCKET_COUNT)
+            if now - last_activity(index) > max_age
+        ]
+        return sorted(stale, key=last_activity)
 
     def first_occupied_bucket(self) -> int:
         'Returns the bucket containing our closest known neighbor'
-        # TODO: write a test
-        for index in range(160):
-            bucket = self.buckets[index]
-            if len(bucket) > 0:
-                return index
-        raise IndexError
+        return self.occupancy.first()
 
-    @staticmethod
-    def _i_centered_indexes(i: int, length: int) -> typing.Iterator[int]:
-        'Generates a permutation of range(length)'
-        assert(length > 0)
-        yield (i,)
-        width = 1
-        while True:
-            to_return = tuple()
-            if (i-width) >= 0:
-                to_return += (i-width,)
-            if (i+width) < length:
-                to_return += (i+width,)
-
-            if len(to_return):
-                yield to_return
-            else:
-                break
-            width += 1
+    def last_occupied_bucket(self) -> int:
+        'Returns the bucket containing our furthest known neighbor'
+        return self.occupancy.last()
+
+    def occupied_buckets(self) -> typing.Iterator[int]:
+        'The indexes of the buckets which hold any nodes, closest to us first'
+        return iter(self.occupancy)
 
     def closest(self, targetnodeid: ID, n:int = None) -> typing.List[Node]:
         'Returns the k nodes we know of which are closest to key'
@@ -155,7 +373,7 @@ class RoutingTable:
         if n is None:
             n = self.k
 
-        bucket_indexes = self._i_centered_indexes(bucket_index, 160)
+        bucket_indexes = self.occupancy.by_distance(bucket_index)
         return self._closest_nodes(targetnodeid, n, bucket_indexes)
 
     def closest_to_me(self, n:int = None) -> typing.List[Node]:
@@ -163,7 +381,7 @@ class RoutingTable:
         if n is None:
             n = self.k
 
-        buckets_to_check = ([i] for i in range(160))
+        buckets_to_check = ((index,) for index in self.occupancy)
         return self._closest_nodes(self.nodeid, n, buckets_to_check)
 
     def _closest_nodes(self, targetnodeid: ID, n: int, bucket_iterator):
@@ -200,21 +418,50 @@ class RoutingTable:
         assert(len(dictionary) > 0)
         return next(iter(dictionary.items()))
 
-    def node_seen(self, node: Node):
+    def _admit(self, node: Node, puzzle: typing.Optional[bytes]):
+        if self.admission is not None and not self.admission(node.nodeid, puzzle):
+            raise NotAdmitted(node)
+
+    def ownership_mask(self, excluding: ID = None) -> int:
+        '''
+        We're closer to a key than a node in bucket i exactly when the key agrees with our
+        id at bit i. So a key which agrees with our id at every bit set in this mask is
+        closer to us than to any node in the table, except maybe excluding.
+        '''
+        mask = self.occupancy.bits
+        if excluding is not None:
+            bucket_index = self._bucket_index_for(excluding)
+            if self.occupancy.counts[bucket_index] == 1:
+                mask &= ~(1 << bucket_index)
+        return mask
+
+    def node_seen(self, node: Node, claimed: typing.Tuple[str, int] = None,
+                  puzzle: bytes = None) -> bool:
+        '''
+        We've heard from this node. If it claimed to be at some other address than the one
+        we heard from, node should have the observed address, claimed the other one.
+        puzzle is the node's solution to the dynamic puzzle, if it sent one. Returns
+        whether the node was new to us.
+        '''
         assert self.nodeid != node.nodeid, (self.nodeid, node.nodeid)
+        self._admit(node, puzzle)
 
-        bucket: collections.OrderedDict = self._bucket_for(node.nodeid)
+        bucket_index = self._bucket_index_for(node.nodeid)
+        bucket: collections.OrderedDict = self.buckets[bucket_index]
+        self.touch_bucket(bucket_index)
 
         if node.nodeid in bucket:
-            bucket[node.nodeid] = bucket[node.nodeid].update_last_seen()
+            entry = bucket[node.nodeid].update_last_seen()
+            bucket[node.nodeid] = entry._replace(node=node, claimed=claimed)
             bucket.move_to_end(node.nodeid)
-            return
+            return False
 
         if len(bucket) < self.k:
             now = datetime.datetime.utcnow()
-            entry = RoutingEntry(node=node, last_seen=now)
+            entry = RoutingEntry(node=node, last_seen=now, claimed=claimed)
             bucket[node.nodeid] = entry
-            return
+            self.occupancy.add(bucket_index)
+            return True
 
         nodeid, routing_entry = self._first_element_of_ordered_dict(bucket)
         raise NoRoomInBucket(routing_entry)
@@ -223,3 +470,165 @@ class RoutingTable:
         'Removes this node from the routing table'
         bucket: collections.OrderedDict = self._bucket_for(nodeid)
         del bucket[nodeid]
+        self.occupancy.remove(self._bucket_index_for(nodeid))
+
+
+class _TreeBucket:
+    'A leaf of the TreeRoutingTable, holds the nodes whose ids start with prefix'
+
+    def __init__(self, depth: int, prefix: int):
+        self.depth = depth  # how many bits of prefix are significant
+        self.prefix = prefix
+        self.entries: RoutingTable.Bucket = collections.OrderedDict()
+
+    def covers(self, nodeid: ID) -> bool:
+        return nodeid.value >> (160 - self.depth) == self.prefix
+
+    def split(self) -> typing.Tuple[_TreeBucket, _TreeBucket]:
+        'Returns the (zero, one) halves of this bucket, entries keep their LRU order'
+        halves = (
+            _TreeBucket(self.depth + 1, self.prefix << 1),
+            _TreeBucket(self.depth + 1, (self.prefix << 1) | 1),
+        )
+        for nodeid, entry in self.entries.items():
+            half = halves[_bit_at(nodeid, self.depth)]
+            half.entries[nodeid] = entry
+        return halves
+
+
+class _TreeBranch:
+    def __init__(self, depth: int, children: typing.Tuple[_TreeNode, _TreeNode]):
+        self.depth = depth  # the bit which decides between our children
+        self.children = children
+
+
+_TreeNode = typing.Union[_TreeBucket, _TreeBranch]
+
+
+def _bit_at(nodeid: ID, depth: int) -> int:
+    'Returns the depth-th most significant bit of the id'
+    return (nodeid.value >> (159 - depth)) & 1
+
+
+class TreeRoutingTable(RoutingTable):
+    '''
+    The routing table described in the paper: a binary tree of k-buckets. It starts as a
+    single bucket covering the whole id space, and whenever a full bucket covering our own
+    id is asked to hold another node it splits in two. So, we know about more nodes the
+    closer they are to us.
+
+    Buckets which do not cover our id also split when the new node would be one of the k
+    closest to us we know of (the paper's relaxed splitting), otherwise an unbalanced id
+    space can leave us knowing fewer than k of our closest neighbors.
+    '''
+
+    def _init_buckets(self):
+        self.root: _TreeNode = _TreeBucket(depth=0, prefix=0)
+
+    @property
+    def buckets(self) -> typing.Dict[int, RoutingTable.Bucket]:
+        'The contents of each leaf of the tree, left to right'
+        return {
+            index: leaf.entries for index, leaf in enumerate(self._leaves(self.root))
+        }
+
+    def _leaves(self, node: _TreeNode) -> typing.Iterator[_TreeBucket]:
+        if isinstance(node, _TreeBucket):
+            yield node
+            return
+        for child in node.children:
+            yield from self._leaves(child)
+
+    def _leaf_for(self, nodeid: ID) -> typing.Tuple[_TreeBucket, typing.Optional[_TreeBranch]]:
+        'Returns the bucket nodeid belongs in, and the branch that bucket hangs off of'
+        parent, node = None, self.root
+        while isinstance(node, _TreeBranch):
+            parent, node = node, node.children[_bit_at(nodeid, node.depth)]
+        return node, parent
+
+    def _bucket_for(self, nodeid: ID) -> RoutingTable.Bucket:
+        return self._leaf_for(nodeid)[0].entries
+
+    def _leaves_by_distance(self, targetnodeid: ID) -> typing.Iterator[_TreeBucket]:
+        '''
+        Walks the leaves in order of their distance from the target. Everything in the
+        child which shares the target's next bit is closer to it than anything in the
+        other child, so this is a depth-first search which always visits that one first.
+        '''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, _TreeBucket):
+                yield node
+                continue
+            bit = _bit_at(targetnodeid, node.depth)
+            stack.append(node.children[1 - bit])
+            stack.append(node.children[bit])
+
+    def closest(self, targetnodeid: ID, n: int = None) -> typing.List[Node]:
+        'Returns the k nodes we know of which are closest to key'
+        if n is None:
+            n = self.k
+
+        result = []
+        dist_from_target = lambda node: targetnodeid.distance(node.nodeid)
+        for leaf in self._leaves_by_distance(targetnodeid):
+            if len(result) >= n:
+                break
+            nodes = [entry.node for entry in leaf.entries.values()]
+            result.extend(sorted(nodes, key=dist_from_target))
+        return result[:n]
+
+    def closest_to_me(self, n: int = None) -> typing.List[Node]:
+        return self.closest(self.nodeid, n)
+
+    def _should_split(self, leaf: _TreeBucket, node: Node) -> bool:
+        if leaf.depth >= 160:
+            return False
+        if leaf.covers(self.nodeid):
+            return True
+
+        # relaxed splitting: keep all of our k closest neighbors
+        closest = self.closest_to_me(self.k)
+        if len(closest) < self.k:
+            return True
+        return self.nodeid.distance(node.nodeid) < self.nodeid.distance(closest[-1].nodeid)
+
+    def _split(self, leaf: _TreeBucket, parent: typing.Optional[_TreeBranch]):
+        branch = _TreeBranch(leaf.depth, leaf.split())
+        if parent is None:
+            self.root = branch
+        else:
+            bit = leaf.prefix & 1
+            children = list(parent.children)
+            children[bit] = branch
+            parent.children = tuple(children)
+
+    def node_seen(self, node: Node, claimed: typing.Tuple[str, int] = None,
+                  puzzle: bytes = None) -> bool:
+        assert self.nodeid != node.nodeid, (self.nodeid, node.nodeid)
+        self._admit(node, puzzle)
+        bucket_index = self._bucket_index_for(node.nodeid)
+        self.touch_bucket(bucket_index)
+
+        while True:
+            leaf, parent = self._leaf_for(node.nodeid)
+            bucket = leaf.entries
+
+            if node.nodeid in bucket:
+                entry = bucket[node.nodeid].update_last_seen()
+                bucket[node.nodeid] = entry._replace(node=node, claimed=claimed)
+                bucket.move_to_end(node.nodeid)
+                return False
+
+            if len(bucket) < self.k:
+                now = datetime.datetime.utcnow()
+                bucket[node.nodeid] = RoutingEntry(node=node, last_seen=now, claimed=claimed)
+                self.occupancy.add(bucket_index)
+                return True
+
+            if not self._should_split(leaf, node):
+                nodeid, routing_entry = self._first_element_of_ordered_dict(bucket)
+                raise NoRoomInBucket(routing_entry)
+
+            self._split(leaf, parent)
@@ -0,0 +1,110 @@
+'''
+Facts about the 160-bit id space and the buckets which divide it up, computed once.
+
+Bucket i holds the nodes whose distance from us is in [2**i, 2**(i+1)), the nodes which
+share our first 159 - i bits but not the next one.
+'''
+import random
+import typing
+
+
+ID_BITS = 160
+BUCKET_COUNT = ID_BITS
+
+# the smallest and largest distance from us of anything in each bucket
+BUCKET_BOUNDS: typing.Tuple[typing.Tuple[int, int], ...] = tuple(
+    (1 << index, (1 << (index + 1)) - 1) for index in range(BUCKET_COUNT)
+)
+
+
+def random_distance(bucket_index: int) -> int:
+    'A random distance from us which falls into this bucket'
+    low, _ = BUCKET_BOUNDS[bucket_index]
+    if bucket_index == 0:
+        return low  # before 3.9 getrandbits(0) raises
+    return low | random.getrandbits(bucket_index)
+
+
+def prefix_of(key: int, depth: int) -> int:
+    'Clears all but the first depth bits of key'
+    return key >> (ID_BITS - depth) << (ID_BITS - depth)
+
+
+def key_range(prefix: int, depth: int) -> typing.Tuple[int, int]:
+    'The ids whose first depth bits are those of prefix, as [low, high)'
+    return prefix, prefix + (1 << (ID_BITS - depth))
+
+
+def _indexes(bits: int) -> typing.Iterator[int]:
+    'The set bits of this bitmap, lowest first'
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class Occupancy:
+    '''
+    Counts the nodes in each bucket and keeps a bitmap of which buckets hold at least one,
+    so finding the occupied buckets doesn't mean looking into all 160 of them.
+    '''
+
+    def __init__(self):
+        self.bits = 0
+        self.counts = [0] * BUCKET_COUNT
+
+    def add(self, bucket_index: int):
+        'A node was added to this bucket'
+        self.counts[bucket_index] += 1
+        self.bits |= 1 << bucket_index
+
+    def remove(self, bucket_index: int):
+        'A node was removed from this bucket'
+        assert self.counts[bucket_index] > 0, bucket_index
+        self.counts[bucket_index] -= 1
+        if not self.counts[bucket_index]:
+            self.bits &= ~(1 << bucket_index)
+
+    def __contains__(self, bucket_index: int) -> bool:
+        return bool(self.bits >> bucket_index & 1)
+
+    def __len__(self) -> int:
+        'How many buckets are occupied'
+        return bin(self.bits).count('1')
+
+    def __iter__(self) -> typing.Iterator[int]:
+        'The occupied buckets, closest to us first'
+        return _indexes(self.bits)
+
+    def first(self) -> int:
+        'The occupied bucket closest to us, raises IndexError if they are all empty'
+        if not self.bits:
+            raise IndexError('no bucket is occupied')
+        return (self.bits & -self.bits).bit_length() - 1
+
+    def last(self) -> int:
+        'The occupied bucket furthest from us, raises IndexError if they are all empty'
+        if not self.bits:
+            raise IndexError('no bucket is occupied')
+        return self.bits.bit_length() - 1
+
+    def by_distance(self, bucket_index: int) -> typing.Iterator[typing.Tuple[int, ...]]:
+        '''
+        Groups the occupied buckets by how far their nodes are from a target which falls
+        into bucket_index. Every node in a group is closer to the target than any node in
+        a later group, nodes within a group have to be sorted.
+
+        The target's own bucket comes first, its nodes agree with the target on every bit
+        above bucket_index. All the closer buckets come next, as one group, they all differ
+        from the target at bit bucket_index. Then the further buckets, in order.
+        '''
+        if bucket_index in self:
+            yield (bucket_index,)
+
+        closer = tuple(_indexes(self.bits & ((1 << bucket_index) - 1)))
+        if closer:
+            yield closer
+
+        further = self.bits >> (bucket_index + 1) << (bucket_index + 1)
+        for index in _indexes(further):
+            yield (index,)
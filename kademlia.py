@@ -1,9 +1,15 @@
 import asyncio
+import datetime
 import logging
 import typing
 
 import core
+import idspace
 import protocol
+import puzzles
+
+if typing.TYPE_CHECKING:
+    import tracing
 
 
 logger = logging.getLogger('kademlia')
@@ -12,17 +18,63 @@ ID = core.ID
 
 
 class Node():
-    def __init__(self, addr: str, port: int, constants: core.Constants = None):
+    def __init__(self, addr: str, port: int, constants: core.Constants = None,
+                 credentials: puzzles.Credentials = None):
         self.constants = constants if constants is not None else core.Constants()
         self.addr = addr
         self.port = port
-        self.nodeid = core.ID()
+
+        # our node id, and the keys and puzzle solutions which go with it. Solving the
+        # puzzles can take a while and blocks, Node.create() solves them off the loop
+        if credentials is None:
+            credentials = puzzles.solve(self.constants)
+        self.identity = credentials.identity
+        self.nodeid = credentials.nodeid
 
         self.node = core.Node(addr=addr, port=port, nodeid=self.nodeid)
-        self.server = protocol.Server(self.nodeid, self.constants)
+        self.server = protocol.Server(
+            self.nodeid, self.constants, self.identity, credentials.puzzle
+        )
+
+        self.refresher: asyncio.Task = None
+        self.syncer: asyncio.Task = None
+        self.sync_turns = 0  # we sync with each of our neighbours in turn
+
+    @classmethod
+    async def create(cls, addr: str, port: int, constants: core.Constants = None,
+                     workers: int = None) -> 'Node':
+        'Makes a Node, solving its puzzles on a pool of workers processes'
+        constants = constants if constants is not None else core.Constants()
+        credentials = await puzzles.solve_in_pool(constants, workers)
+        return cls(addr, port, constants, credentials)
 
     async def listen(self):
+        'Starts serving requests, and refreshing our buckets once they go stale'
         await self.server.listen(self.addr, self.port)
+        self.start_refreshing()
+
+    def start_refreshing(self):
+        'Periodically refresh any buckets which have gone stale, until stop() is called'
+        if self.refresher is None:
+            self.refresher = asyncio.get_running_loop().create_task(self._refresh_loop())
+
+    def start_syncing(self):
+        'Periodically sync our keys with one of our closest neighbours, until stop()'
+        if self.syncer is None:
+            self.syncer = asyncio.get_running_loop().create_task(self._sync_loop())
+
+    def tune(self, **changes):
+        'Changes some of our constants while we run, see Constants.TUNABLE'
+        self.server.tune(**changes)
+
+    def stop(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+        if self.syncer is not None:
+            self.syncer.cancel()
+            self.syncer = None
+        self.server.stop()
 
     async def _refresh(self, bucket: int):
         '''
@@ -32,6 +84,74 @@ class Node():
         nodeid: core.ID = core.random_key_in_bucket(self.nodeid, bucket)
         await self.server.node_lookup(nodeid)
 
+    async def refresh_stale_buckets(self):
+        '''
+        Refreshes the buckets we haven't heard from in refresh_interval seconds. At most
+        refresh_budget lookups are started, refresh_concurrency at a time, anything left
+        over is picked up by the next call.
+        '''
+        max_age = datetime.timedelta(seconds=self.constants.refresh_interval)
+        stale = self.server.table.stale_buckets(max_age)
+        if not stale:
+            return
+
+        # stale is ordered by age, the buckets which have been quiet longest get refreshed.
+        # Each needs its own lookup, a lookup only hears from the nodes around its target
+        stale = stale[:self.constants.refresh_budget]
+
+        semaphore = asyncio.Semaphore(self.constants.refresh_concurrency)
+        async def refresh(bucket):
+            async with semaphore:
+                try:
+                    await asyncio.wait_for(
+                        self._refresh(bucket), self.constants.refresh_timeout
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning(f'timed out while refreshing bucket {bucket}')
+
+        await asyncio.gather(*(refresh(bucket) for bucket in stale))
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.constants.refresh_check_interval)
+            try:
+                await protocol.as_maintenance(self.refresh_stale_buckets())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('failed to refresh stale buckets')
+
+    async def sync_with_neighbour(self):
+        '''
+        Sends the next of our k closest neighbours a digest of the keys we should both be
+        holding, and swaps whichever values one of us is missing. See antientropy.py
+        '''
+        neighbours = self.server.table.closest_to_me(self.constants.k)
+        if not neighbours:
+            return
+        neighbour = neighbours[self.sync_turns % len(neighbours)]
+        self.sync_turns += 1
+        try:
+            pushed, pulled = await self.server.sync_with(neighbour)
+        except asyncio.TimeoutError:
+            logger.debug(f'{neighbour} did not respond to our SyncDigest')
+            return
+        except protocol.UnexpectedResponse as ex:
+            logger.warning(f'could not sync with {neighbour}: {ex}')
+            return
+        if pushed or pulled:
+            logger.info(f'synced with {neighbour}: pushed {pushed} and pulled {pulled} values')
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.constants.sync_interval)
+            try:
+                await protocol.as_maintenance(self.sync_with_neighbour())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('failed to sync with a neighbour')
+
     async def bootstrap(self, address: str, port:int):
         '''
         Given a node we should connect to, populate our routing table
@@ -39,7 +159,7 @@ class Node():
 
         # 1. Add the remote node to our buckeet
         try:
-            await self.server.ping(address, port, timeout=10)
+            await self.server.ping(address, port)
         except asyncio.TimeoutError:
             logger.error('cannot bootstrap, the remote node did not respond')
             return
@@ -52,23 +172,45 @@ class Node():
         # todo: 160*k requests is probably too many to send at once but this could
         #       definitely be parallelized at least a little
         closest = self.server.table.first_occupied_bucket()
-        for index in range(closest, 160):
+        for index in range(closest, idspace.BUCKET_COUNT):
             await self._refresh(index)
 
-    async def store_value(self, key: core.ID, value: bytes):
-        'Find the k closest nodes and send a STORE RPC to all of them'
+    async def store_value(self, key: core.ID, value: bytes,
+                          version: core.Version = None) -> core.Version:
+        '''
+        Find the k closest nodes and send a STORE RPC to all of them. Nodes only replace the
+        value they hold with a newer version of it, by default this write is versioned with
+        the current time. Returns the newest version any of the nodes holds.
+        '''
+        if version is None:
+            version = core.Version.now(self.nodeid)
         closest_nodes = await self.server.node_lookup(key)
 
-        # todo: timeouts
         coros = [
-            self.server.store(node, key, value)
+            self.server.store(node, key, value, version)
             for node in closest_nodes
         ]
-        await asyncio.gather(*coros)
-
-    async def find_value(self, key: core.ID):
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        newest = version
+        for node, result in zip(closest_nodes, results):
+            if isinstance(result, asyncio.TimeoutError):
+                logger.warning(f'{node} did not respond to our STORE')
+            elif isinstance(result, protocol.UnexpectedResponse):
+                logger.warning(f'{node} did not store {key}: {result}')
+            elif isinstance(result, Exception):
+                raise result
+            elif result.refused:
+                logger.warning(f'{node} refused to store {key}: {result.refused}')
+            elif not result.stored:
+                logger.info(f'{node} holds a newer version of {key}: {result.version}')
+                newest = max(newest, result.version)
+        return newest
+
+    async def find_value(self, key: core.ID, trace: 'tracing.LookupTrace' = None,
+                         with_version: bool = False):
         '''
         Perform a node lookup but send FIND_VALUE messages, and stop once we've found the
-        value.
+        value. Pass a trace to record what the lookup did, and with_version to also be
+        told the version of the value which was found.
         '''
-        return await self.server.value_lookup(key)
+        return await self.server.value_lookup(key, trace, with_version)
@@ -0,0 +1,356 @@
+'''
+Drives a network of real nodes, talking UDP over loopback, at a fixed request rate.
+
+    $ python loadtest.py --nodes 20 --processes 4 --keys 1000 --qps 200 --duration 60
+
+Starts --nodes kademlia.Nodes spread over --processes worker processes, stores --keys
+values, then sends a mix of store_value and find_value requests from a client node in this
+process at --qps, whether or not earlier requests have finished. Reports throughput,
+latency percentiles, how many RPCs went unanswered, and the CPU and memory each worker
+used over time.
+'''
+import argparse
+import asyncio
+import collections
+import dataclasses
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import time
+import typing
+
+import core
+import kademlia
+
+
+def percentile(samples: typing.Sequence[float], fraction: float) -> float:
+    'The nearest-rank percentile, samples must be sorted'
+    if not samples:
+        return float('nan')
+    rank = max(0, min(len(samples) - 1, int(round(fraction * len(samples))) - 1))
+    return samples[rank]
+
+
+def rss_bytes() -> int:
+    'The resident set size of this process'
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # not linux, fall back to the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclasses.dataclass
+class WorkerSample:
+    worker: int
+    nodes: int
+    elapsed: float  # seconds since the worker started
+    cpu: float  # cpu seconds used so far
+    rss: int
+    stored_keys: int
+    rpcs_sent: int
+    rpc_timeouts: int
+
+
+# Workers
+
+async def _worker(index: int, ports: typing.List[int], seed_port: int, constants: dict,
+                  samples: multiprocessing.Queue, stop: multiprocessing.Event,
+                  interval: float):
+    nodes = [kademlia.Node('127.0.0.1', port, core.Constants(**constants)) for port in ports]
+    for node in nodes:
+        await node.listen()
+    for node in nodes:
+        if node.port != seed_port:
+            await node.bootstrap('127.0.0.1', seed_port)
+
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+
+    def sample() -> WorkerSample:
+        return WorkerSample(
+            worker=index,
+            nodes=len(nodes),
+            elapsed=time.monotonic() - started,
+            cpu=time.process_time(),
+            rss=rss_bytes(),
+            stored_keys=sum(len(node.server.storage) for node in nodes),
+            rpcs_sent=sum(node.server.rpc_stats['sent'] for node in nodes),
+            rpc_timeouts=sum(node.server.rpc_stats['timeouts'] for node in nodes),
+        )
+
+    samples.put(('ready', index))
+    while not await loop.run_in_executor(None, stop.wait, interval):
+        samples.put(('sample', sample()))
+    samples.put(('sample', sample()))
+
+    for node in nodes:
+        node.stop()
+
+
+def run_worker(*args):
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_worker(*args))
+
+
+# The client
+
+class Results:
+    def __init__(self):
+        self.latencies: typing.Dict[str, typing.List[float]] = collections.defaultdict(list)
+        self.failures: typing.Counter[str] = collections.Counter()
+        # the exceptions which failed requests, by their type
+        self.errors: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.late = 0  # requests we couldn't send on time because the client was busy
+
+    def record(self, op: str, latency: float, ok: bool, error: str = None):
+        if ok:
+            self.latencies[op].append(latency)
+        else:
+            self.failures[op] += 1
+        if error is not None:
+            self.errors[op][error] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        ops = {}
+        for op in sorted(set(self.latencies) | set(self.failures)):
+            samples = sorted(self.latencies[op])
+            ops[op] = {
+                'ok': len(samples),
+                'failed': self.failures[op],
+                'errors': dict(self.errors[op]),
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p90_ms': percentile(samples, 0.90) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': (samples[-1] if samples else float('nan')) * 1000,
+            }
+        completed = sum(len(samples) for samples in self.latencies.values())
+        return {
+            'elapsed': elapsed,
+            'throughput': completed / elapsed if elapsed else 0,
+            'late_requests': self.late,
+            'ops': ops,
+        }
+
+
+async def _drive(args, seed_port: int, client_port: int) -> typing.Tuple[Results, dict]:
+    constants = core.Constants(**_constants(args))
+    client = kademlia.Node('127.0.0.1', client_port, constants)
+    await client.listen()
+    await client.bootstrap('127.0.0.1', seed_port)
+
+    value = lambda: os.urandom(args.value_size)
+    keys = [core.ID() for _ in range(args.keys)]
+    results = Results()
+
+    # preload, a few at a time so we don't measure our own queueing
+    semaphore = asyncio.Semaphore(32)
+    async def preload(key):
+        async with semaphore:
+            await client.store_value(key, value())
+    await asyncio.gather(*(preload(key) for key in keys))
+    preload_stats = dict(client.server.rpc_stats)
+
+    async def request(op: str, key: core.ID):
+        started = time.perf_counter()
+        error = None
+        try:
+            if op == 'find_value':
+                found = await asyncio.wait_for(client.find_value(key), args.timeout)
+                ok = found is not None
+            else:
+                await asyncio.wait_for(client.store_value(key, value()), args.timeout)
+                ok = True
+        except asyncio.TimeoutError:
+            ok = False
+        except Exception as ex:
+            # a bug or a bad response shouldn't stop the rest of the run, but it belongs in
+            # the report
+            ok, error = False, type(ex).__name__
+        results.record(op, time.perf_counter() - started, ok, error)
+
+    # an open loop: requests go out on schedule, however long earlier ones are taking
+    loop = asyncio.get_running_loop()
+    interval = 1 / args.qps
+    started = loop.time()
+    inflight = set()
+    sent = 0
+    while True:
+        due = started + sent * interval
+        now = loop.time()
+        if due - started >= args.duration:
+            break
+        if due > now:
+            await asyncio.sleep(due - now)
+        elif now - due > interval:
+            results.late += 1
+
+        op = 'find_value' if random.random() < args.read_ratio else 'store_value'
+        task = loop.create_task(request(op, random.choice(keys)))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+        sent += 1
+
+    if inflight:
+        await asyncio.wait(inflight)
+    elapsed = loop.time() - started
+
+    rpc_stats = {
+        name: count - preload_stats.get(name, 0)
+        for name, count in client.server.rpc_stats.items()
+    }
+    concurrency = client.server.concurrency.metrics()
+    client.stop()
+    return results, dict(
+        results.summary(elapsed), client_rpcs=rpc_stats, client_concurrency=concurrency
+    )
+
+
+def _constants(args) -> dict:
+    return {'k': args.k, 'alpha': args.alpha, 'rpc_timeout': args.rpc_timeout}
+
+
+def _worker_report(samples: typing.List[WorkerSample]) -> dict:
+    by_worker = collections.defaultdict(list)
+    for sample in samples:
+        by_worker[sample.worker].append(sample)
+
+    report = {}
+    for worker, series in sorted(by_worker.items()):
+        first, last = series[0], series[-1]
+        wall = last.elapsed - first.elapsed
+        report[worker] = {
+            'nodes': last.nodes,
+            'cpu_per_node': (last.cpu - first.cpu) / wall / last.nodes if wall else None,
+            'rss_start': first.rss,
+            'rss_end': last.rss,
+            'rss_growth_per_minute': (last.rss - first.rss) / wall * 60 if wall else None,
+            'stored_keys': last.stored_keys,
+            'rpc_loss': last.rpc_timeouts / last.rpcs_sent if last.rpcs_sent else 0,
+            'rss_over_time': [(round(s.elapsed, 1), s.rss) for s in series],
+        }
+    return report
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='how many worker processes to spread the nodes over, '
+                             'defaults to one per node')
+    parser.add_argument('--keys', type=int, default=100, help='values to preload')
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--qps', type=float, default=50)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--read-ratio', type=float, default=0.9,
+                        help='the fraction of requests which are find_value')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='seconds before a request counts as failed')
+    parser.add_argument('--base-port', type=int, default=7000)
+    parser.add_argument('--sample-interval', type=float, default=1)
+    parser.add_argument('--k', type=int, default=core.Constants.k)
+    parser.add_argument('--alpha', type=int, default=core.Constants.alpha)
+    parser.add_argument('--rpc-timeout', type=float, default=core.Constants.rpc_timeout)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args(argv)
+
+    processes = min(args.processes or args.nodes, args.nodes)
+    ports = [args.base_port + i for i in range(args.nodes)]
+    seed_port = ports[0]
+    client_port = args.base_port + args.nodes
+
+    samples_queue = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    workers = []
+    for index in range(processes):
+        worker_ports = ports[index::processes]
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(index, worker_ports, seed_port, _constants(args), samples_queue, stop,
+                  args.sample_interval),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+
+        # everybody else bootstraps off the seed, so it has to be up first
+        if index == 0:
+            assert samples_queue.get(timeout=30) == ('ready', 0)
+
+    ready = 1
+    samples: typing.List[WorkerSample] = []
+    while ready < processes:
+        kind, payload = samples_queue.get(timeout=30)
+        if kind == 'ready':
+            ready += 1
+        else:
+            samples.append(payload)
+
+    try:
+        results, report = asyncio.run(_drive(args, seed_port, client_port))
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=10)
+
+    while not samples_queue.empty():
+        kind, payload = samples_queue.get()
+        if kind == 'sample':
+            samples.append(payload)
+
+    report['workers'] = _worker_report(samples)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['elapsed']:.1f}s, {report['throughput']:.1f} requests/s completed, "
+        f"{report['late_requests']} sent late",
+    ]
+    rpcs = report['client_rpcs']
+    if rpcs.get('sent'):
+        lines.append(
+            f"client rpcs: {rpcs['sent']} sent, {rpcs.get('timeouts', 0)} unanswered "
+            f"({rpcs.get('timeouts', 0) / rpcs['sent']:.2%} loss)"
+        )
+    concurrency = report.get('client_concurrency')
+    if concurrency:
+        lines.append(
+            f"client lookups: window {concurrency['window']:.1f}, "
+            f"alpha {concurrency['alpha']}, loss {concurrency['loss']:.2%}"
+        )
+    for op, stats in report['ops'].items():
+        lines.append(
+            f"{op:>12}: {stats['ok']} ok, {stats['failed']} failed, "
+            f"p50 {stats['p50_ms']:.1f}ms p90 {stats['p90_ms']:.1f}ms "
+            f"p99 {stats['p99_ms']:.1f}ms max {stats['max_ms']:.1f}ms"
+        )
+        if stats['errors']:
+            errors = ', '.join(f'{count} {name}' for name, count in stats['errors'].items())
+            lines.append(f"{'':>12}  errors: {errors}")
+    for worker, stats in report['workers'].items():
+        cpu = stats['cpu_per_node']
+        growth = stats['rss_growth_per_minute']
+        lines.append(
+            f"worker {worker}: {stats['nodes']} nodes, "
+            f"{'?' if cpu is None else f'{cpu:.1%}'} cpu per node, "
+            f"rss {stats['rss_start'] / 2**20:.1f}MB -> {stats['rss_end'] / 2**20:.1f}MB "
+            f"({'?' if growth is None else f'{growth / 2**20:+.2f}'}MB/min), "
+            f"{stats['stored_keys']} keys, {stats['rpc_loss']:.2%} rpc loss"
+        )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+'''
+Sanity checks for the contacts our peers send us during a lookup, and the shortlist of
+candidates which the lookup picks its next queries from.
+
+A lookup asks peers for the nodes closest to its target, and then queries some of them.
+Every contact it accepts might cost an RPC, so before a contact joins the candidates it
+has to be new, by both id and address, and its address has to be one we could plausibly
+reach. A peer who lies about which nodes are close to the target can't be caught, but
+each peer can only contribute a limited number of contacts to each lookup.
+'''
+import bisect
+import collections
+import heapq
+import ipaddress
+import typing
+
+import core
+import messages
+
+
+def _ip(addr) -> typing.Optional[core.Address]:
+    'The address as an ip, None if it is a hostname'
+    try:
+        return ipaddress.ip_address(addr)
+    except ValueError:
+        return None
+
+
+def _local(ip: core.Address) -> bool:
+    return ip.is_loopback or ip.is_private or ip.is_link_local
+
+
+def implausible(contact: core.Node, responder: core.Node) -> typing.Optional[str]:
+    '''
+    Returns why we shouldn't believe the responder when it says contact is at that
+    address, or None if the address seems fine
+    '''
+    if not 0 < contact.port < 2**16:
+        return 'bad port'
+    ip = _ip(contact.addr)
+    if ip is None:
+        return None  # a hostname, which we'll have to trust
+    if ip.is_unspecified or ip.is_multicast:
+        return 'unroutable'
+
+    # a peer we reach over the internet can't know about anybody on our own network
+    responder_ip = _ip(responder.addr)
+    remote = responder_ip is not None and not _local(responder_ip)
+    if ip.is_loopback:
+        if responder_ip is not None and not responder_ip.is_loopback:
+            return 'loopback'  # only a peer on this machine knows who else is on it
+        return None
+    if ip.is_reserved:
+        return 'unroutable'
+    if _local(ip) and remote:
+        return 'private'
+    return None
+
+
+def responder(message: messages.Message) -> core.Node:
+    '''
+    Who sent message. Anyone can claim any address, so if the message arrived as a
+    datagram this is the address it came from.
+    '''
+    if message.observed is None:
+        return message.sender  # it came over a stream, from some ephemeral port
+    addr, port = message.observed
+    return message.sender._replace(addr=addr, port=port)
+
+
+class ContactFilter:
+    '''
+    The merge stage of a lookup: passes along the contacts from each response which are
+    new to this lookup and which we can believe.
+    '''
+
+    def __init__(self, mynodeid: core.ID, per_response: int):
+        self.per_response = per_response  # the most contacts a single response may add
+        self.ids: typing.Set[core.ID] = {mynodeid}
+        self.addrs: typing.Set[typing.Tuple[str, int]] = set()
+        self.rejected: typing.Counter[str] = collections.Counter()
+
+    def admit(self, responder: core.Node,
+              contacts: typing.Iterable[core.Node]) -> typing.Iterator[core.Node]:
+        added = 0
+        for contact in contacts:
+            if contact.nodeid in self.ids:
+                continue  # not news
+            if (contact.addr, contact.port) in self.addrs:
+                self.rejected['duplicate address'] += 1
+                continue
+            reason = implausible(contact, responder)
+            if reason is not None:
+                self.rejected[reason] += 1
+                continue
+            if added == self.per_response:
+                self.rejected['too many'] += 1
+                continue
+
+            added += 1
+            self.ids.add(contact.nodeid)
+            self.addrs.add((contact.addr, contact.port))
+            yield contact
+
+
+Entry = typing.Tuple[int, core.Node]  # a candidate, and its distance from the target
+
+
+class Shortlist:
+    '''
+    The candidates of a lookup, by their distance from its target, which is computed once,
+    when a candidate is added.
+
+    The k closest candidates which haven't failed to respond are kept in a sorted list,
+    the rest wait in a heap until a failure makes room for one of them. The unqueried
+    candidates are in a heap of their own, so finding the closest one doesn't mean
+    scanning the list. Both heaps drop entries which no longer belong there lazily, when
+    they reach the top.
+
+    Candidates must be unique, the ContactFilter takes care of that.
+    '''
+
+    def __init__(self, target: core.ID, k: int):
+        self.target = target.value
+        self.k = k
+        self.closest: typing.List[Entry] = list()  # sorted
+        self.reserve: typing.List[Entry] = list()  # a heap, all further than self.closest
+        self.unqueried: typing.List[Entry] = list()  # a heap
+        self.candidates: typing.Set[int] = set()  # the values of their nodeids
+        self.queried: typing.Set[int] = set()
+        self.unresponsive: typing.Set[int] = set()
+
+    def __len__(self):
+        return len(self.closest)
+
+    def nodes(self) -> typing.List[core.Node]:
+        'The k closest nodes we know of, leaving out the ones which failed to respond'
+        return [node for _, node in self.closest]
+
+    def closest_distance(self) -> typing.Optional[int]:
+        return self.closest[0][0] if self.closest else None
+
+    def add(self, node: core.Node):
+        nodeid = node.nodeid.value
+        if nodeid in self.unresponsive:
+            return
+        self.candidates.add(nodeid)
+        entry = (nodeid ^ self.target, node)
+        if nodeid not in self.queried:
+            heapq.heappush(self.unqueried, entry)
+
+        if len(self.closest) == self.k and entry[0] > self.closest[-1][0]:
+            heapq.heappush(self.reserve, entry)
+            return
+        bisect.insort(self.closest, entry)
+        if len(self.closest) > self.k:
+            heapq.heappush(self.reserve, self.closest.pop())
+
+    def mark_queried(self, node: core.Node):
+        self.queried.add(node.nodeid.value)
+
+    def was_queried(self, node: core.Node) -> bool:
+        return node.nodeid.value in self.queried
+
+    def failed(self, node: core.Node):
+        'Node did not respond, its place goes to the closest of the reserve'
+        nodeid = node.nodeid.value
+        self.unresponsive.add(nodeid)
+        distance = nodeid ^ self.target
+        index = bisect.bisect_left(self.closest, (distance,))
+        if index == len(self.closest) or self.closest[index][0] != distance:
+            return  # it was never a candidate
+        del self.closest[index]
+
+        while self.reserve and len(self.closest) < self.k:
+            entry = heapq.heappop(self.reserve)
+            if entry[1].nodeid.value not in self.unresponsive:
+                self.closest.append(entry)
+
+    def peek(self) -> typing.Optional[core.Node]:
+        'The closest of the k closest nodes which we have yet to query'
+        while self.unqueried and self.unqueried[0][1].nodeid.value in self.queried:
+            heapq.heappop(self.unqueried)  # it was queried as a hedge
+        if not self.unqueried:
+            return None
+        distance, node = self.unqueried[0]
+        if len(self.closest) == self.k and distance > self.closest[-1][0]:
+            return None
+        return node
+
+    def take(self, count: int) -> typing.List[core.Node]:
+        'Marks up to count of the closest unqueried nodes as queried, and returns them'
+        taken = []
+        while len(taken) < count:
+            node = self.peek()
+            if node is None:
+                break
+            heapq.heappop(self.unqueried)
+            self.mark_queried(node)
+            taken.append(node)
+        return taken
@@ -1,9 +1,43 @@
 import dataclasses
-import google.protobuf
+import functools
+import ipaddress
 import typing
 
 import core
-import protobuf.rpc_pb2 as proto
+
+if typing.TYPE_CHECKING:
+    import protobuf.rpc_pb2 as proto
+
+
+@functools.lru_cache(maxsize=None)
+def codec():
+    '''
+    The generated protobuf module. Building its descriptors is a good fraction of the time
+    it takes to start a node, so it isn't imported until the first message is encoded or
+    decoded.
+    '''
+    import protobuf.rpc_pb2
+    return protobuf.rpc_pb2
+
+
+class MalformedMessage(ValueError):
+    'The bytes we received could not be decoded into a Message'
+
+
+def parse(data: bytes) -> 'proto.Message':
+    'Parses the bytes into a protobuf, without looking at what kind of message it holds'
+    import google.protobuf.message
+
+    protobuf = codec().Message()
+    try:
+        protobuf.ParseFromString(data)
+    except google.protobuf.message.DecodeError as ex:
+        raise MalformedMessage(str(ex)) from ex
+    return protobuf
+
+
+def decode(data: bytes) -> 'Message':
+    return Message.parse_protobuf(parse(data))
 
 
 @dataclasses.dataclass
@@ -12,13 +46,23 @@ class Message:
     nonce: bytes = dataclasses.field(init=False, default_factory=core.newnonce)
     sender: core.Node = dataclasses.field(init=False)
 
+    # the (addr, port) a received datagram actually came from, None for anything else
+    observed: typing.Optional[typing.Tuple[str, int]] = dataclasses.field(
+        init=False, default=None, compare=False
+    )
+
+    # the sender's solution to the dynamic puzzle, see puzzles.py
+    puzzle: typing.Optional[bytes] = dataclasses.field(
+        init=False, default=None, compare=False
+    )
+
     def __init_subclass__(cls, **kwargs):
         if hasattr(cls, 'field'):
             Message.message_types[cls.field] = cls
         super().__init_subclass__(**kwargs)
 
     def finalize(self, node: core.Node):
-        message = proto.Message()
+        message = codec().Message()
         message.nonce = self.nonce
         message.sender.ip = node.addr
         message.sender.port = node.port
@@ -30,7 +74,16 @@ class Message:
         return message
 
     @staticmethod
-    def _parse_node(sender: proto.Node) -> core.Node:
+    def _parse_version(stub: 'proto.Version') -> core.Version:
+        return core.Version(stub.timestamp, stub.publisher)
+
+    @staticmethod
+    def _version_to_proto(version: core.Version, stub: 'proto.Version'):
+        stub.timestamp = version.timestamp
+        stub.publisher = version.publisher
+
+    @staticmethod
+    def _parse_node(sender: 'proto.Node') -> core.Node:
         return core.Node(
             addr=sender.ip,
             port=sender.port,
@@ -38,14 +91,22 @@ class Message:
         )
 
     @classmethod
-    def parse_protobuf(cls, protobuf: proto.Message):
+    def parse_protobuf(cls, protobuf: 'proto.Message'):
         for fieldName, fieldClass in cls.message_types.items():
             if protobuf.HasField(fieldName):
-                result = fieldClass._from_proto(protobuf)
-                result.nonce = protobuf.nonce
-                result.sender = cls._parse_node(protobuf.sender)
+                try:
+                    result = fieldClass._from_proto(protobuf)
+                    result.nonce = protobuf.nonce
+                    result.sender = cls._parse_node(protobuf.sender)
+                except MalformedMessage:
+                    raise
+                except Exception as ex:
+                    # such as an id of the wrong length
+                    raise MalformedMessage(f'bad {fieldName}: {ex!r}') from ex
+                if protobuf.sender.HasField('puzzle'):
+                    result.puzzle = protobuf.sender.puzzle
                 return result
-        raise ValueError(f'did not recognize {proto}')
+        raise MalformedMessage(f'did not recognize {protobuf}')
 
 # if there were any more of these it would barely be worth metaprogramming
 
@@ -57,36 +118,109 @@ class Response(Message):
 class FindNode(Message):
     field = 'findNode'
     key: core.ID
+    count: int = 0  # how many neighbours we want, 0 leaves it up to the responder
+    compact: bool = False  # whether we understand packed neighbours
 
     def _to_proto(self, stub):
         stub.findNode.key = self.key.to_bytes()
+        if self.count:
+            stub.findNode.count = self.count
+        if self.compact:
+            stub.findNode.compact = True
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
-        return cls(key=core.ID.from_bytes(proto.findNode.key))
+    def _from_proto(cls, proto: 'proto.Message'):
+        request = proto.findNode
+        return cls(core.ID.from_bytes(request.key), request.count, request.compact)
+
+
+# the length of an address, a port and a nodeid
+PACKED_OVERHEAD = 1 + 2 + 20
+
+
+def _pack_node(node: core.Node) -> typing.Optional[bytes]:
+    'The packed form of node, None if its address is a hostname rather than an ip'
+    try:
+        address = ipaddress.ip_address(node.addr).packed
+    except ValueError:
+        return None
+    return b''.join((
+        bytes([len(address)]), address,
+        node.port.to_bytes(2, byteorder='big'), node.nodeid.to_bytes(),
+    ))
+
+
+def _unpack_nodes(packed: bytes) -> typing.List[core.Node]:
+    nodes = []
+    offset = 0
+    while offset < len(packed):
+        length = packed[offset]
+        end = offset + length + PACKED_OVERHEAD
+        if length not in (4, 16) or end > len(packed):
+            raise MalformedMessage('the packed neighbours are truncated')
+        address = ipaddress.ip_address(packed[offset + 1:offset + 1 + length])
+        port = int.from_bytes(packed[end - 22:end - 20], byteorder='big')
+        nodes.append(core.Node(str(address), port, core.ID.from_bytes(packed[end - 20:end])))
+        offset = end
+    return nodes
 
 
 @dataclasses.dataclass
 class FindNodeResponse(Response):
+    '''
+    When compact is set, neighbours with ip addresses are packed into a single bytes field,
+    which is about half the size of sending each of them as a Node. The packed neighbours
+    are parsed after the others, so the order they were sent in is only kept when all or
+    none of them could be packed.
+    '''
     field = 'findNodeResponse'
     nodes: typing.List[core.Node]
+    compact: bool = False
 
     def _to_proto(self, stub):
+        stub.findNodeResponse.SetInParent()  # we might not have any neighbors to send
+        packed = []
         for node in self.nodes:
+            entry = _pack_node(node) if self.compact else None
+            if entry is not None:
+                packed.append(entry)
+                continue
             neighbor = stub.findNodeResponse.neighbors.add()
             neighbor.ip = node.addr
             neighbor.port = node.port
             neighbor.nodeid = node.nodeid.to_bytes()
+        if packed:
+            stub.findNodeResponse.packed = b''.join(packed)
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
-        return cls(proto.nonce, [
+    def _from_proto(cls, proto: 'proto.Message'):
+        response = proto.findNodeResponse
+        nodes = [
             core.Node(
                 addr=neighbor.ip,
                 port=neighbor.port,
                 nodeid=core.ID.from_bytes(neighbor.nodeid)
-            ) for neighbor in proto.findNodeResponse.neighbors
-        ])
+            ) for neighbor in response.neighbors
+        ]
+        if response.HasField('packed'):
+            nodes.extend(_unpack_nodes(response.packed))
+            return cls(proto.nonce, nodes, compact=True)
+        return cls(proto.nonce, nodes)
+
+    def _entry_size(self, node: core.Node) -> int:
+        'How many bytes node adds to the encoded message, give or take a byte'
+        packed = _pack_node(node) if self.compact else None
+        if packed is not None:
+            return len(packed)
+        neighbor = codec().Node(ip=node.addr, port=node.port, nodeid=node.nodeid.to_bytes())
+        return neighbor.ByteSize() + 2  # its tag and length
+
+    def fit(self, sender: core.Node, limit: int) -> 'FindNodeResponse':
+        'Drops our furthest neighbours until the message, sent by sender, fits into limit'
+        excess = self.finalize(sender).ByteSize() - limit
+        while excess > 0 and self.nodes:
+            excess -= self._entry_size(self.nodes.pop())
+        return self
 
 class Ping(Message):
     field = 'ping'
@@ -95,7 +229,7 @@ class Ping(Message):
         stub.ping.SetInParent()
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
+    def _from_proto(cls, proto: 'proto.Message'):
         return cls()
 
 class Pong(Response):
@@ -105,59 +239,135 @@ class Pong(Response):
         stub.pong.SetInParent()
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
+    def _from_proto(cls, proto: 'proto.Message'):
         return cls(proto.nonce)
 
+@dataclasses.dataclass
 class StoreResponse(Response):
     field = 'storeResponse'
+    stored: bool = True  # False if the node already held a newer version
+    version: core.Version = core.NO_VERSION  # the version the node now holds
+    refused: str = ''  # why the node didn't store it, if not for a newer version
 
     def _to_proto(self, stub):
         stub.storeResponse.SetInParent()
+        stub.storeResponse.stored = self.stored
+        self._version_to_proto(self.version, stub.storeResponse.version)
+        if self.refused:
+            stub.storeResponse.refused = self.refused
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
-        return cls(proto.nonce)
+    def _from_proto(cls, proto: 'proto.Message'):
+        response = proto.storeResponse
+        if not response.HasField('stored'):
+            return cls(proto.nonce)  # from a node which doesn't version values
+        return cls(
+            proto.nonce, response.stored, cls._parse_version(response.version),
+            response.refused,
+        )
 
 @dataclasses.dataclass
 class Store(Message):
     field = 'store'
     key: core.ID
     value: bytes
+    version: core.Version = core.NO_VERSION
 
     def _to_proto(self, stub):
         stub.store.key = self.key.to_bytes()
         stub.store.value = self.value
+        if self.version != core.NO_VERSION:
+            self._version_to_proto(self.version, stub.store.version)
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
-        return cls(core.ID.from_bytes(proto.store.key), proto.store.value)
+    def _from_proto(cls, proto: 'proto.Message'):
+        return cls(
+            core.ID.from_bytes(proto.store.key),
+            proto.store.value,
+            cls._parse_version(proto.store.version),
+        )
 
 @dataclasses.dataclass
 class FoundValue(Response):
     field = 'foundValue'
     key: core.ID
     value: bytes
+    version: core.Version = core.NO_VERSION
 
     def _to_proto(self, stub):
         stub.foundValue.key = self.key.to_bytes()
         stub.foundValue.value = self.value
+        if self.version != core.NO_VERSION:
+            self._version_to_proto(self.version, stub.foundValue.version)
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
+    def _from_proto(cls, proto: 'proto.Message'):
         return cls(
             proto.nonce,
             core.ID.from_bytes(proto.foundValue.key),
-            proto.foundValue.value
+            proto.foundValue.value,
+            cls._parse_version(proto.foundValue.version),
         )
 
 @dataclasses.dataclass
 class FindValue(Message):
     field = 'findValue'
     key: core.ID
+    count: int = 0  # see FindNode
+    compact: bool = False
 
     def _to_proto(self, stub):
         stub.findValue.key = self.key.to_bytes()
+        if self.count:
+            stub.findValue.count = self.count
+        if self.compact:
+            stub.findValue.compact = True
+
+    @classmethod
+    def _from_proto(cls, proto: 'proto.Message'):
+        request = proto.findValue
+        return cls(core.ID.from_bytes(request.key), request.count, request.compact)
+
+@dataclasses.dataclass
+class SyncDigest(Message):
+    field = 'syncDigest'
+    prefix: core.ID
+    depth: int
+    hashes: typing.List[int]
+
+    def _to_proto(self, stub):
+        stub.syncDigest.prefix = self.prefix.to_bytes()
+        stub.syncDigest.depth = self.depth
+        stub.syncDigest.hashes.extend(self.hashes)
+
+    @classmethod
+    def _from_proto(cls, proto: 'proto.Message'):
+        digest = proto.syncDigest
+        return cls(core.ID.from_bytes(digest.prefix), digest.depth, list(digest.hashes))
+
+@dataclasses.dataclass
+class SyncDigestResponse(Response):
+    field = 'syncDigestResponse'
+    differing: typing.List[int]
+    entries: typing.List[typing.Tuple[int, core.Version]]  # (key, version)
+    truncated: bool = False  # entries is a run of the keys in the only differing part
+
+    def _to_proto(self, stub):
+        response = stub.syncDigestResponse
+        response.SetInParent()  # we might agree on everything
+        response.differing.extend(self.differing)
+        if self.truncated:
+            response.truncated = True
+        for key, version in self.entries:
+            entry = response.keys.add()
+            entry.key = key.to_bytes(20, byteorder='big')
+            if version != core.NO_VERSION:
+                self._version_to_proto(version, entry.version)
 
     @classmethod
-    def _from_proto(cls, proto: proto.Message):
-        return cls(core.ID.from_bytes(proto.findValue.key))
+    def _from_proto(cls, proto: 'proto.Message'):
+        response = proto.syncDigestResponse
+        return cls(proto.nonce, list(response.differing), [
+            (core.ID.from_bytes(entry.key).value, cls._parse_version(entry.version))
+            for entry in response.keys
+        ], response.truncated)
@@ -1,13 +1,11 @@
+# -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: rpc.proto
-
-import sys
-_b=sys.version_info[0]<3 and (lambda x:x) or (lambda x:x.encode('latin1'))
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
-from google.protobuf import descriptor_pb2
 # @@protoc_insertion_point(imports)
 
 _sym_db = _symbol_database.Default()
@@ -15,516 +13,39 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='rpc.proto',
-  package='',
-  serialized_pb=_b('\n\trpc.proto\"C\n\x04Node\x12\n\n\x02ip\x18\x01 \x02(\t\x12\x0c\n\x04port\x18\x02 \x02(\r\x12\x0e\n\x06nodeid\x18\x03 \x02(\x0c\x12\x11\n\tpublickey\x18\x04 \x01(\x0c\"\x06\n\x04Ping\"\x06\n\x04Pong\"#\n\x05Store\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05value\x18\x02 \x02(\x0c\"\x0f\n\rStoreResponse\"\x17\n\x08\x46indNode\x12\x0b\n\x03key\x18\x01 \x02(\x0c\"\x18\n\tFindValue\x12\x0b\n\x03key\x18\x01 \x02(\x0c\"(\n\nFoundValue\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05value\x18\x02 \x02(\x0c\",\n\x10\x46indNodeResponse\x12\x18\n\tneighbors\x18\x01 \x03(\x0b\x32\x05.Node\"\xcd\x02\n\x07Message\x12\x15\n\x06sender\x18\x01 \x02(\x0b\x32\x05.Node\x12\x11\n\tsignature\x18\x02 \x01(\x0c\x12\r\n\x05nonce\x18\x03 \x02(\x0c\x12\x15\n\x04ping\x18\x04 \x01(\x0b\x32\x05.PingH\x00\x12\x15\n\x04pong\x18\x05 \x01(\x0b\x32\x05.PongH\x00\x12\x17\n\x05store\x18\x06 \x01(\x0b\x32\x06.StoreH\x00\x12\'\n\rstoreResponse\x18\x07 \x01(\x0b\x32\x0e.StoreResponseH\x00\x12\x1d\n\x08\x66indNode\x18\x08 \x01(\x0b\x32\t.FindNodeH\x00\x12-\n\x10\x66indNodeResponse\x18\t \x01(\x0b\x32\x11.FindNodeResponseH\x00\x12\x1f\n\tfindValue\x18\n \x01(\x0b\x32\n.FindValueH\x00\x12!\n\nfoundValue\x18\x0b \x01(\x0b\x32\x0b.FoundValueH\x00\x42\x07\n\x05inner')
-)
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-
-
-
-_NODE = _descriptor.Descriptor(
-  name='Node',
-  full_name='Node',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='ip', full_name='Node.ip', index=0,
-      number=1, type=9, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='port', full_name='Node.port', index=1,
-      number=2, type=13, cpp_type=3, label=2,
-      has_default_value=False, default_value=0,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='nodeid', full_name='Node.nodeid', index=2,
-      number=3, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='publickey', full_name='Node.publickey', index=3,
-      number=4, type=12, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=13,
-  serialized_end=80,
-)
-
-
-_PING = _descriptor.Descriptor(
-  name='Ping',
-  full_name='Ping',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=82,
-  serialized_end=88,
-)
-
-
-_PONG = _descriptor.Descriptor(
-  name='Pong',
-  full_name='Pong',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=90,
-  serialized_end=96,
-)
-
-
-_STORE = _descriptor.Descriptor(
-  name='Store',
-  full_name='Store',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='key', full_name='Store.key', index=0,
-      number=1, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='value', full_name='Store.value', index=1,
-      number=2, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=98,
-  serialized_end=133,
-)
-
-
-_STORERESPONSE = _descriptor.Descriptor(
-  name='StoreResponse',
-  full_name='StoreResponse',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=135,
-  serialized_end=150,
-)
-
-
-_FINDNODE = _descriptor.Descriptor(
-  name='FindNode',
-  full_name='FindNode',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='key', full_name='FindNode.key', index=0,
-      number=1, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=152,
-  serialized_end=175,
-)
-
-
-_FINDVALUE = _descriptor.Descriptor(
-  name='FindValue',
-  full_name='FindValue',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='key', full_name='FindValue.key', index=0,
-      number=1, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=177,
-  serialized_end=201,
-)
-
-
-_FOUNDVALUE = _descriptor.Descriptor(
-  name='FoundValue',
-  full_name='FoundValue',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='key', full_name='FoundValue.key', index=0,
-      number=1, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='value', full_name='FoundValue.value', index=1,
-      number=2, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=203,
-  serialized_end=243,
-)
-
-
-_FINDNODERESPONSE = _descriptor.Descriptor(
-  name='FindNodeResponse',
-  full_name='FindNodeResponse',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='neighbors', full_name='FindNodeResponse.neighbors', index=0,
-      number=1, type=11, cpp_type=10, label=3,
-      has_default_value=False, default_value=[],
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=245,
-  serialized_end=289,
-)
-
-
-_MESSAGE = _descriptor.Descriptor(
-  name='Message',
-  full_name='Message',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='sender', full_name='Message.sender', index=0,
-      number=1, type=11, cpp_type=10, label=2,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='signature', full_name='Message.signature', index=1,
-      number=2, type=12, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='nonce', full_name='Message.nonce', index=2,
-      number=3, type=12, cpp_type=9, label=2,
-      has_default_value=False, default_value=_b(""),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='ping', full_name='Message.ping', index=3,
-      number=4, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='pong', full_name='Message.pong', index=4,
-      number=5, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='store', full_name='Message.store', index=5,
-      number=6, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='storeResponse', full_name='Message.storeResponse', index=6,
-      number=7, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='findNode', full_name='Message.findNode', index=7,
-      number=8, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='findNodeResponse', full_name='Message.findNodeResponse', index=8,
-      number=9, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='findValue', full_name='Message.findValue', index=9,
-      number=10, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='foundValue', full_name='Message.foundValue', index=10,
-      number=11, type=11, cpp_type=10, label=1,
-      has_default_value=False, default_value=None,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  extension_ranges=[],
-  oneofs=[
-    _descriptor.OneofDescriptor(
-      name='inner', full_name='Message.inner',
-      index=0, containing_type=None, fields=[]),
-  ],
-  serialized_start=292,
-  serialized_end=625,
-)
-
-_FINDNODERESPONSE.fields_by_name['neighbors'].message_type = _NODE
-_MESSAGE.fields_by_name['sender'].message_type = _NODE
-_MESSAGE.fields_by_name['ping'].message_type = _PING
-_MESSAGE.fields_by_name['pong'].message_type = _PONG
-_MESSAGE.fields_by_name['store'].message_type = _STORE
-_MESSAGE.fields_by_name['storeResponse'].message_type = _STORERESPONSE
-_MESSAGE.fields_by_name['findNode'].message_type = _FINDNODE
-_MESSAGE.fields_by_name['findNodeResponse'].message_type = _FINDNODERESPONSE
-_MESSAGE.fields_by_name['findValue'].message_type = _FINDVALUE
-_MESSAGE.fields_by_name['foundValue'].message_type = _FOUNDVALUE
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['ping'])
-_MESSAGE.fields_by_name['ping'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['pong'])
-_MESSAGE.fields_by_name['pong'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['store'])
-_MESSAGE.fields_by_name['store'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['storeResponse'])
-_MESSAGE.fields_by_name['storeResponse'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['findNode'])
-_MESSAGE.fields_by_name['findNode'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['findNodeResponse'])
-_MESSAGE.fields_by_name['findNodeResponse'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['findValue'])
-_MESSAGE.fields_by_name['findValue'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-_MESSAGE.oneofs_by_name['inner'].fields.append(
-  _MESSAGE.fields_by_name['foundValue'])
-_MESSAGE.fields_by_name['foundValue'].containing_oneof = _MESSAGE.oneofs_by_name['inner']
-DESCRIPTOR.message_types_by_name['Node'] = _NODE
-DESCRIPTOR.message_types_by_name['Ping'] = _PING
-DESCRIPTOR.message_types_by_name['Pong'] = _PONG
-DESCRIPTOR.message_types_by_name['Store'] = _STORE
-DESCRIPTOR.message_types_by_name['StoreResponse'] = _STORERESPONSE
-DESCRIPTOR.message_types_by_name['FindNode'] = _FINDNODE
-DESCRIPTOR.message_types_by_name['FindValue'] = _FINDVALUE
-DESCRIPTOR.message_types_by_name['FoundValue'] = _FOUNDVALUE
-DESCRIPTOR.message_types_by_name['FindNodeResponse'] = _FINDNODERESPONSE
-DESCRIPTOR.message_types_by_name['Message'] = _MESSAGE
-
-Node = _reflection.GeneratedProtocolMessageType('Node', (_message.Message,), dict(
-  DESCRIPTOR = _NODE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:Node)
-  ))
-_sym_db.RegisterMessage(Node)
-
-Ping = _reflection.GeneratedProtocolMessageType('Ping', (_message.Message,), dict(
-  DESCRIPTOR = _PING,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:Ping)
-  ))
-_sym_db.RegisterMessage(Ping)
-
-Pong = _reflection.GeneratedProtocolMessageType('Pong', (_message.Message,), dict(
-  DESCRIPTOR = _PONG,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:Pong)
-  ))
-_sym_db.RegisterMessage(Pong)
-
-Store = _reflection.GeneratedProtocolMessageType('Store', (_message.Message,), dict(
-  DESCRIPTOR = _STORE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:Store)
-  ))
-_sym_db.RegisterMessage(Store)
-
-StoreResponse = _reflection.GeneratedProtocolMessageType('StoreResponse', (_message.Message,), dict(
-  DESCRIPTOR = _STORERESPONSE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:StoreResponse)
-  ))
-_sym_db.RegisterMessage(StoreResponse)
-
-FindNode = _reflection.GeneratedProtocolMessageType('FindNode', (_message.Message,), dict(
-  DESCRIPTOR = _FINDNODE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:FindNode)
-  ))
-_sym_db.RegisterMessage(FindNode)
-
-FindValue = _reflection.GeneratedProtocolMessageType('FindValue', (_message.Message,), dict(
-  DESCRIPTOR = _FINDVALUE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:FindValue)
-  ))
-_sym_db.RegisterMessage(FindValue)
-
-FoundValue = _reflection.GeneratedProtocolMessageType('FoundValue', (_message.Message,), dict(
-  DESCRIPTOR = _FOUNDVALUE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:FoundValue)
-  ))
-_sym_db.RegisterMessage(FoundValue)
-
-FindNodeResponse = _reflection.GeneratedProtocolMessageType('FindNodeResponse', (_message.Message,), dict(
-  DESCRIPTOR = _FINDNODERESPONSE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:FindNodeResponse)
-  ))
-_sym_db.RegisterMessage(FindNodeResponse)
-
-Message = _reflection.GeneratedProtocolMessageType('Message', (_message.Message,), dict(
-  DESCRIPTOR = _MESSAGE,
-  __module__ = 'rpc_pb2'
-  # @@protoc_insertion_point(class_scope:Message)
-  ))
-_sym_db.RegisterMessage(Message)
-
-
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\trpc.proto\"S\n\x04Node\x12\n\n\x02ip\x18\x01 \x02(\t\x12\x0c\n\x04port\x18\x02 \x02(\r\x12\x0e\n\x06nodeid\x18\x03 \x02(\x0c\x12\x11\n\tpublickey\x18\x04 \x01(\x0c\x12\x0e\n\x06puzzle\x18\x05 \x01(\x0c\"\x06\n\x04Ping\"\x06\n\x04Pong\"/\n\x07Version\x12\x11\n\ttimestamp\x18\x01 \x02(\x04\x12\x11\n\tpublisher\x18\x02 \x02(\x0c\">\n\x05Store\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05value\x18\x02 \x02(\x0c\x12\x19\n\x07version\x18\x03 \x01(\x0b\x32\x08.Version\"K\n\rStoreResponse\x12\x0e\n\x06stored\x18\x01 \x01(\x08\x12\x19\n\x07version\x18\x02 \x01(\x0b\x32\x08.Version\x12\x0f\n\x07refused\x18\x03 \x01(\t\"7\n\x08\x46indNode\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05\x63ount\x18\x02 \x01(\r\x12\x0f\n\x07\x63ompact\x18\x03 \x01(\x08\"8\n\tFindValue\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05\x63ount\x18\x02 \x01(\r\x12\x0f\n\x07\x63ompact\x18\x03 \x01(\x08\"C\n\nFoundValue\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\r\n\x05value\x18\x02 \x02(\x0c\x12\x19\n\x07version\x18\x03 \x01(\x0b\x32\x08.Version\"<\n\x10\x46indNodeResponse\x12\x18\n\tneighbors\x18\x01 \x03(\x0b\x32\x05.Node\x12\x0e\n\x06packed\x18\x02 \x01(\x0c\";\n\nSyncDigest\x12\x0e\n\x06prefix\x18\x01 \x02(\x0c\x12\r\n\x05\x64\x65pth\x18\x02 \x02(\r\x12\x0e\n\x06hashes\x18\x03 \x03(\x06\"4\n\nKeyVersion\x12\x0b\n\x03key\x18\x01 \x02(\x0c\x12\x19\n\x07version\x18\x02 \x01(\x0b\x32\x08.Version\"U\n\x12SyncDigestResponse\x12\x11\n\tdiffering\x18\x01 \x03(\r\x12\x19\n\x04keys\x18\x02 \x03(\x0b\x32\x0b.KeyVersion\x12\x11\n\ttruncated\x18\x03 \x01(\x08\"\xa3\x03\n\x07Message\x12\x15\n\x06sender\x18\x01 \x02(\x0b\x32\x05.Node\x12\x11\n\tsignature\x18\x02 \x01(\x0c\x12\r\n\x05nonce\x18\x03 \x02(\x0c\x12\x15\n\x04ping\x18\x04 \x01(\x0b\x32\x05.PingH\x00\x12\x15\n\x04pong\x18\x05 \x01(\x0b\x32\x05.PongH\x00\x12\x17\n\x05store\x18\x06 \x01(\x0b\x32\x06.StoreH\x00\x12\'\n\rstoreResponse\x18\x07 \x01(\x0b\x32\x0e.StoreResponseH\x00\x12\x1d\n\x08\x66indNode\x18\x08 \x01(\x0b\x32\t.FindNodeH\x00\x12-\n\x10\x66indNodeResponse\x18\t \x01(\x0b\x32\x11.FindNodeResponseH\x00\x12\x1f\n\tfindValue\x18\n \x01(\x0b\x32\n.FindValueH\x00\x12!\n\nfoundValue\x18\x0b \x01(\x0b\x32\x0b.FoundValueH\x00\x12!\n\nsyncDigest\x18\x0c \x01(\x0b\x32\x0b.SyncDigestH\x00\x12\x31\n\x12syncDigestResponse\x18\r \x01(\x0b\x32\x13.SyncDigestResponseH\x00\x42\x07\n\x05inner')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'rpc_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _NODE._serialized_start=13
+  _NODE._serialized_end=96
+  _PING._serialized_start=98
+  _PING._serialized_end=104
+  _PONG._serialized_start=106
+  _PONG._serialized_end=112
+  _VERSION._serialized_start=114
+  _VERSION._serialized_end=161
+  _STORE._serialized_start=163
+  _STORE._serialized_end=225
+  _STORERESPONSE._serialized_start=227
+  _STORERESPONSE._serialized_end=302
+  _FINDNODE._serialized_start=304
+  _FINDNODE._serialized_end=359
+  _FINDVALUE._serialized_start=361
+  _FINDVALUE._serialized_end=417
+  _FOUNDVALUE._serialized_start=419
+  _FOUNDVALUE._serialized_end=486
+  _FINDNODERESPONSE._serialized_start=488
+  _FINDNODERESPONSE._serialized_end=548
+  _SYNCDIGEST._serialized_start=550
+  _SYNCDIGEST._serialized_end=609
+  _KEYVERSION._serialized_start=611
+  _KEYVERSION._serialized_end=663
+  _SYNCDIGESTRESPONSE._serialized_start=665
+  _SYNCDIGESTRESPONSE._serialized_end=750
+  _MESSAGE._serialized_start=753
+  _MESSAGE._serialized_end=1172
 # @@protoc_insertion_point(module_scope)
@@ -1,75 +1,369 @@
 from __future__ import annotations
 
 import asyncio
-import binascii
 import collections
+import concurrent.futures
+import contextvars
+import enum
 import functools
-import hashlib
-import heapq
-import itertools
+import ipaddress
 import logging
-import queue
+import math
 import random
+import time
 import typing
 
-import google.protobuf
-
+import antientropy
+import concurrency
 import core
+import idspace
+import lookup
 import messages
-from protobuf.rpc_pb2 import Message, Ping, Node as NodeProto
+import puzzles
+import ratelimit
+import storage
+import transports
+
+if typing.TYPE_CHECKING:
+    import signing
+    import tracing
 
 
 logger = logging.getLogger('kademlia')
 
+# the most neighbours a FindNode may ask for
+MAX_NEIGHBOURS = 256
+
+# an Ed25519 public key and signature, and their tags and lengths
+SIGNATURE_OVERHEAD = (32 + 2) + (64 + 2)
+
+# a handoff lets the event loop run after checking this many keys
+HANDOFF_SCAN = 64
+
 
 class ValueFound(Exception):
-    def __init__(self, value: bytes):
+    def __init__(self, value: bytes, version: core.Version = core.NO_VERSION):
         self.value = value
+        self.version = version
+
+
+class UnexpectedResponse(Exception):
+    'A peer answered one of our requests with the wrong kind of message'
+
+
+class SingleFlight:
+    '''
+    Lets concurrent callers who want the same thing share the work. The first caller for a
+    key starts a task, everyone who asks for that key before it finishes waits on the same
+    task and receives the same result (or exception). Once every caller has given up the
+    task is cancelled.
+    '''
+
+    def __init__(self):
+        self.inflight: typing.Dict[typing.Hashable, asyncio.Task] = dict()
+        self.waiters: typing.Counter[asyncio.Task] = collections.Counter()
+
+    async def run(self, key: typing.Hashable, coro_factory):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(coro_factory())
+            self.inflight[key] = task
+
+            def forget(task):
+                if self.inflight.get(key) is task:
+                    del self.inflight[key]
+                if not task.cancelled():
+                    task.exception()  # the callers might all have left before it failed
+            task.add_done_callback(forget)
+
+        # one of the callers being cancelled shouldn't cancel the work for all the others
+        self.waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                task.cancel()  # nobody is listening, unless it already finished
+
+    def cancel(self):
+        for task in self.inflight.values():
+            task.cancel()
+
+
+class Priority(enum.IntEnum):
+    'How urgently an outgoing message should be sent, lower numbers go first'
+    RESPONSE = 0  # somebody is waiting on us
+    INTERACTIVE = 1  # requests made on behalf of our users
+    MAINTENANCE = 2  # refreshes, syncs, repairs and handoffs
+
+
+# the priority of the requests sent by the running task, see as_maintenance()
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    'priority', default=Priority.INTERACTIVE
+)
+
+
+def as_maintenance(coro) -> asyncio.Task:
+    '''
+    Runs the coroutine in a task of its own. Any requests it sends, including from the
+    tasks it starts, wait until our other traffic has been sent.
+    '''
+    # a task runs in a copy of the context it was created in, so this never has to be
+    # undone, which would fail if the coroutine were closed outside of its task
+    context = contextvars.copy_context()
+    context.run(_priority.set, Priority.MAINTENANCE)
+    return context.run(asyncio.get_running_loop().create_task, coro)
+
+
+class Outbox:
+    '''
+    Every outgoing message waits here until the end of the current iteration of the event
+    loop, then everything which was queued is sent in one batch, the most urgent messages
+    first. Each Priority has its own rate limit, a tenth of a second's worth of messages
+    may go out in a burst. A message is only sent once every more urgent message has been
+    sent, so maintenance traffic never delays responses or our users' lookups.
+
+    Messages which have waited so long that nobody cares anymore are dropped: requests
+    whose future is done, because we stopped waiting for the response, and anything queued
+    more than rpc_timeout ago. Each queue holds at most send_queue_limit messages, when
+    it's full the oldest one is dropped.
+    '''
+
+    def __init__(self, transport: transports.Transport, constants: core.Constants,
+                 clock=time.monotonic):
+        self.transport = transport
+        self.constants = constants
+        self.clock = clock
+
+        # (data, addr, when it goes stale, the future of the request's response)
+        self.queues: typing.List[typing.Deque[typing.Tuple[
+            bytes, transports.Addr, float, typing.Optional[asyncio.Future]
+        ]]] = [collections.deque() for _ in Priority]
+        self.buckets: typing.List[ratelimit.TokenBucket] = list()
+        self.retune()
+
+        self.flush_handle: typing.Optional[asyncio.Handle] = None
+        self.sent: typing.Counter[Priority] = collections.Counter()
+        self.dropped: typing.Counter[Priority] = collections.Counter()
+
+    def _rate(self, priority: Priority) -> float:
+        return getattr(self.constants, f'{priority.name.lower()}_send_rate')
+
+    def retune(self):
+        old = self.buckets
+        self.buckets = [
+            ratelimit.TokenBucket(self._rate(priority), max(1, self._rate(priority) / 10),
+                                  self.clock)
+            for priority in Priority
+        ]
+        for bucket, previous in zip(self.buckets, old):
+            bucket.tokens = min(bucket.burst, previous.tokens)
+
+    def sendto(self, data: bytes, addr: transports.Addr, priority: Priority,
+               future: asyncio.Future = None):
+        'Queues data, pass the future of a request to drop it once nobody waits for it'
+        queue = self.queues[priority]
+        if len(queue) >= self.constants.send_queue_limit:
+            queue.popleft()
+            self.dropped[priority] += 1
+        queue.append((data, addr, self.clock() + self.constants.rpc_timeout, future))
+        self._schedule()
+
+    def __len__(self) -> int:
+        'How many messages are waiting to be sent'
+        return sum(len(queue) for queue in self.queues)
+
+    def _schedule(self):
+        if self.flush_handle is not None:
+            return
+        waiting = [priority for priority in Priority if self.queues[priority]]
+        if not waiting:
+            return
+
+        loop = asyncio.get_running_loop()
+        bucket = self.buckets[waiting[0]]
+        delay = (1 - bucket.level * bucket.burst) / bucket.rate
+        if delay <= 0:
+            self.flush_handle = loop.call_soon(self.flush)
+        else:
+            self.flush_handle = loop.call_later(delay, self.flush)
+
+    def flush(self):
+        'Sends as much of what is queued as the batch size and our rate limits allow'
+        self.flush_handle = None
+        budget = self.constants.send_batch
+        now = self.clock()
+        for priority in Priority:
+            queue, bucket = self.queues[priority], self.buckets[priority]
+            while queue and budget:
+                data, addr, stale, future = queue[0]
+                if now > stale or (future is not None and future.done()):
+                    queue.popleft()
+                    self.dropped[priority] += 1
+                    continue
+                if not bucket.take():
+                    break
+                queue.popleft()
+                self.transport.sendto(data, addr)
+                self.sent[priority] += 1
+                budget -= 1
+            if queue:
+                break  # the less urgent messages wait until these are sent
+        self._schedule()
+
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for queue in self.queues:
+            queue.clear()
 
 
 class Protocol(asyncio.DatagramProtocol):
 
-    def __init__(self, table: core.RoutingTable, node: core.Node, rpc_hook):
+    def __init__(self, table: core.RoutingTable, node: core.Node, rpc_hook,
+                 limiter: ratelimit.RequestLimiter = None,
+                 verifier: signing.Verifier = None,
+                 executor: concurrent.futures.Executor = None,
+                 added_hook=None):
         self.outstanding_requests: typing.Dict[bytes, asyncio.Future] = dict()
         self.table = table
         self.node = node
 
         self.rpc_hook = rpc_hook
+        self.added_hook = added_hook  # called with each node which joins the table
+        self.limiter = limiter
+
+        # when we have a verifier the messages which arrive during an iteration of the
+        # event loop are queued up here, then verified together on the executor
+        self.verifier = verifier
+        self.executor = executor
+        self.unverified: typing.List[typing.Tuple[bytes, typing.Any, typing.Any]] = list()
+
+        # how many messages claimed an address other than the one they came from
+        self.address_conflicts = 0
 
     def connection_made(self, transport):
         self.transport = transport
 
+    @staticmethod
+    def _addresses_conflict(claimed: transports.Addr, observed: transports.Addr) -> bool:
+        if claimed[1] != observed[1]:
+            return True
+        try:
+            return ipaddress.ip_address(claimed[0]) != ipaddress.ip_address(observed[0])
+        except ValueError:
+            return False  # they gave us a hostname, it might well resolve to observed
+
+    def _remote_for(self, message: messages.Message):
+        '''
+        Returns the node which sent this message, and the address it claimed if that was
+        not the one it sent from.
+
+        The node claims to have the address {message.sender}, but {message.observed} has
+        been proven to work and potentially even punched through a NAT, when they disagree
+        we believe the observed address.
+        '''
+        claimed = message.sender
+        if message.observed is None:
+            # this came over a stream, from some ephemeral port. If we already know a
+            # better address for the node keep using it
+            try:
+                entry = self.table.entry_for(claimed.nodeid)
+            except KeyError:
+                return claimed, None
+            if entry.claimed == (claimed.addr, claimed.port):
+                return entry.node, entry.claimed
+            return claimed, None
+
+        claimed_addr = (claimed.addr, claimed.port)
+        if not self._addresses_conflict(claimed_addr, message.observed):
+            return claimed, None
+
+        self.address_conflicts += 1
+        logger.debug(f'{claimed.nodeid} claims to be at {claimed_addr} but messaged us '
+                     f'from {message.observed}')
+        observed = claimed._replace(addr=message.observed[0], port=message.observed[1])
+        return observed, claimed_addr
+
     def datagram_received(self, data, addr):
-        # We're throwing away addr but it seems useful.
+        self.message_received(data, addr, observed=addr[:2])
+
+    def frame_received(self, data, addr):
+        'Messages which arrive over a stream, we do not learn anything from their addr'
+        self.message_received(data, addr, observed=None)
+
+    def message_received(self, data, addr, observed: typing.Optional[transports.Addr]):
+        if self.verifier is not None:
+            self.unverified.append((data, addr, observed))
+            if len(self.unverified) == 1:
+                asyncio.get_running_loop().call_soon(self._verify_queued)
+            return
 
-        # The node claims to have the address {message.sender}, but {addr} has been proven
-        # to work and potentially even punched through a NAT, it seems the better choice!
         try:
-            protobuf = Message()
-            protobuf.ParseFromString(data)
-        except google.protobuf.message.DecodeError:
+            message = messages.decode(data)
+        except messages.MalformedMessage:
             logger.warning(f"received malformed data from {addr}")
             return
+        self.message_decoded(message, addr, observed)
+
+    def _verify_queued(self):
+        batch, self.unverified = self.unverified, list()
+        loop = asyncio.get_running_loop()
+        try:
+            verified = loop.run_in_executor(
+                self.executor, self.verifier.verify_batch, [data for data, _, _ in batch]
+            )
+        except RuntimeError:
+            return  # the server was stopped and shut the executor down
+        verified.add_done_callback(functools.partial(self._verified, batch))
+
+    def _verified(self, batch, verified: asyncio.Future):
+        if verified.cancelled():
+            return
+        if verified.exception() is not None:
+            logger.warning(f'failed to verify {len(batch)} messages: {verified.exception()!r}')
+            return
+        for (_, addr, observed), result in zip(batch, verified.result()):
+            if isinstance(result, messages.MalformedMessage):
+                logger.warning(f'rejected a message from {addr}: {result}')
+                continue
+            self.message_decoded(result, addr, observed)
+
+    def message_decoded(self, message: messages.Message, addr,
+                        observed: typing.Optional[transports.Addr]):
+        message.observed = observed
 
-        message = messages.Message.parse_protobuf(protobuf)
+        # responses are to requests we made, we always want to hear those
+        is_response = isinstance(message, messages.Response)
+        if not is_response and self.limiter and not self.limiter.admit(message, addr):
+            logger.debug(f'dropped a {type(message).__name__} from {addr}')
+            return
 
-        remote = message.sender
-        if remote.nodeid == self.node.nodeid:
+        if message.sender.nodeid == self.node.nodeid:
             assert False, 'received a message from ourselves'
+        remote, claimed = self._remote_for(message)
         try:
-            self.table.node_seen(remote)
+            added = self.table.node_seen(remote, claimed, message.puzzle)
+            if added and self.added_hook is not None:
+                self.added_hook(remote)
         except core.NoRoomInBucket:
             # TODO: do something here, we should try to evict a node!
             pass
+        except core.NotAdmitted:
+            logger.debug(f'ignored {remote.nodeid}, it has not solved our puzzles')
+            return
 
-        if isinstance(message, messages.Response):
+        if is_response:
             nonce = message.nonce
             if nonce not in self.outstanding_requests:
                 logger.warning(f"received malformed data from {addr}")
                 return
 
             future = self.outstanding_requests.pop(nonce)
-            future.set_result(message)
+            if not future.done():  # it might have been cancelled
+                future.set_result(message)
             return
 
         self.rpc_hook(message)
@@ -80,30 +374,99 @@ class Protocol(asyncio.DatagramProtocol):
         assert(nonce not in self.outstanding_requests)
         self.outstanding_requests[nonce] = future
 
+    def forget_nonce(self, nonce):
+        'We are no longer waiting for a response to this request'
+        self.outstanding_requests.pop(nonce, None)
+
 
 class Server:
-    def __init__(self, mynodeid: core.ID, constants: core.Constants = None):
+    def __init__(self, mynodeid: core.ID, constants: core.Constants = None,
+                 identity: signing.Identity = None, puzzle: bytes = None):
         self.transport = None
+        self.outbox: typing.Optional[Outbox] = None  # everything we send goes through it
         self.outstanding_requests: typing.Dict[bytes, asyncio.Future] = dict()
 
         self.constants = constants if constants is not None else core.Constants()
-        self.table = core.RoutingTable(self.constants.k, mynodeid)
-        self.storage: typing.Dict[int, bytes] = dict()
+
+        # our solution to the dynamic puzzle, which goes out with every message
+        self.puzzle = puzzle
+        admission = None
+        if puzzles.required(self.constants):
+            if not puzzles.admissible(self.constants, mynodeid, puzzle):
+                raise ValueError('our nodeid does not solve the puzzles, see puzzles.solve()')
+            admission = functools.partial(puzzles.admissible, self.constants)
+
+        Table = core.TreeRoutingTable if self.constants.bucket_splitting else core.RoutingTable
+        self.table = Table(self.constants.k, mynodeid, admission)
+        self.storage = storage.Storage(
+            mynodeid,
+            budget=self.constants.storage_budget,
+            shards=self.constants.storage_shards,
+            policy=self.constants.storage_eviction,
+        )
+        self.limiter = ratelimit.RequestLimiter(self.constants)
+        self.concurrency = concurrency.AdaptiveConcurrency(self.constants)
+
+        # how many of our requests were sent, and how many were never answered
+        self.rpc_stats: typing.Counter[str] = collections.Counter()
+
+        # identical lookups and RPCs which are in progress at the same time are merged
+        self.lookups = SingleFlight()
+        self.rpcs = SingleFlight()
+
+        # work we started which nobody waits for, such as read repairs
+        self.background: typing.Set[asyncio.Task] = set()
+        self.handoffs: typing.Set[core.ID] = set()  # the nodes we're handing keys to
 
         self.node = None
         self.nodeid = mynodeid
 
+        # we sign what we send with identity, and check the signatures of what we receive
+        self.identity = identity
+        self.verifier = None
+        self.verify_executor = None
+        if self.constants.signed_messages:
+            if identity is None or identity.nodeid != mynodeid:
+                raise ValueError('signed messages need an identity which matches our nodeid')
+            import signing  # cryptography is slow to import, and optional
+            self.verifier = signing.Verifier(self.constants.verify_cache_size)
+
     async def listen(self, addr, port):
         loop = asyncio.get_running_loop()
         local_addr = (addr, port)
 
         self.node = core.Node(addr=addr, port=port, nodeid=self.nodeid)
 
+        if self.verifier is not None:
+            self.verify_executor = concurrent.futures.ThreadPoolExecutor(
+                self.constants.verify_threads, thread_name_prefix='kademlia-verify'
+            )
+
         endpoint = loop.create_datagram_endpoint(
-            lambda: Protocol(self.table, self.node, self.received_rpc),
+            lambda: Protocol(self.table, self.node, self.received_rpc, self.limiter,
+                             self.verifier, self.verify_executor, self.node_added),
             local_addr = local_addr
         )
-        self.transport, self.protocol = await endpoint
+        datagram_transport, self.protocol = await endpoint
+        datagrams = transports.DatagramTransport(datagram_transport)
+
+        if not self.constants.stream_transport:
+            self.transport = datagrams
+            self.outbox = Outbox(self.transport, self.constants)
+            return
+
+        # messages which arrive over a stream are handled just like datagrams, though we
+        # can't reply to the address they came from
+        stream = transports.StreamTransport(
+            self.protocol.frame_received, pool_size=self.constants.stream_pool_size
+        )
+        try:
+            await stream.listen(addr, port)
+        except OSError:
+            datagrams.close()
+            raise
+        self.transport = transports.FallbackTransport(datagrams, stream, self.constants)
+        self.outbox = Outbox(self.transport, self.constants)
 
     def must_be_running(func):
         @functools.wraps(func)
@@ -114,9 +477,28 @@ class Server:
         return run
 
     def stop(self):
+        for task in self.background:
+            task.cancel()
+        self.lookups.cancel()
+        self.rpcs.cancel()
+        if self.outbox:
+            self.outbox.close()
         if self.transport:
             self.transport.close()
             self.transport = None
+        if self.verify_executor:
+            self.verify_executor.shutdown(wait=False)
+            self.verify_executor = None
+
+    def tune(self, **changes):
+        'Changes some of our constants while we run, see Constants.TUNABLE'
+        self.constants.tune(**changes)
+
+        self.table.k = self.constants.k
+        self.limiter.retune()
+        if self.outbox:
+            self.outbox.retune()
+        self.storage.retune(self.constants.storage_budget, self.constants.storage_eviction)
 
     @must_be_running
     def send(self, message: messages.Message, remote: core.Node):
@@ -138,14 +520,45 @@ class Server:
         self.protocol.register_nonce(nonce, future)
 
         # TODO: where do we check that the message is not too large?
-        message = message.finalize(self.node)
-        serialized = message.SerializeToString()
-        self.transport.sendto(serialized, (addr, port))
+        self.outbox.sendto(self._serialize(message), (addr, port), _priority.get(), future)
 
-        # TODO: also timeout if we haven't received a response in x seconds
         # TODO: when a timeout happens, alert the RoutingTable so we mark this node flaky
         return future
 
+    async def _wait_for_response(self, message: messages.Message, future: asyncio.Future,
+                                 dest: transports.Addr, timeout: float = None,
+                                 expected: typing.Union[type, typing.Tuple[type, ...]] = None):
+        '''
+        Waits for the response to a message we sent to dest, for at most timeout seconds.
+        Raises UnexpectedResponse if it isn't an instance of expected (a type or a tuple of
+        types).
+        '''
+        if timeout is None:
+            timeout = self.constants.rpc_timeout
+        self.rpc_stats['sent'] += 1
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        try:
+            result = await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.rpc_stats['timeouts'] += 1
+            self.concurrency.timed_out()
+            if self.transport:
+                self.transport.timed_out(dest)
+            raise
+        finally:
+            self.protocol.forget_nonce(message.nonce)
+
+        self.concurrency.responded(loop.time() - sent)
+        if self.transport:
+            self.transport.responded(dest)
+        if expected is not None and not isinstance(result, expected):
+            self.rpc_stats['unexpected_responses'] += 1
+            raise UnexpectedResponse(
+                f'{dest} answered a {type(message).__name__} with a {type(result).__name__}'
+            )
+        return result
+
     def received_rpc(self, message):
         if isinstance(message, messages.FindNode):
             self.find_node_received(message)
@@ -155,16 +568,37 @@ class Server:
             self.store_received(message)
         elif isinstance(message, messages.FindValue):
             self.find_value_received(message)
+        elif isinstance(message, messages.SyncDigest):
+            self.sync_digest_received(message)
         else:
             assert False, 'an unexpected message type was received'
 
     # Incoming RPCs
 
+    def _serialize(self, message: messages.Message) -> bytes:
+        finalized = message.finalize(self.node)
+        if self.puzzle is not None:
+            finalized.sender.puzzle = self.puzzle
+        if self.identity is not None:
+            self.identity.sign(finalized)
+        return finalized.SerializeToString()
+
+    def _sender_overhead(self) -> int:
+        'How many bytes _serialize() adds to a finalized message'
+        overhead = 0
+        if self.puzzle is not None:
+            overhead += len(self.puzzle) + 2
+        if self.identity is not None:
+            overhead += SIGNATURE_OVERHEAD
+        return overhead
+
     def _respond(self, request, response: messages.Message):
-        finalized = response.finalize(self.node)
-        serialized = finalized.SerializeToString()
-        dest = (request.sender.addr, request.sender.port)
-        self.transport.sendto(serialized, dest)
+        serialized = self._serialize(response)
+
+        # the address the request came from has been proven to work, unlike the one the
+        # sender claims
+        dest = request.observed or (request.sender.addr, request.sender.port)
+        self.outbox.sendto(serialized, dest, Priority.RESPONSE)
 
     def ping_received(self, message):
         logger.debug(f'received a Ping from {message.sender.nodeid}, {message.sender.port}')
@@ -174,18 +608,34 @@ class Server:
 
     def store_received(self, message):
         logger.debug(f'received a Store from {message.sender.nodeid}, {message.sender.port}')
-        self.storage[message.key.value] = message.value
+        key = message.key.value
+        stored, refused = False, ''
+        if message.version.too_new(self.constants.max_version_skew):
+            refused = 'the version is from the future'
+        else:
+            try:
+                stored = self.storage.put(key, message.value, message.version)
+            except ValueError as ex:
+                refused = str(ex)
+        if refused:
+            logger.warning(f'refused to store {message.key}: {refused}')
 
-        response = messages.StoreResponse(message.nonce)
+        # tell the publisher which version we hold, so they learn if theirs was stale
+        version = self.storage.version_of(key) or core.NO_VERSION
+        response = messages.StoreResponse(message.nonce, stored, version, refused)
         self._respond(message, response)
 
     def find_node_received(self, request):
         logger.debug(f'received a FindNode from {request.sender.nodeid}, {request.sender.port}')
         # look in the table and return the nodes closest to the requested node
         targetnodeid: core.ID = request.key
-        closest: typing.List[core.Node] = self.table.closest(targetnodeid)
+        count = min(request.count or self.constants.k, MAX_NEIGHBOURS)
+        closest: typing.List[core.Node] = self.table.closest(targetnodeid, count)
 
-        response = messages.FindNodeResponse(request.nonce, closest)
+        # send as many of them as fit into a datagram, a larger response would have to be
+        # fragmented or sent over a stream
+        response = messages.FindNodeResponse(request.nonce, closest, request.compact)
+        response.fit(self.node, self.constants.max_datagram_size - self._sender_overhead())
         self._respond(request, response)
 
     def find_value_received(self, request):
@@ -194,7 +644,8 @@ class Server:
         targetkey: core.ID = request.key
         if targetkey.value in self.storage:
             response = messages.FoundValue(
-                request.nonce, targetkey, self.storage[targetkey.value]
+                request.nonce, targetkey, self.storage[targetkey.value],
+                self.storage.version_of(targetkey.value),
             )
             self._respond(request, response)
             return
@@ -202,61 +653,322 @@ class Server:
         # otherwise, return the nodes most likely to have the value
         self.find_node_received(request)
 
+    def sync_digest_received(self, request):
+        logger.debug(f'received a SyncDigest from {request.sender.nodeid}')
+        parts = len(request.hashes)
+        if not 0 < parts <= antientropy.MAX_PARTS:
+            logger.warning(f'ignored a malformed SyncDigest from {request.sender.nodeid}')
+            return
+
+        # we only compare the keys we ought to share, anything wider is somebody making
+        # us hash our whole store
+        prefix, depth = antientropy.shared_range(self.nodeid, request.sender.nodeid)
+        if (request.prefix.value, request.depth) != (prefix, depth):
+            logger.warning(f'ignored a SyncDigest from {request.sender.nodeid} for keys '
+                           'we do not share')
+            return
+
+        low, high = idspace.key_range(prefix, depth)
+        partitioned = antientropy.partition(
+            self.storage.entries(low, high), prefix, depth, parts
+        )
+        ours = antientropy.digest(partitioned)
+
+        # list every key in as many of the differing parts as fit, the next sync will
+        # get to the rest. A part too large to list on its own gets a random run of its
+        # keys, so that repeated syncs cover all of it
+        differing, entries, truncated = [], [], False
+        for index, (mine, theirs) in enumerate(zip(ours, request.hashes)):
+            if mine == theirs:
+                continue
+            part = partitioned[index]
+            room = self.constants.sync_max_keys - len(entries)
+            if len(part) > room:
+                if entries:
+                    break
+                start = random.randrange(len(part) - room + 1)
+                part, truncated = sorted(part)[start:start + room], True
+            differing.append(index)
+            entries.extend(part)
+            if truncated:
+                break
+
+        response = messages.SyncDigestResponse(request.nonce, differing, entries, truncated)
+        self._respond(request, response)
+
     # Outbound RPCs
 
     @must_be_running
-    async def ping(self, addr, port: int, timeout: int = None):
+    async def ping(self, addr, port: int, timeout: float = None):
         pingmsg = messages.Ping()
         future = self.send_to(pingmsg, addr, port)
-        result = None
-        if timeout is None:
-            result = await future
-        else:
-            result = await asyncio.wait_for(future, timeout=timeout)
+        result = await self._wait_for_response(pingmsg, future, (addr, port), timeout)
         assert isinstance(result, messages.Pong)
 
     @must_be_running
-    async def find_node(self, remote: core.Node, targetnodeid: core.ID) -> typing.List[core.Node]:
-        'Send a FIND_NODE to remote and return the result'
-        message = messages.FindNode(targetnodeid)
+    async def find_node(self, remote: core.Node, targetnodeid: core.ID,
+                        count: int = 0) -> typing.List[core.Node]:
+        '''
+        Send a FIND_NODE to remote and return the result, which has up to count neighbours
+        (by default, remote's k) or as many as fit in a datagram
+        '''
+        key = (messages.FindNode, remote, targetnodeid, count)
+        return await self.rpcs.run(key, lambda: self._find_node(remote, targetnodeid, count))
+
+    async def _find_node(self, remote: core.Node, targetnodeid: core.ID, count: int):
+        message = messages.FindNode(targetnodeid, count, compact=True)
         future = self.send(message, remote)
-        result = await future
-        # TODO: throw an error if we weren't given a FindNodeResponse
-        return result
+        return await self._wait_for_response(
+            message, future, (remote.addr, remote.port), expected=messages.FindNodeResponse
+        )
 
     @must_be_running
-    async def find_value(self, remote: core.Node, targetnodeid: core.ID) -> typing.List[core.Node]:
-        'Send a FIND_VALUE to remote and return the result'
-        message = messages.FindValue(targetnodeid)
+    async def find_value(self, remote: core.Node, targetnodeid: core.ID,
+                         count: int = 0) -> typing.List[core.Node]:
+        'Send a FIND_VALUE to remote and return the result, see find_node()'
+        key = (messages.FindValue, remote, targetnodeid, count)
+        return await self.rpcs.run(key, lambda: self._find_value(remote, targetnodeid, count))
+
+    async def _find_value(self, remote: core.Node, targetnodeid: core.ID, count: int = 0):
+        message = messages.FindValue(targetnodeid, count, compact=True)
         future = self.send(message, remote)
-        result = await future
+        result = await self._wait_for_response(
+            message, future, (remote.addr, remote.port),
+            expected=(messages.FindNodeResponse, messages.FoundValue)
+        )
         if isinstance(result, messages.FoundValue):
-            raise ValueFound(result.value)
+            raise ValueFound(result.value, result.version)
         return result
 
     @must_be_running
-    async def store(self, remote: core.Node, key: core.ID, value: bytes):
-        # todo: write a test for this function
-        message = messages.Store(key, value)
+    async def store(self, remote: core.Node, key: core.ID, value: bytes,
+                    version: core.Version = core.NO_VERSION) -> messages.StoreResponse:
+        '''
+        Asks remote to store this version of the value. The response says whether it did,
+        and which version it holds, which is newer than ours if it didn't.
+        '''
+        message = messages.Store(key, value, version)
+        future = self.send(message, remote)
+        return await self._wait_for_response(
+            message, future, (remote.addr, remote.port), expected=messages.StoreResponse
+        )
+
+    @must_be_running
+    async def sync_with(self, remote: core.Node) -> typing.Tuple[int, int]:
+        '''
+        Compares the keys we and remote ought to both hold, and sends each of us the values
+        the other is missing. Returns how many values were (pushed, pulled).
+        '''
+        prefix, depth = antientropy.shared_range(self.nodeid, remote.nodeid)
+        low, high = idspace.key_range(prefix, depth)
+        parts = self.constants.sync_parts
+        entries = self.storage.entries(low, high)
+        partitioned = antientropy.partition(entries, prefix, depth, parts)
+
+        hashes = antientropy.digest(partitioned)
+        message = messages.SyncDigest(core.ID(prefix), depth, hashes)
         future = self.send(message, remote)
-        result = await future
-        return  # TODO: look at and verify the result
+        result = await self._wait_for_response(
+            message, future, (remote.addr, remote.port), expected=messages.SyncDigestResponse
+        )
+
+        differing = {index for index in result.differing if 0 <= index < parts}
+        mine = [entry for index in differing for entry in partitioned[index]]
+        theirs = [
+            (key, version) for key, version in result.entries
+            if low <= key < high
+            and antientropy.part_of(key, prefix, depth, parts) in differing
+        ]
+        if result.truncated:
+            # they only listed the keys between these two, we can't compare the rest
+            first = min((key for key, _ in theirs), default=high)
+            last = max((key for key, _ in theirs), default=low)
+            mine = [(key, version) for key, version in mine if first <= key <= last]
+        push, pull = antientropy.differences(mine, theirs)
+        push = push[:self.constants.sync_max_keys]
+
+        semaphore = asyncio.Semaphore(self.constants.sync_concurrency)
+        async def push_value(key):
+            async with semaphore:
+                await self._push(remote, key)  # if it fails the next sync will try again
+
+        async def pull_value(key):
+            async with semaphore:
+                try:
+                    await self.find_value(remote, core.ID(key))
+                except (asyncio.TimeoutError, UnexpectedResponse):
+                    pass
+                except ValueFound as found:
+                    if found.version.too_new(self.constants.max_version_skew):
+                        logger.warning(f'{remote} holds {key} with a version from the future')
+                        return
+                    try:
+                        self.storage.put(key, found.value, found.version)
+                    except ValueError as ex:
+                        logger.warning(f'could not store {key}: {ex}')
+
+        await asyncio.gather(
+            *(push_value(key) for key in push), *(pull_value(key) for key in pull)
+        )
+        self.rpc_stats['sync_pushed'] += len(push)
+        self.rpc_stats['sync_pulled'] += len(pull)
+        return len(push), len(pull)
+
+    async def _push(self, remote: core.Node, key: int) -> bool:
+        'Sends remote our value for key, returns whether it answered'
+        if key not in self.storage:
+            return True  # it was evicted while we waited
+        value, version = self.storage[key], self.storage.version_of(key)
+        try:
+            await self.store(remote, core.ID(key), value, version)
+        except (asyncio.TimeoutError, UnexpectedResponse):
+            return False
+        return True
+
+    def node_added(self, node: core.Node):
+        'A node joined our routing table'
+        if not self.constants.handoff or node.nodeid in self.handoffs or not self.storage:
+            return
+        self.handoffs.add(node.nodeid)
+        self._in_background(self.hand_off(node))
+
+    def _hands_off(self, key: int, newcomer: core.Node) -> bool:
+        '''
+        Whether newcomer is now among the k closest nodes we know of to key, and we're the
+        closest of the rest. Only the closest sends a key, so newcomers aren't sent it k
+        times over.
+        '''
+        target = core.ID(key)
+        ours = self.nodeid.distance(target)
+        closest = self.table.closest(target, self.constants.k)
+        if any(
+            node.nodeid != newcomer.nodeid and node.nodeid.distance(target) < ours
+            for node in closest
+        ):
+            return False  # they'll hand it off
+        for rank, node in enumerate(closest):
+            if node.nodeid == newcomer.nodeid:
+                # it has to be among the k closest once we're counted too
+                return rank + 1 < self.constants.k or node.nodeid.distance(target) < ours
+        return False
+
+    async def handoff_keys(self, newcomer: core.Node) -> typing.AsyncIterator[int]:
+        '''
+        The keys we hold which we should give newcomer. Checking a key means looking up its
+        closest nodes and, right after we join, the prefix might cover every key we hold,
+        so this lets other work run every HANDOFF_SCAN keys.
+        '''
+        # apart from newcomer we're closest to the keys which agree with us at every bit
+        # in mask. Its top bits usually form a run, which narrows things to a prefix
+        mask = self.table.ownership_mask(excluding=newcomer.nodeid)
+        depth = idspace.ID_BITS - (~mask & ((1 << idspace.ID_BITS) - 1)).bit_length()
+
+        mine = self.nodeid.value
+        keys = self.storage.keys_with_prefix(mine, depth)
+        for checked, key in enumerate(keys, start=1):
+            if (key ^ mine) & mask == 0 and self._hands_off(key, newcomer):
+                yield key
+            if checked % HANDOFF_SCAN == 0:
+                await asyncio.sleep(0)
+
+    async def hand_off(self, newcomer: core.Node):
+        '''
+        Sends newcomer the keys it's now among the k closest nodes to, in batches of
+        handoff_batch STOREs, at most handoff_rate STOREs a second
+        '''
+        try:
+            batch: typing.List[int] = list()
+            async for key in self.handoff_keys(newcomer):
+                batch.append(key)
+                if len(batch) < self.constants.handoff_batch:
+                    continue
+                if not await self._hand_off_batch(newcomer, batch):
+                    return
+                batch = list()
+            if batch:
+                await self._hand_off_batch(newcomer, batch)
+        finally:
+            self.handoffs.discard(newcomer.nodeid)
+
+    async def _hand_off_batch(self, newcomer: core.Node, keys: typing.List[int]) -> bool:
+        'Sends newcomer the keys, returns False if it answered none of them'
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        answered = await asyncio.gather(*(self._push(newcomer, key) for key in keys))
+        self.rpc_stats['handed_off'] += sum(answered)
+        if not any(answered):
+            logger.debug(f'gave up handing keys off to {newcomer}')
+            return False
+        pause = len(answered) / self.constants.handoff_rate
+        await asyncio.sleep(max(0, pause - (loop.time() - began)))
+        return True
+
+    def _in_background(self, coro):
+        task = as_maintenance(coro)
+        self.background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task):
+        self.background.discard(task)
+        if task.cancelled():
+            return
+        exception = task.exception()
+        if isinstance(exception, (asyncio.TimeoutError, UnexpectedResponse)):
+            logger.debug(f'background work failed: {exception!r}')
+        elif exception is not None:
+            logger.error('background work failed', exc_info=exception)
+
+    def _read_repair(self, key: core.ID, found: ValueFound,
+                     lacking: typing.List[core.Node], closest: typing.List[core.Node]):
+        '''
+        A value lookup found the value after asking some nodes which didn't have it. The
+        ones among the closest nodes to the key ought to, so we give it to them.
+        '''
+        k = self.constants.k
+        cutoff = closest[k - 1].nodeid.distance(key) if len(closest) >= k else math.inf
+        lacking = sorted(lacking, key=lambda node: node.nodeid.distance(key))
+        repair = [node for node in lacking if node.nodeid.distance(key) <= cutoff][:k]
+
+        for node in repair:
+            self._in_background(self.store(node, key, found.value, found.version))
+        self.rpc_stats['read_repairs'] += len(repair)
 
     # Node lookups
 
     @must_be_running
-    async def node_lookup(self, targetnodeid: core.ID) -> typing.List[core.Node]:
-        return await self._lookup(targetnodeid, looking_for_value=False)
+    async def node_lookup(self, targetnodeid: core.ID,
+                          trace: tracing.LookupTrace = None) -> typing.List[core.Node]:
+        result = await self._shared_lookup(targetnodeid, False, trace)
+        return list(result)  # everybody who shared the lookup gets their own copy
 
     @must_be_running
-    async def value_lookup(self, targetnodeid: core.ID):
+    async def value_lookup(self, targetnodeid: core.ID, trace: tracing.LookupTrace = None,
+                           with_version: bool = False):
+        '''
+        Returns the value, or (value, version) if with_version is set. Returns None if
+        nobody had it.
+        '''
         try:
-            await self._lookup(targetnodeid, looking_for_value=True)
+            await self._shared_lookup(targetnodeid, True, trace)
         except ValueFound as ex:
-            return ex.value
+            return (ex.value, ex.version) if with_version else ex.value
+        return (None, None) if with_version else None
+
+    def _shared_lookup(self, targetnodeid: core.ID, looking_for_value: bool,
+                       trace: tracing.LookupTrace = None):
+        'If somebody is already performing this lookup wait for their result'
+        if trace is not None:
+            # a trace of somebody else's lookup wouldn't tell you much
+            return self._lookup(targetnodeid, looking_for_value, trace)
+
+        # a lookup runs at the priority of whoever started it, so users don't share the
+        # lookups of maintenance tasks
+        key = (targetnodeid, looking_for_value, _priority.get())
+        return self.lookups.run(key, lambda: self._lookup(targetnodeid, looking_for_value))
 
     @must_be_running
-    async def _lookup(self, targetnodeid: core.ID, looking_for_value: bool) -> typing.List[core.Node]:
+    async def _lookup(self, targetnodeid: core.ID, looking_for_value: bool,
+                      trace: tracing.LookupTrace = None) -> typing.List[core.Node]:
         '''
         A way you might be able to parallalize this:
         1. always have alpha requests in-flight
@@ -269,36 +981,152 @@ class Server:
           from your list (until they do respond) and you continue until you've heard back
           from the k-closest nodes still in consideration
         '''
-        # start with the alpha nodes closest to me
-        to_query = self.table.closest_to_me(self.constants.alpha)
-
-        queried = collections.defaultdict(lambda: False)
-        seen_nodes = list()
-
-        while True:
-            rpc_coro = self.find_value if looking_for_value else self.find_node
-            coros = [rpc_coro(node, targetnodeid) for node in to_query]
-
-            for node in to_query:
-                queried[node.nodeid] = True
-
-            # collect all the responses, merge them into our list, keep the closest k
-            results = await asyncio.gather(*coros)  # TODO: set some kind of timeout!
-            new_nodes = (node for result in results for node in result.nodes)
-            new_nodes = (node for node in new_nodes if node.nodeid != self.nodeid)
-            seen_nodes = sorted(
-                itertools.chain(seen_nodes, new_nodes),
-                key=lambda node: node.nodeid.distance(targetnodeid)
-            )[:self.constants.k]
-
-            # for the next round, send queries to alpha of the closest unqueried nodes
-            to_query = list(itertools.islice(
-                (node for node in seen_nodes if node.nodeid not in queried),
-                self.constants.alpha
-            ))
-
-            # finish once you've queried all of the k closest nodes you know of
-            if len(to_query) == 0:
-                break
+        self.table.lookup_performed(targetnodeid)
+        if trace is not None:
+            trace.looking_for_value = looking_for_value
+
+        self.concurrency.lookups += 1
+        try:
+            return await self._lookup_rounds(targetnodeid, looking_for_value, trace)
+        finally:
+            self.concurrency.lookups -= 1
+
+    async def _lookup_rounds(self, targetnodeid: core.ID, looking_for_value: bool,
+                             trace: typing.Optional[tracing.LookupTrace]):
+        # start with the alpha nodes closest to me, the next few are spares for hedging
+        alpha = self.concurrency.alpha()
+        candidates = self.table.closest_to_me(2 * alpha)
+        to_query, spares = candidates[:alpha], candidates[alpha:]
+
+        # every contact we've accepted, by its distance from the target
+        contacts = lookup.ContactFilter(self.nodeid, per_response=self.constants.k)
+        shortlist = lookup.Shortlist(targetnodeid, self.constants.k)
+        lacking = list()  # nodes which answered our FIND_VALUE without the value
+
+        rpc_coro = self.find_value if looking_for_value else self.find_node
+        async def query(node):
+            await self.concurrency.acquire()
+            try:
+                result = await rpc_coro(node, targetnodeid)
+                if looking_for_value:
+                    lacking.append(node)
+                return result
+            except (asyncio.TimeoutError, UnexpectedResponse):
+                shortlist.failed(node)
+                return None
+            finally:
+                self.concurrency.release()
+
+        async def traced_query(node, closest_distance, hedge=False):
+            record = trace.rpc_sent(node, hedge)
+            try:
+                result = await query(node)
+            except ValueFound:
+                trace.rpc_finished(record, 'value')
+                trace.finished('value found')
+                raise
+            except asyncio.CancelledError:
+                trace.rpc_finished(record, 'cancelled')
+                raise
+            if result is None:
+                trace.rpc_finished(record, 'timeout')
+                return result
+            distances = [targetnodeid.distance(found.nodeid) for found in result.nodes]
+            closer = bool(distances) and (
+                closest_distance is None or min(distances) < closest_distance
+            )
+            trace.rpc_finished(record, 'response', len(result.nodes), closer)
+            return result
+
+        def initial_spare():
+            return next(
+                (spare for spare in spares if not shortlist.was_queried(spare)), None
+            )
+
+        async def hedged_query(node, ask, next_spare):
+            '''
+            Queries node. If it's slower to answer than most peers are, also queries the
+            spare which next_spare() suggests, and returns whichever answer comes back
+            first.
+            '''
+            loop = asyncio.get_running_loop()
+            primary = loop.create_task(ask(node))
+            self.concurrency.primary_sent()
+
+            delay = self.concurrency.hedge_delay()
+            if delay is None:
+                return await primary
+            try:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+            except asyncio.CancelledError:
+                primary.cancel()  # wait() leaves it running
+                raise
+            spare = None if done else next_spare()
+            if spare is None or not self.concurrency.take_hedge():
+                return await primary
+
+            shortlist.mark_queried(spare)
+            self.rpc_stats['hedges'] += 1
+            asked = {primary: node, loop.create_task(ask(spare, hedge=True)): spare}
+            pending = set(asked)
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        result = task.result()  # which might be a ValueFound
+                        if result is not None:
+                            return result
+                return None  # they both timed out
+            finally:
+                for task in pending:
+                    task.cancel()
+                    # asking it again would cost more than our hedge budget allows
+                    shortlist.failed(asked[task])
+
+        next_spare = initial_spare
+        try:
+            while True:
+                if trace is None:
+                    ask = lambda node, hedge=False: query(node)
+                else:
+                    trace.round_started()
+                    ask = functools.partial(
+                        traced_query, closest_distance=shortlist.closest_distance()
+                    )
+
+                for node in to_query:
+                    shortlist.mark_queried(node)
+                coros = [hedged_query(node, ask, next_spare) for node in to_query]
+
+                # collect all the responses, merge the new contacts into our candidates.
+                # Nodes which didn't respond have already left the shortlist
+                results = await asyncio.gather(*coros)
+                for result in results:
+                    if result is None:
+                        continue
+                    for contact in contacts.admit(lookup.responder(result), result.nodes):
+                        shortlist.add(contact)
+
+                # for the next round, send queries to alpha of the closest unqueried nodes,
+                # the rest of the k closest are spares
+                to_query = shortlist.take(self.concurrency.alpha())
+                next_spare = shortlist.peek
+
+                # finish once you've queried all of the k closest nodes you know of
+                if len(to_query) == 0:
+                    if trace is not None:
+                        trace.finished(
+                            'queried the k closest' if shortlist.queried else 'no peers'
+                        )
+                    break
+
+        except ValueFound as found:
+            if self.constants.read_repair:
+                self._read_repair(targetnodeid, found, lacking, shortlist.nodes())
+            raise
+        finally:
+            self.rpc_stats['contacts_rejected'] += sum(contacts.rejected.values())
 
-        return seen_nodes
+        return shortlist.nodes()
@@ -0,0 +1,186 @@
+'''
+S/Kademlia's crypto puzzles, which make node ids expensive to generate so that nobody can
+cheaply fill our buckets with ids of their choosing.
+
+The static puzzle: the sha1 of a node's id must start with static_puzzle_bits zero bits.
+Node ids are random (or, with signed messages, the hash of a public key), so the only way
+to get one which passes is to keep generating them, and aiming for a particular part of
+the id space multiplies the work.
+
+The dynamic puzzle: a node must also find some x such that sha1(nodeid ^ x) starts with
+dynamic_puzzle_bits zero bits. x is sent along with every message. Unlike the static
+puzzle its difficulty can be raised without everybody changing their ids.
+
+Checking either puzzle costs a single hash. Solving them is done once, at startup, and
+solve_in_pool() spreads the work over a pool of processes so the event loop keeps
+running.
+'''
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import random
+import threading
+import typing
+
+import core
+
+if typing.TYPE_CHECKING:
+    import signing
+
+
+ID_BYTES = 20
+
+# how many candidates each job tries before reporting back
+CHUNK_SIZE = 4096
+
+
+def _hash(value: int) -> int:
+    digest = hashlib.sha1(value.to_bytes(ID_BYTES, byteorder='big')).digest()
+    return int.from_bytes(digest, byteorder='big')
+
+
+def _leading_zeros(value: int, bits: int) -> bool:
+    return value >> (160 - bits) == 0
+
+
+def static_ok(nodeid: core.ID, bits: int) -> bool:
+    return bits == 0 or _leading_zeros(_hash(nodeid.value), bits)
+
+
+def dynamic_ok(nodeid: core.ID, puzzle: typing.Optional[bytes], bits: int) -> bool:
+    if bits == 0:
+        return True
+    if not puzzle or len(puzzle) > ID_BYTES:
+        return False
+    x = int.from_bytes(puzzle, byteorder='big')
+    return _leading_zeros(_hash(nodeid.value ^ x), bits)
+
+
+def required(constants: core.Constants) -> bool:
+    return bool(constants.static_puzzle_bits or constants.dynamic_puzzle_bits)
+
+
+def admissible(constants: core.Constants, nodeid: core.ID,
+               puzzle: typing.Optional[bytes]) -> bool:
+    'Whether a node with this id and puzzle solution may join our routing table'
+    return (
+        static_ok(nodeid, constants.static_puzzle_bits)
+        and dynamic_ok(nodeid, puzzle, constants.dynamic_puzzle_bits)
+    )
+
+
+class Credentials(typing.NamedTuple):
+    'Everything a node needs to prove it may use its id'
+    nodeid: core.ID
+    puzzle: typing.Optional[bytes] = None  # our solution to the dynamic puzzle
+    identity: typing.Optional['signing.Identity'] = None  # when we sign our messages
+
+
+# The work, these run in the pool and so only take and return things which pickle
+
+def _static_chunk(bits: int, signed: bool,
+                  tries: int) -> typing.Optional[typing.Tuple[int, typing.Optional[bytes]]]:
+    'Returns (nodeid, private key) for an id which solves the static puzzle, if we find one'
+    if signed:
+        import signing
+        for _ in range(tries):
+            identity = signing.Identity()
+            if static_ok(identity.nodeid, bits):
+                return identity.nodeid.value, identity.private_bytes
+        return None
+
+    for _ in range(tries):
+        nodeid = core.ID()
+        if static_ok(nodeid, bits):
+            return nodeid.value, None
+    return None
+
+
+def _dynamic_chunk(nodeid: int, bits: int, start: int, tries: int) -> typing.Optional[int]:
+    'Returns an x which solves the dynamic puzzle for nodeid, if there is one in the range'
+    for x in range(start, start + tries):
+        x %= 2**160
+        if _leading_zeros(_hash(nodeid ^ x), bits):
+            return x
+    return None
+
+
+def _credentials(nodeid: int, private_bytes: typing.Optional[bytes],
+                 x: typing.Optional[int]) -> Credentials:
+    identity = None
+    if private_bytes is not None:
+        import signing
+        identity = signing.Identity.from_private_bytes(private_bytes)
+    puzzle = None if x is None else x.to_bytes(ID_BYTES, byteorder='big')
+    return Credentials(core.ID(nodeid), puzzle, identity)
+
+
+def _static_jobs(constants: core.Constants) -> typing.Iterator[tuple]:
+    while True:
+        yield (constants.static_puzzle_bits, constants.signed_messages, CHUNK_SIZE)
+
+
+def _dynamic_jobs(constants: core.Constants, nodeid: int) -> typing.Iterator[tuple]:
+    start = random.getrandbits(160)
+    while True:
+        yield (nodeid, constants.dynamic_puzzle_bits, start, CHUNK_SIZE)
+        start += CHUNK_SIZE
+
+
+def solve(constants: core.Constants) -> Credentials:
+    'Generates a node id and solves its puzzles, in this thread. See solve_in_pool()'
+    nodeid, private_bytes = None, None
+    for args in _static_jobs(constants):
+        found = _static_chunk(*args)
+        if found is not None:
+            nodeid, private_bytes = found
+            break
+
+    x = None
+    if constants.dynamic_puzzle_bits:
+        for args in _dynamic_jobs(constants, nodeid):
+            x = _dynamic_chunk(*args)
+            if x is not None:
+                break
+
+    return _credentials(nodeid, private_bytes, x)
+
+
+async def _race(pool: concurrent.futures.Executor, workers: int, function,
+                jobs: typing.Iterator[tuple]):
+    'Keeps workers jobs running until one of them finds something'
+    loop = asyncio.get_running_loop()
+    running = {loop.run_in_executor(pool, function, *next(jobs)) for _ in range(workers)}
+    try:
+        while True:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.result() is not None:
+                    return future.result()
+                running.add(loop.run_in_executor(pool, function, *next(jobs)))
+    finally:
+        for future in running:
+            future.cancel()
+
+
+async def solve_in_pool(constants: core.Constants, workers: int = None) -> Credentials:
+    'Generates a node id and solves its puzzles, on a pool of worker processes'
+    if not required(constants):
+        return solve(constants)  # there's nothing expensive to do
+
+    workers = workers or os.cpu_count() or 1
+    pool = concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        nodeid, private_bytes = await _race(pool, workers, _static_chunk,
+                                            _static_jobs(constants))
+        x = None
+        if constants.dynamic_puzzle_bits:
+            x = await _race(pool, workers, _dynamic_chunk, _dynamic_jobs(constants, nodeid))
+    finally:
+        # don't block the loop waiting for the jobs which lost the race (_race has already
+        # cancelled the ones which hadn't started), a thread waits for them. On 3.7 a
+        # shutdown(wait=False) pool hangs the interpreter when it exits
+        threading.Thread(target=pool.shutdown, name='puzzle pool shutdown').start()
+
+    return _credentials(nodeid, private_bytes, x)
@@ -0,0 +1,136 @@
+import collections
+import ipaddress
+import time
+import typing
+
+import messages
+
+
+# an IPv6 host usually gets a whole /64 to itself, we limit it as a single source
+IPV6_SOURCE_PREFIX = 64
+
+
+def source_of(addr) -> typing.Hashable:
+    '''
+    Who sent a request from addr, as far as rate limits are concerned: its ip, or its
+    /64 for IPv6. Ports are left out, anybody can pick a new one for every request and
+    connections to our stream fallback come from ephemeral ports. The exception is
+    loopback, where every port is a node of our own (see loadtest.py)
+    '''
+    host = addr[0]
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return host  # a hostname
+    if ip.is_loopback:
+        return ip, addr[1]
+    if ip.version == 6:
+        return ipaddress.ip_network((ip, IPV6_SOURCE_PREFIX), strict=False)
+    return ip
+
+
+class TokenBucket:
+    'Allows rate events per second, with bursts of up to burst events'
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    @property
+    def level(self) -> float:
+        'The fraction of the burst which is currently available'
+        self._refill()
+        return self.tokens / self.burst
+
+    def take(self, tokens: float = 1) -> bool:
+        'Returns whether there was room for this event, if there was it is recorded'
+        self._refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class RequestLimiter:
+    '''
+    Decides which incoming requests we have the capacity to serve.
+
+    Each (source, message type) pair gets its own TokenBucket, so a single chatty peer
+    can't crowd out everyone else, and all requests share a global bucket. See source_of()
+    for who counts as a single source. When the
+    global bucket runs low we're overloaded, and only serve high-priority requests until
+    it fills back up.
+    '''
+
+    # Ping and FindNode are cheap for the sender to retry elsewhere, losing a Store loses
+    # data
+    HIGH_PRIORITY = (messages.Store, messages.FindValue)
+
+    def __init__(self, constants, clock=time.monotonic, max_peers: int = 10000):
+        self.constants = constants
+        self.clock = clock
+        self.max_peers = max_peers
+
+        self.peers: typing.MutableMapping[tuple, TokenBucket] = collections.OrderedDict()
+        self.everyone = TokenBucket(
+            constants.global_request_rate, constants.global_request_burst, clock
+        )
+
+        # (reason, message type) -> how many requests we've dropped
+        self.dropped: typing.Counter[typing.Tuple[str, str]] = collections.Counter()
+
+    def retune(self):
+        'Picks up any changes to the rates in our constants'
+        self.everyone.rate = self.constants.global_request_rate
+        self.everyone.burst = self.constants.global_request_burst
+        for bucket in self.peers.values():
+            bucket.rate = self.constants.peer_request_rate
+            bucket.burst = self.constants.peer_request_burst
+
+    def _bucket_for(self, addr, message_type: type) -> TokenBucket:
+        key = (source_of(addr), message_type)
+        if key in self.peers:
+            self.peers.move_to_end(key)
+            return self.peers[key]
+
+        if len(self.peers) >= self.max_peers:
+            # forget whoever we've heard from least recently, their bucket was probably
+            # full anyway
+            self.peers.popitem(last=False)
+
+        bucket = TokenBucket(
+            self.constants.peer_request_rate, self.constants.peer_request_burst, self.clock
+        )
+        self.peers[key] = bucket
+        return bucket
+
+    def overloaded(self) -> bool:
+        return self.everyone.level < self.constants.overload_reserve
+
+    def admit(self, message: messages.Message, addr) -> bool:
+        'Returns whether we should serve this request'
+        message_type = type(message)
+        reason = None
+
+        if not self._bucket_for(addr, message_type).take():
+            reason = 'peer'
+        elif self.overloaded() and not isinstance(message, self.HIGH_PRIORITY):
+            reason = 'overload'
+        elif not self.everyone.take():
+            reason = 'global'
+
+        if reason is None:
+            return True
+
+        self.dropped[(reason, message_type.__name__)] += 1
+        return False
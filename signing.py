@@ -0,0 +1,162 @@
+'''
+Optional message signing, which ties node ids to keys.
+
+A node which signs its messages has an Ed25519 Identity, and its node id is the sha1 of
+its public key. Every message it sends carries that public key, and a signature over the
+rest of the message. Someone who wants to impersonate a node has to steal its key, and
+nobody can choose their own node id without also finding a matching key.
+
+This module needs the cryptography package, which the rest of the package does not.
+'''
+import collections
+import hashlib
+import threading
+import typing
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+except ImportError:  # pragma: no cover
+    ed25519 = None
+
+import core
+import messages
+
+if typing.TYPE_CHECKING:
+    import protobuf.rpc_pb2 as proto
+
+
+def _require_cryptography():
+    if ed25519 is None:
+        raise ImportError('signed messages require the cryptography package')
+
+
+def nodeid_for(publickey: bytes) -> core.ID:
+    'The node id which belongs to this public key'
+    return core.ID.from_bytes(hashlib.sha1(publickey).digest())
+
+
+def _signed_bytes(message: 'proto.Message') -> bytes:
+    'What the signature covers: the message, without its signature'
+    signature = message.signature
+    message.ClearField('signature')
+    try:
+        return message.SerializeToString(deterministic=True)
+    finally:
+        if signature:
+            message.signature = signature
+
+
+class SignatureError(messages.MalformedMessage):
+    'The message was not signed by the node it claims to be from'
+
+
+class Identity:
+    'Our keypair, and the node id which goes with it'
+
+    def __init__(self, private_key: 'ed25519.Ed25519PrivateKey' = None):
+        _require_cryptography()
+        if private_key is None:
+            private_key = ed25519.Ed25519PrivateKey.generate()
+        self.private_key = private_key
+        self.publickey: bytes = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        self.nodeid = nodeid_for(self.publickey)
+
+    @classmethod
+    def from_private_bytes(cls, private_bytes: bytes) -> 'Identity':
+        _require_cryptography()
+        return cls(ed25519.Ed25519PrivateKey.from_private_bytes(private_bytes))
+
+    @property
+    def private_bytes(self) -> bytes:
+        return self.private_key.private_bytes(
+            serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+            serialization.NoEncryption(),
+        )
+
+    def sign(self, message: 'proto.Message'):
+        'Adds our public key and a signature to a finalized message'
+        message.sender.publickey = self.publickey
+        message.signature = self.private_key.sign(_signed_bytes(message))
+
+
+class Verifier:
+    '''
+    Decodes received messages and checks their signatures. Checking that a peer's public
+    key hashes to its node id, and loading the key, happens the first time we hear from
+    the peer. After that the key comes from a cache of the cache_size peers we've heard
+    from most recently, and only the signature itself has to be checked.
+
+    verify() and verify_batch() may be called from several threads at once.
+    '''
+
+    def __init__(self, cache_size: int = 10000):
+        _require_cryptography()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+        # nodeid -> (the public key it sent us, the loaded key)
+        self.keys: typing.MutableMapping[
+            bytes, typing.Tuple[bytes, ed25519.Ed25519PublicKey]
+        ] = collections.OrderedDict()
+
+        self.stats: typing.Counter[str] = collections.Counter()
+
+    def _key_for(self, nodeid: bytes, publickey: bytes) -> 'ed25519.Ed25519PublicKey':
+        with self.lock:
+            cached = self.keys.get(nodeid)
+            if cached is not None and cached[0] == publickey:
+                self.keys.move_to_end(nodeid)
+                self.stats['cache_hits'] += 1
+                return cached[1]
+            self.stats['cache_misses'] += 1
+
+        if hashlib.sha1(publickey).digest() != nodeid:
+            raise SignatureError('the node id does not belong to the public key')
+        try:
+            key = ed25519.Ed25519PublicKey.from_public_bytes(publickey)
+        except ValueError as ex:
+            raise SignatureError(f'bad public key: {ex}') from ex
+
+        with self.lock:
+            self.keys[nodeid] = (publickey, key)
+            self.keys.move_to_end(nodeid)
+            while len(self.keys) > self.cache_size:
+                self.keys.popitem(last=False)
+        return key
+
+    def verify(self, data: bytes) -> messages.Message:
+        'Decodes the message, raises MalformedMessage unless it was signed by its sender'
+        protobuf = messages.parse(data)
+        if not protobuf.HasField('signature') or not protobuf.sender.HasField('publickey'):
+            raise SignatureError('the message is not signed')
+
+        key = self._key_for(protobuf.sender.nodeid, protobuf.sender.publickey)
+        try:
+            key.verify(protobuf.signature, _signed_bytes(protobuf))
+        except InvalidSignature:
+            raise SignatureError('the signature does not match') from None
+
+        return messages.Message.parse_protobuf(protobuf)
+
+    def verify_batch(
+            self, batch: typing.Sequence[bytes]
+    ) -> typing.List[typing.Union[messages.Message, messages.MalformedMessage]]:
+        '''
+        Verifies each message, returning either it or the reason it was rejected. One bad
+        message never costs us the rest of the batch.
+        '''
+        results = []
+        for data in batch:
+            try:
+                results.append(self.verify(data))
+            except Exception as ex:
+                with self.lock:
+                    self.stats['rejected'] += 1
+                if not isinstance(ex, messages.MalformedMessage):
+                    ex = messages.MalformedMessage(f'could not verify the message: {ex!r}')
+                results.append(ex)
+        return results
@@ -0,0 +1,301 @@
+import array
+import bisect
+import collections.abc
+import heapq
+import typing
+
+import core
+import idspace
+
+
+# Roughly what python spends on each entry beyond the bytes of the value: the dict slot,
+# the int key, and the slots in our metadata arrays
+ENTRY_OVERHEAD = 128
+
+
+class StorageStats(typing.NamedTuple):
+    keys: int
+    bytes: int
+    budget: int
+    hits: int
+    misses: int
+    evictions: int
+    rejected: int
+
+
+# below this many keys it's faster to sort a subtree by distance than to split it further
+SORT_BELOW = 8
+
+
+def _nearest(index: typing.List[int], target: int, low: int, bits: int,
+             start: int, stop: int) -> typing.Iterator[int]:
+    '''
+    Yields index[start:stop], the keys of the subtree of 2**bits keys beginning at low, in
+    order of their xor distance from target. Every key in the half of the subtree which
+    agrees with target at its top bit is closer to target than every key in the other half.
+    '''
+    if stop - start <= SORT_BELOW:
+        yield from sorted(index[start:stop], key=lambda key: key ^ target)
+        return
+
+    bits -= 1
+    middle = low + (1 << bits)
+    split = bisect.bisect_left(index, middle, start, stop)
+    halves = [(low, start, split), (middle, split, stop)]
+    if target >> bits & 1:
+        halves.reverse()
+    for half_low, half_start, half_stop in halves:
+        if half_start < half_stop:
+            yield from _nearest(index, target, half_low, bits, half_start, half_stop)
+
+
+class _Shard:
+    '''
+    Holds some of the keys. Metadata about each key lives in compact arrays indexed by
+    the slot the key was assigned, slots are reused once their key is removed. index holds
+    the keys in sorted order, for range and distance queries, and recency holds them in
+    the order they were last touched.
+    '''
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+
+        self.slots: typing.Dict[int, int] = dict()  # key -> slot
+        self.free: typing.List[int] = list()
+
+        self.keys: typing.List[typing.Optional[int]] = list()
+        self.values: typing.List[typing.Optional[bytes]] = list()
+        self.sizes = array.array('L')
+        self.stamps = array.array('Q')  # the timestamp of each value's version
+        self.publishers: typing.List[bytes] = list()  # and who published it
+
+        self.index: typing.List[int] = list()
+        self.recency: typing.MutableMapping[int, None] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def in_range(self, low: int, high: int) -> typing.List[int]:
+        'The keys in [low, high), in order'
+        start = bisect.bisect_left(self.index, low)
+        return self.index[start:bisect.bisect_left(self.index, high, start)]
+
+    def nearest(self, target: int) -> typing.Iterator[int]:
+        'Every key, closest to target first'
+        return _nearest(self.index, target, 0, idspace.ID_BITS, 0, len(self.index))
+
+    def version(self, slot: int) -> core.Version:
+        return core.Version(self.stamps[slot], self.publishers[slot])
+
+    def touch(self, key: int):
+        self.recency.move_to_end(key)
+
+    def put(self, key: int, value: bytes, size: int, version: core.Version):
+        slot = self.slots.get(key)
+        self.recency[key] = None
+        self.recency.move_to_end(key)
+        if slot is not None:
+            self.used -= self.sizes[slot]
+            self.values[slot] = value
+            self.sizes[slot] = size
+            self.stamps[slot], self.publishers[slot] = version
+        elif self.free:
+            bisect.insort(self.index, key)
+            slot = self.free.pop()
+            self.keys[slot] = key
+            self.values[slot] = value
+            self.sizes[slot] = size
+            self.stamps[slot], self.publishers[slot] = version
+        else:
+            bisect.insort(self.index, key)
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.values.append(value)
+            self.sizes.append(size)
+            self.stamps.append(version.timestamp)
+            self.publishers.append(version.publisher)
+        self.slots[key] = slot
+        self.used += size
+
+    def remove(self, key: int):
+        slot = self.slots.pop(key)
+        del self.index[bisect.bisect_left(self.index, key)]
+        del self.recency[key]
+        self.used -= self.sizes[slot]
+        self.keys[slot] = None
+        self.values[slot] = None
+        self.sizes[slot] = 0
+        self.publishers[slot] = b''
+        self.free.append(slot)
+
+
+class Storage(collections.abc.MutableMapping):
+    '''
+    The values we've been asked to store, keyed by int, which never uses more than budget
+    bytes.
+
+    Keys are spread over shards, each of which gets an equal share of the budget. When a
+    shard goes over its share it evicts keys until it's back under low_water of it. The
+    "lru" policy evicts the keys which were read or written least recently, the "distance"
+    policy evicts the keys furthest from our node id: the ones we're least likely to be
+    among the k closest nodes to, which were probably only cached here.
+
+    Each value also has a core.Version. put() only replaces a value with a newer version
+    of it, assigning to a key replaces the value whatever its version was.
+    '''
+
+    POLICIES = ('lru', 'distance')
+
+    def __init__(self, nodeid: core.ID, budget: int, shards: int = 16,
+                 policy: str = 'lru', low_water: float = 0.9):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown eviction policy {policy}')
+
+        self.nodeid = nodeid
+        self.budget = budget
+        self.policy = policy
+        self.low_water = low_water
+
+        self.shards = [_Shard(budget // shards) for _ in range(shards)]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def _shard_for(self, key: int) -> _Shard:
+        return self.shards[key % len(self.shards)]
+
+    @staticmethod
+    def size_of(value: bytes) -> int:
+        return len(value) + ENTRY_OVERHEAD
+
+    def __getitem__(self, key: int) -> bytes:
+        shard = self._shard_for(key)
+        slot = shard.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        shard.touch(key)
+        return shard.values[slot]
+
+    def __setitem__(self, key: int, value: bytes):
+        self._write(key, value, core.NO_VERSION)
+
+    def _write(self, key: int, value: bytes, version: core.Version):
+        shard = self._shard_for(key)
+        size = self.size_of(value)
+        if size > shard.budget:
+            self.rejected += 1
+            raise ValueError(f'a value of {len(value)} bytes is too large to store')
+
+        shard.put(key, value, size, version)
+        if shard.used > shard.budget:
+            self._evict(shard)
+
+    def version_of(self, key: int) -> typing.Optional[core.Version]:
+        'The version of the value we hold for this key, None if we hold nothing'
+        shard = self._shard_for(key)
+        slot = shard.slots.get(key)
+        if slot is None:
+            return None
+        return shard.version(slot)
+
+    def keys_in_range(self, low: int, high: int) -> typing.Iterator[int]:
+        'The keys in [low, high), in order'
+        return heapq.merge(*(shard.in_range(low, high) for shard in self.shards))
+
+    def keys_with_prefix(self, prefix: int, depth: int) -> typing.Iterator[int]:
+        'The keys whose first depth bits match those of prefix, in order'
+        return self.keys_in_range(
+            *idspace.key_range(idspace.prefix_of(prefix, depth), depth)
+        )
+
+    def nearest(self, target: int) -> typing.Iterator[int]:
+        '''
+        Every key, in order of xor distance from target. This is lazy, finding the closest
+        few keys costs about as much as a couple of bisections per bit.
+        '''
+        distance = lambda key: key ^ target
+        return heapq.merge(*(shard.nearest(target) for shard in self.shards), key=distance)
+
+    def entries(self, low: int, high: int) -> typing.Iterator[typing.Tuple[int, core.Version]]:
+        'The (key, version) of every key in [low, high), in order'
+        for key in self.keys_in_range(low, high):
+            shard = self._shard_for(key)
+            yield key, shard.version(shard.slots[key])
+
+    def put(self, key: int, value: bytes, version: core.Version = core.NO_VERSION) -> bool:
+        '''
+        Stores the value unless we already hold a newer version of it. Returns whether we
+        now hold this version. Unversioned values always replace each other, the way they
+        did before values had versions.
+        '''
+        current = self.version_of(key)
+        if current is None or version > current or version == core.NO_VERSION == current:
+            self._write(key, value, version)
+            return True
+        return version == current
+
+    def __delitem__(self, key: int):
+        self._shard_for(key).remove(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self._shard_for(key).slots
+
+    def __iter__(self) -> typing.Iterator[int]:
+        for shard in self.shards:
+            yield from list(shard.slots)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def _eviction_order(self, shard: _Shard) -> typing.Iterable[int]:
+        'Returns the keys of this shard, the ones which should be evicted first come first'
+        if self.policy == 'lru':
+            return iter(shard.recency)
+        # the keys closest to the complement of our id are the furthest from us
+        return shard.nearest(self.nodeid.value ^ ((1 << idspace.ID_BITS) - 1))
+
+    def _evict(self, shard: _Shard):
+        # Under the distance policy this might evict the value we were just given, that's
+        # fine, it means we're the wrong node to be holding onto it
+        excess = shard.used - shard.budget * self.low_water
+        victims = []
+        for key in self._eviction_order(shard):
+            if excess <= 0:
+                break
+            victims.append(key)
+            excess -= shard.sizes[shard.slots[key]]
+
+        for key in victims:
+            shard.remove(key)
+            self.evictions += 1
+
+    def retune(self, budget: int, policy: str):
+        'Changes the budget and policy, evicting keys if we are now over budget'
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown eviction policy {policy}')
+        self.budget = budget
+        self.policy = policy
+        for shard in self.shards:
+            shard.budget = budget // len(self.shards)
+            if shard.used > shard.budget:
+                self._evict(shard)
+
+    @property
+    def used(self) -> int:
+        return sum(shard.used for shard in self.shards)
+
+    def stats(self) -> StorageStats:
+        return StorageStats(
+            keys=len(self),
+            bytes=self.used,
+            budget=self.budget,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            rejected=self.rejected,
+        )
@@ -0,0 +1,40 @@
+import antientropy
+import idspace
+from core import ID, NO_VERSION, Version
+
+
+def test_shared_range():
+    prefix, depth = antientropy.shared_range(ID(0b1000), ID(0b1011))
+    assert depth == 158
+    assert idspace.key_range(prefix, depth) == (0b1000, 0b1100)
+
+    assert antientropy.shared_range(ID(0), ID(2**159)) == (0, 0)  # the whole id space
+    assert idspace.key_range(0, 0) == (0, 2**160)
+
+
+def test_partition():
+    prefix, depth = 0b1000, 158
+    entries = [(key, NO_VERSION) for key in (0b1000, 0b1001, 0b1011)]
+    assert antientropy.partition(entries, prefix, depth, 2) == [entries[:2], entries[2:]]
+    assert [len(part) for part in antientropy.partition(entries, prefix, depth, 8)] == [
+        1, 0, 1, 0, 0, 0, 1, 0
+    ]
+
+
+def test_digests_only_match_the_same_entries():
+    old, new = Version(1, b'a'), Version(2, b'a')
+    mine = antientropy.digest([[(1, old), (2, new)], [(3, old)]])
+    assert mine == antientropy.digest([[(2, new), (1, old)], [(3, old)]])
+
+    theirs = antientropy.digest([[(1, new), (2, new)], [(3, old)]])
+    assert mine[0] != theirs[0]
+    assert mine[1] == theirs[1]
+
+    assert antientropy.digest([[]]) == [0]
+
+
+def test_differences():
+    old, new = Version(1, b'a'), Version(2, b'a')
+    mine = [(1, new), (2, old), (3, old)]
+    theirs = [(1, old), (2, new), (3, old), (4, NO_VERSION)]
+    assert antientropy.differences(mine, theirs) == ([1], [2, 4])
@@ -0,0 +1,49 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+import batch
+from core import ID, Node, RoutingTable
+
+
+def test_ids_round_trip():
+    ids = [ID(0), ID(1), ID(2**160 - 1), ID(2**128 + 2**64 + 5), ID()]
+    array = batch.ids_to_array(ids)
+    assert array.dtype == batch.ID_DTYPE
+    assert array[2]['high'] == 2**32 - 1
+    assert batch.array_to_ids(array) == ids
+
+
+def test_closest_matches_sorting():
+    ids = [ID() for _ in range(200)]
+    # some ids which only differ in the lower words
+    ids += [ID(ids[0].value ^ (1 << bit)) for bit in (1, 63, 64, 127, 128)]
+    targets = [ID() for _ in range(20)] + [ids[0], ids[-1]]
+
+    array = batch.ids_to_array(ids)
+    result = batch.closest(array, targets, n=8, chunk_size=7)
+    assert result.shape == (len(targets), 8)
+
+    for target, indexes in zip(targets, result):
+        expected = sorted(ids, key=target.distance)[:8]
+        assert [ids[index] for index in indexes] == expected
+
+
+def test_closest_with_fewer_ids_than_n():
+    array = batch.ids_to_array([ID(1), ID(2)])
+    assert batch.closest(array, [ID(3)], n=5).tolist() == [[1, 0]]
+
+
+def test_xor_distances():
+    array = batch.ids_to_array([ID(0b101), ID(2**150)])
+    distances = batch.array_to_ids(batch.xor_distances(array, ID(0b1)))
+    assert distances == [ID(0b100), ID(2**150 + 1)]
+
+
+def test_table_to_array():
+    table = RoutingTable(2, ID(0b1000))
+    for value in (0b1001, 0b1010, 0b1100):
+        table.node_seen(Node('localhost', 1, ID(value)))
+
+    ids = batch.array_to_ids(batch.table_to_array(table))
+    assert sorted(ids) == [ID(0b1001), ID(0b1010), ID(0b1100)]
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import concurrency
+import core
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+    def __call__(self):
+        return self.now
+
+
+def test_loss_raises_alpha():
+    constants = core.Constants(alpha=3, max_alpha=8)
+    controller = concurrency.AdaptiveConcurrency(constants, Clock())
+    assert controller.alpha() == 3
+
+    controller.responded(0.01)
+    for _ in range(3):
+        controller.timed_out()
+    assert 3 < controller.alpha() <= 8
+
+    # round trips are flat, so this is loss rather than congestion
+    assert controller.window >= constants.inflight_window
+
+    for _ in range(50):
+        controller.timed_out()
+    assert controller.alpha() == 8
+
+    for _ in range(50):
+        controller.responded(0.01)
+    assert controller.alpha() == 3
+
+
+def test_congestion_shrinks_the_window():
+    clock = Clock()
+    constants = core.Constants(inflight_window=64, min_inflight_window=4)
+    controller = concurrency.AdaptiveConcurrency(constants, clock)
+
+    for _ in range(10):
+        controller.responded(0.01)
+    assert controller.window > 64
+
+    # round trips balloon, the window is halved but only once per round trip
+    window = controller.window
+    for _ in range(20):
+        controller.responded(0.5)
+    assert controller.window == window / 2
+
+    clock.now += 1
+    controller.responded(0.5)
+    assert controller.window == window / 4
+
+    # each lookup only gets its share
+    controller.lookups = 100
+    assert controller.alpha() == 1
+
+
+def test_disabled():
+    constants = core.Constants(alpha=3, adaptive_concurrency=False)
+    controller = concurrency.AdaptiveConcurrency(constants, Clock())
+    for _ in range(10):
+        controller.timed_out()
+    assert controller.alpha() == 3
+
+
+@pytest.mark.asyncio
+async def test_window_limits_inflight():
+    constants = core.Constants(inflight_window=1, min_inflight_window=1)
+    controller = concurrency.AdaptiveConcurrency(constants, Clock())
+
+    await controller.acquire()
+    second = asyncio.get_running_loop().create_task(controller.acquire())
+    await asyncio.sleep(0)
+    assert not second.done()
+    assert controller.metrics()['waiting'] == 1
+
+    # a cancelled waiter doesn't take a slot
+    third = asyncio.get_running_loop().create_task(controller.acquire())
+    await asyncio.sleep(0)
+    third.cancel()
+
+    controller.release()
+    await asyncio.wait_for(second, timeout=0.1)
+    assert controller.inflight == 1
+    controller.release()
+    assert controller.inflight == 0
+
+
+def test_hedging():
+    constants = core.Constants(hedge_percentile=0.5, hedge_budget=0.1)
+    controller = concurrency.AdaptiveConcurrency(constants, Clock())
+
+    # until we know what a slow peer looks like we don't hedge
+    controller.responded(0.01)
+    assert controller.hedge_delay() is None
+
+    for rtt in range(1, 21):
+        controller.responded(rtt / 100)
+    assert 0.09 <= controller.hedge_delay() <= 0.11
+
+    # the delay comes from a sorted copy of the most recent round trips
+    for rtt in range(300, 0, -1):
+        controller.responded(rtt / 1000)
+    assert controller.sorted_rtts == sorted(controller.rtts)
+    assert len(controller.sorted_rtts) == 256
+    assert controller.hedge_delay() == 0.129
+
+    # ten RPCs earn a single hedge
+    for _ in range(9):
+        controller.primary_sent()
+    assert not controller.take_hedge()
+    controller.primary_sent()
+    assert controller.take_hedge()
+    assert not controller.take_hedge()
+
+    constants.tune(hedge_budget=0)
+    assert controller.hedge_delay() is None
@@ -1,6 +1,6 @@
 import collections
+import datetime
 import pytest
-import typing
 
 from core import *
 
@@ -61,17 +61,6 @@ def test_first_element_of_ordered_dict():
     assert RoutingTable._first_element_of_ordered_dict(dictionary) == (20, 2)
 
 
-def test_i_centered_indexes():
-    assert list(RoutingTable._i_centered_indexes(0, 1)) == [(0,)]
-    assert list(RoutingTable._i_centered_indexes(3, 5)) == [(3,), (2, 4), (1,), (0,)]
-
-    def flatten(tups: typing.Iterator[typing.Tuple[int, ...]]):
-        return [subitem for item in tups for subitem in item]
-
-    # it should return a permutation of range(length)
-    assert sorted(flatten(RoutingTable._i_centered_indexes(73, 160))) == list(range(160))
-
-
 def test_calling_node_seen_bumps_last_seen():
     mynodeid = ID(0b1000)
     table = RoutingTable(2, mynodeid)
@@ -171,3 +160,188 @@ def test_closest():
     assert mynodeid.distance(ID(0b10010)) < mynodeid.distance(ID(0b11000))
     assert [node.nodeid for node in nodes] == [ID(0b10101), ID(0b10010)]
 
+
+def test_stale_buckets():
+    mynodeid = ID(0b10000)
+    table = RoutingTable(2, mynodeid)
+
+    hour = datetime.timedelta(hours=1)
+    now = datetime.datetime.utcnow()
+
+    # we don't know anybody, there's nothing to refresh
+    assert table.stale_buckets(hour, now + 2*hour) == []
+
+    table.node_seen(Node('localhost', 1, ID(0b10100)))  # bucket 2
+    assert table.stale_buckets(hour, now) == []
+
+    # the buckets closer than our closest neighbor are never stale
+    stale = table.stale_buckets(hour, now + 2*hour)
+    assert set(stale) == set(range(2, 160))
+
+    # the buckets which have been quiet for longest come first
+    table.touch_bucket(5, now + 2*hour)
+    table.touch_bucket(2, now - 3*hour)
+    stale = table.stale_buckets(hour, now + 2*hour)
+    assert 5 not in stale
+    assert stale[0] == 2
+
+    # a lookup into a bucket counts as activity
+    table.lookup_performed(ID(0b10000 ^ 0b1000000))  # bucket 6
+    assert table.bucket_activity[6] > now
+
+
+def test_occupied_buckets():
+    table = RoutingTable(2, ID(0))
+    with pytest.raises(IndexError):
+        table.first_occupied_bucket()
+    assert len(table.buckets) == 0  # looking didn't create any empty buckets
+
+    for nodeid in (0b1, 0b100, 0b101, 2**159):
+        table.node_seen(Node('localhost', 1, ID(nodeid)))
+    assert list(table.occupied_buckets()) == [0, 2, 159]
+    assert table.first_occupied_bucket() == 0
+    assert table.last_occupied_bucket() == 159
+
+    table.evict_node(ID(0b1))
+    table.evict_node(ID(0b100))
+    assert table.first_occupied_bucket() == 2  # 0b101 is still in there
+    with pytest.raises(KeyError):
+        table.entry_for(ID(0b1000))
+    assert list(table.occupied_buckets()) == [2, 159]
+
+
+def test_ownership_mask():
+    table = RoutingTable(2, ID(0b1000))
+    assert table.node_seen(Node('localhost', 1, ID(0b1001)))
+    assert not table.node_seen(Node('localhost', 1, ID(0b1001)))  # not new any more
+    for nodeid in (0b1100, 0b1110):
+        table.node_seen(Node('localhost', 1, ID(nodeid)))
+    assert table.ownership_mask() == 0b101
+
+    # we're closer to a key than any of them when it agrees with us at bits 0 and 2
+    closest = lambda key: min([0b1000, 0b1001, 0b1100, 0b1110], key=lambda n: n ^ key)
+    for key in range(16):
+        assert ((key ^ 0b1000) & 0b101 == 0) == (closest(key) == 0b1000)
+
+    assert table.ownership_mask(excluding=ID(0b1001)) == 0b100  # alone in its bucket
+    assert table.ownership_mask(excluding=ID(0b1100)) == 0b101
+
+
+def test_closest_crosses_buckets_in_distance_order():
+    table = RoutingTable(20, ID(0))
+    nodes = [Node('localhost', 1, ID(nodeid)) for nodeid in (0b1, 0b10, 0b10000)]
+    for node in nodes:
+        table.node_seen(node)
+
+    # the target is in bucket 3, which is empty. Everything in the buckets closer to us
+    # is closer to it than anything in bucket 4 is
+    target = ID(0b1000)
+    assert table.closest(target, 2) == [nodes[0], nodes[1]]
+    assert table.closest(target, 3) == sorted(nodes, key=lambda n: n.nodeid.distance(target))
+
+
+def test_tree_splits_the_bucket_containing_us():
+    mynodeid = ID(0)
+    table = TreeRoutingTable(2, mynodeid)
+
+    far = [Node('localhost', 1, ID(2**159 + i)) for i in range(3)]
+    table.node_seen(far[0])
+    table.node_seen(far[1])
+
+    # the only bucket covers us, so it splits rather than rejecting the node. But then
+    # the far half doesn't cover us and is full
+    with pytest.raises(NoRoomInBucket) as excinfo:
+        table.node_seen(far[2])
+    assert excinfo.value.entry.node == far[0]
+
+    # while the half we're in keeps splitting, we can hold many more nodes close to us
+    near = [Node('localhost', 1, ID(i)) for i in (1, 2, 3, 4, 5, 8, 9, 16, 17)]
+    for node in near:
+        table.node_seen(node)
+    for node in near:
+        assert table.last_seen_for(node.nodeid) is not None
+
+    assert sorted(table.nodes()) == sorted(far[:2] + near)
+    assert table.first_occupied_bucket() == 0
+
+
+def test_tree_relaxed_splitting():
+    'A bucket which does not cover us still splits to hold our k closest neighbors'
+    mynodeid = ID(0)
+    table = TreeRoutingTable(2, mynodeid)
+
+    # these are all in the far half of the tree, but each is the closest node we know of
+    far = [Node('localhost', 1, ID(2**159 + i)) for i in (3, 2, 1, 0)]
+    for node in far:
+        table.node_seen(node)
+    assert table.closest_to_me() == [far[3], far[2]]
+
+    # once we know of closer nodes the far buckets stop splitting
+    table = TreeRoutingTable(2, mynodeid)
+    table.node_seen(Node('localhost', 1, ID(1)))
+    table.node_seen(Node('localhost', 1, ID(2)))
+    table.node_seen(far[0])
+    table.node_seen(far[1])
+    with pytest.raises(NoRoomInBucket):
+        table.node_seen(far[2])
+
+
+def test_tree_closest_matches_sorting():
+    mynodeid = ID()
+    table = TreeRoutingTable(4, mynodeid)
+
+    for _ in range(500):
+        try:
+            table.node_seen(Node('localhost', 1, ID()))
+        except NoRoomInBucket:
+            pass
+
+    known = list(table.nodes())
+    for _ in range(20):
+        target = ID()
+        expected = sorted(known, key=lambda node: target.distance(node.nodeid))[:4]
+        assert table.closest(target) == expected
+
+    expected = sorted(known, key=lambda node: mynodeid.distance(node.nodeid))[:7]
+    assert table.closest_to_me(7) == expected
+
+
+def test_tree_eviction():
+    table = TreeRoutingTable(2, ID(0))
+    one, two, three = (Node('localhost', 1, ID(2**159 + i)) for i in range(3))
+
+    table.node_seen(Node('localhost', 1, ID(1)))
+    table.node_seen(Node('localhost', 1, ID(2)))
+    table.node_seen(one)
+    table.node_seen(two)
+    with pytest.raises(NoRoomInBucket):
+        table.node_seen(three)
+
+    table.evict_node(one.nodeid)
+    table.node_seen(three)
+    with pytest.raises(KeyError):
+        table.last_seen_for(one.nodeid)
+
+
+def test_constants():
+    constants = Constants(k=20, alpha=5)
+    assert constants.k == 20
+    assert Constants().k != 20  # the defaults are not shared
+
+    with pytest.raises(ValueError):
+        Constants(k=0)
+    with pytest.raises(ValueError):
+        Constants(storage_eviction='random')
+
+    constants.tune(alpha=1, rpc_timeout=0.5)
+    assert constants.alpha == 1
+    assert constants.rpc_timeout == 0.5
+
+    # invalid changes are rejected, and none of the other changes are made
+    with pytest.raises(ValueError):
+        constants.tune(alpha=2, k=-1)
+    assert constants.alpha == 1
+
+    # some things can only be decided before the node starts
+    with pytest.raises(ValueError):
+        constants.tune(bucket_splitting=True)
@@ -0,0 +1,60 @@
+import pytest
+
+import idspace
+
+
+def test_bucket_bounds():
+    assert idspace.BUCKET_BOUNDS[0] == (1, 1)
+    assert idspace.BUCKET_BOUNDS[3] == (8, 15)
+    assert idspace.BUCKET_BOUNDS[159] == (2**159, 2**160 - 1)
+
+
+def test_random_distance():
+    for index in (0, 1, 5, 159):
+        low, high = idspace.BUCKET_BOUNDS[index]
+        for _ in range(50):
+            assert low <= idspace.random_distance(index) <= high
+    assert {idspace.random_distance(2) for _ in range(200)} == {4, 5, 6, 7}
+
+
+def test_prefixes():
+    assert idspace.prefix_of(0b1011, 158) == 0b1000
+    assert idspace.prefix_of(2**160 - 1, 0) == 0
+    assert idspace.prefix_of(0b1011, 160) == 0b1011
+    assert idspace.key_range(0b1000, 158) == (0b1000, 0b1100)
+    assert idspace.key_range(0, 0) == (0, 2**160)
+
+
+def test_occupancy():
+    occupancy = idspace.Occupancy()
+    assert len(occupancy) == 0
+    assert list(occupancy) == []
+
+    for index in (7, 3, 3, 120):
+        occupancy.add(index)
+    assert len(occupancy) == 3
+    assert list(occupancy) == [3, 7, 120]
+    assert 3 in occupancy and 4 not in occupancy
+    assert (occupancy.first(), occupancy.last()) == (3, 120)
+
+    # bucket 3 holds two nodes, it stays occupied until both are gone
+    occupancy.remove(3)
+    assert occupancy.first() == 3
+    occupancy.remove(3)
+    assert occupancy.first() == 7
+
+    occupancy.remove(7)
+    occupancy.remove(120)
+    with pytest.raises(IndexError):
+        occupancy.first()
+
+
+def test_by_distance():
+    occupancy = idspace.Occupancy()
+    for index in (0, 2, 5, 6, 9):
+        occupancy.add(index)
+
+    assert list(occupancy.by_distance(5)) == [(5,), (0, 2), (6,), (9,)]
+    assert list(occupancy.by_distance(4)) == [(0, 2), (5,), (6,), (9,)]
+    assert list(occupancy.by_distance(0)) == [(0,), (2,), (5,), (6,), (9,)]
+    assert list(occupancy.by_distance(159)) == [(0, 2, 5, 6, 9)]
@@ -1,7 +1,9 @@
 import asyncio
+import datetime
 import pytest
 
 
+import core
 import kademlia
 import protocol
 from core import ID
@@ -28,6 +30,24 @@ async def test_full_nodes():
     assert value == b'hello'
 
 
+@pytest.mark.asyncio
+async def test_full_nodes_with_bucket_splitting():
+    first, second, third = (
+        kademlia.Node('localhost', port, core.Constants(bucket_splitting=True))
+        for port in (9000, 9001, 9002)
+    )
+    for node in (first, second, third):
+        await node.listen()
+        assert isinstance(node.server.table, core.TreeRoutingTable)
+
+    await asyncio.wait_for(first.bootstrap('localhost', 9001), timeout=0.1)
+    await second.bootstrap('localhost', 9002)
+
+    await asyncio.wait_for(first.store_value(ID(0b100), b'hello'), timeout=0.1)
+    value = await asyncio.wait_for(third.find_value(ID(0b100)), timeout=0.1)
+    assert value == b'hello'
+
+
 @pytest.mark.asyncio
 async def test_bootstrapping():
     node = kademlia.Node('localhost', 3000)
@@ -44,6 +64,10 @@ async def test_bootstrapping():
     await node.bootstrap('localhost', 3001)
     assert node.server.table.last_seen_for(far.node.nodeid) is not None
 
+    node.stop()
+    remote.stop()
+    far.stop()
+
 
 @pytest.mark.asyncio
 async def test_store():
@@ -70,6 +94,7 @@ async def test_store():
     assert 0b1010 in storage(third)
     assert 0b1010 in storage(second)
     assert 0b1010 not in storage(first)  # first is not in the first k peers
+    node.stop()
 
 
 @pytest.mark.asyncio
@@ -94,3 +119,117 @@ async def test_value_lookup():
 
     result = await asyncio.wait_for(node.find_value(ID(0b100)), timeout=0.1)
     assert result == b'hello'
+
+
+@pytest.mark.asyncio
+async def test_stale_stores_do_not_overwrite():
+    node = kademlia.Node('localhost', 3000)
+    await node.listen()
+
+    first = protocol.Server(mynodeid=ID(0b1000))
+    second = protocol.Server(mynodeid=ID(0b1001))
+    await first.listen('localhost', 3001)
+    await second.listen('localhost', 3002)
+
+    await node.bootstrap('localhost', 3001)
+    first.table.node_seen(second.node)
+
+    key = ID(0b100)
+    old, new = core.Version(1, b'a'), core.Version(2, b'b')
+    newest = await asyncio.wait_for(node.store_value(key, b'new', new), timeout=0.1)
+    assert newest == new
+
+    # a publisher who raced us and lost learns that its write is stale
+    newest = await asyncio.wait_for(node.store_value(key, b'old', old), timeout=0.1)
+    assert newest == new
+    assert second.storage[key.value] == b'new'
+
+    found = await asyncio.wait_for(node.find_value(key, with_version=True), timeout=0.1)
+    assert found == (b'new', new)
+
+
+@pytest.mark.asyncio
+async def test_read_repair():
+    node = kademlia.Node('localhost', 3000)
+    await node.listen()
+
+    first = protocol.Server(mynodeid=ID(0b1000))
+    second = protocol.Server(mynodeid=ID(0b1001))
+    third = protocol.Server(mynodeid=ID(0b1010))
+    await first.listen('localhost', 3001)
+    await second.listen('localhost', 3002)
+    await third.listen('localhost', 3003)
+
+    await node.bootstrap('localhost', 3001)
+    first.table.node_seen(second.node)
+    second.table.node_seen(third.node)
+
+    version = core.Version(1, b'publisher')
+    third.storage.put(0b1011, b'hello', version)
+
+    result = await asyncio.wait_for(node.find_value(ID(0b1011)), timeout=0.1)
+    assert result == b'hello'
+    await asyncio.sleep(0.05)  # the repairs happen in the background
+
+    # second is one of the k closest nodes to the key, and was asked for it
+    assert node.server.rpc_stats['read_repairs'] == 1
+    assert second.storage[0b1011] == b'hello'
+    assert second.storage.version_of(0b1011) == version
+    assert 0b1011 not in first.storage
+    node.stop()
+
+
+@pytest.mark.asyncio
+async def test_refresh_stale_buckets():
+    node = kademlia.Node('localhost', 3000)
+    await node.listen()
+    assert node.refresher is not None  # listening starts the refresher
+
+    remote = kademlia.Node('localhost', 3001)
+    await remote.listen()
+
+    far = kademlia.Node('localhost', 3002)
+    await far.listen()
+
+    remote.server.table.node_seen(far.node)
+    node.server.table.node_seen(remote.node)
+
+    # pretend we haven't heard from anybody in a very long time
+    table = node.server.table
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    table.created = long_ago
+    table.bucket_activity = {index: long_ago for index in table.bucket_activity}
+
+    max_age = datetime.timedelta(seconds=node.constants.refresh_interval)
+    stale = table.stale_buckets(max_age)
+    assert len(stale) > 0
+
+    lookups = []
+    node_lookup = node.server.node_lookup
+    async def counting_lookup(targetnodeid):
+        lookups.append(targetnodeid)
+        return await node_lookup(targetnodeid)
+    node.server.node_lookup = counting_lookup
+
+    await asyncio.wait_for(node.refresh_stale_buckets(), timeout=1)
+
+    # we only had the budget for a few lookups, which went to the stalest buckets
+    budget = node.constants.refresh_budget
+    assert 0 < len(lookups) <= budget
+    targeted = sorted(table._bucket_index_for(target) for target in lookups)
+    assert targeted == sorted(stale[:budget])
+
+    # which refreshed the buckets they targeted and the buckets of the nodes they heard
+    # from, the buckets nobody answered from are still stale
+    refreshed = {table._bucket_index_for(target) for target in lookups}
+    refreshed |= {table._bucket_index_for(peer.node.nodeid) for peer in (remote, far)}
+    still_stale = set(table.stale_buckets(max_age))
+    assert not refreshed & still_stale
+    assert set(stale) - refreshed <= still_stale
+
+    # the refresh lookups taught us about far
+    assert table.last_seen_for(far.node.nodeid) is not None
+
+    node.stop()
+    remote.stop()
+    far.stop()
@@ -0,0 +1,39 @@
+import math
+
+import loadtest
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert loadtest.percentile(samples, 0.5) == 50
+    assert loadtest.percentile(samples, 0.99) == 99
+    assert loadtest.percentile(samples, 1) == 100
+    assert loadtest.percentile([7], 0.99) == 7
+    assert math.isnan(loadtest.percentile([], 0.5))
+
+
+def test_results_summary():
+    results = loadtest.Results()
+    for latency in (0.001, 0.002, 0.003):
+        results.record('find_value', latency, ok=True)
+    results.record('find_value', 5, ok=False)
+    results.record('store_value', 0.004, ok=True)
+    results.record('store_value', 0.001, ok=False, error='OSError')
+
+    summary = results.summary(elapsed=2)
+    assert summary['throughput'] == 2
+    assert summary['ops']['find_value']['ok'] == 3
+    assert summary['ops']['find_value']['failed'] == 1
+    assert summary['ops']['find_value']['max_ms'] == 3
+    assert summary['ops']['find_value']['errors'] == {}
+    assert summary['ops']['store_value']['errors'] == {'OSError': 1}
+
+
+def test_load_test_runs():
+    report = loadtest.main([
+        '--nodes', '3', '--processes', '2', '--keys', '5', '--qps', '20',
+        '--duration', '0.5', '--sample-interval', '0.1', '--base-port', '7100', '--json',
+    ])
+    assert sum(stats['ok'] for stats in report['ops'].values()) > 0
+    assert set(report['workers']) == {0, 1}
+    assert sum(worker['nodes'] for worker in report['workers'].values()) == 3
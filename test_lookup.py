@@ -0,0 +1,90 @@
+from core import ID, Node
+import lookup
+import messages
+
+
+def test_implausible():
+    public = Node('8.8.8.8', 3000, ID(1))
+    private = Node('10.0.0.1', 3000, ID(2))
+    loopback = Node('127.0.0.1', 3000, ID(3))
+    hostname = Node('localhost', 3000, ID(4))
+
+    contact = lambda addr, port=3000: Node(addr, port, ID(5))
+    assert lookup.implausible(contact('1.2.3.4'), public) is None
+    assert lookup.implausible(contact('1.2.3.4', 0), public) == 'bad port'
+    assert lookup.implausible(contact('0.0.0.0'), public) == 'unroutable'
+    assert lookup.implausible(contact('224.0.0.1'), public) == 'unroutable'
+    assert lookup.implausible(contact('255.255.255.255'), private) == 'unroutable'
+
+    # peers may only tell us about addresses which are local to them if we're local too
+    assert lookup.implausible(contact('10.0.0.2'), public) == 'private'
+    assert lookup.implausible(contact('10.0.0.2'), private) is None
+    assert lookup.implausible(contact('127.0.0.1'), private) == 'loopback'
+    assert lookup.implausible(contact('::1'), loopback) is None
+    assert lookup.implausible(contact('127.0.0.1'), hostname) is None
+    assert lookup.implausible(contact('localhost'), public) is None
+
+
+def test_responders_are_judged_by_where_they_are():
+    response = messages.FindNodeResponse(b'nonce', [Node('10.0.0.2', 3000, ID(5))])
+    response.sender = Node('127.0.0.1', 3000, ID(1))  # a claim anyone could make
+
+    # over a stream all we have is the claim
+    assert lookup.responder(response) == response.sender
+
+    # but this datagram came from across the internet
+    response.observed = ('8.8.8.8', 4000)
+    responder = lookup.responder(response)
+    assert responder == Node('8.8.8.8', 4000, ID(1))
+    contacts = lookup.ContactFilter(ID(0), per_response=2)
+    assert list(contacts.admit(responder, response.nodes)) == []
+    assert contacts.rejected == {'private': 1}
+
+
+def test_contact_filter():
+    responder = Node('8.8.8.8', 3000, ID(1))
+    contacts = lookup.ContactFilter(ID(0), per_response=2)
+
+    sent = [
+        Node('1.1.1.1', 3000, ID(0)),  # us
+        Node('1.1.1.1', 3000, ID(10)),
+        Node('1.1.1.1', 3000, ID(11)),  # somebody else at the same address
+        Node('10.0.0.1', 3000, ID(12)),
+        Node('1.1.1.2', 3000, ID(13)),
+        Node('1.1.1.3', 3000, ID(14)),  # one more than the responder may add
+    ]
+    assert list(contacts.admit(responder, sent)) == [sent[1], sent[4]]
+    assert contacts.rejected == {'duplicate address': 1, 'private': 1, 'too many': 1}
+
+    # nodes we already know of aren't admitted twice
+    assert list(contacts.admit(responder, sent[1:2] + sent[5:])) == [sent[5]]
+
+
+def test_shortlist():
+    node = lambda value: Node('1.1.1.1', 3000 + value, ID(value))
+    shortlist = lookup.Shortlist(ID(0), k=3)
+    assert shortlist.take(1) == []
+    assert shortlist.closest_distance() is None
+
+    for value in (5, 1, 7, 3, 6):
+        shortlist.add(node(value))
+    assert shortlist.nodes() == [node(1), node(3), node(5)]
+    assert shortlist.closest_distance() == 1
+
+    # only the k closest are ever queried
+    assert shortlist.take(2) == [node(1), node(3)]
+    assert shortlist.peek() == node(5)
+    shortlist.mark_queried(node(5))  # as a hedge
+    assert shortlist.take(1) == []
+
+    # a node which doesn't respond makes room for the next closest
+    shortlist.failed(node(3))
+    assert shortlist.nodes() == [node(1), node(5), node(6)]
+    assert shortlist.take(3) == [node(6)]
+
+    # and it won't be added back
+    shortlist.add(node(3))
+    shortlist.add(node(2))
+    assert shortlist.nodes() == [node(1), node(2), node(5)]
+    assert shortlist.take(3) == [node(2)]
+    assert shortlist.reserve[0] == (6, node(6))
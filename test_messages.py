@@ -1,5 +1,9 @@
+import subprocess
+import sys
 
-from core import ID, Node
+import pytest
+
+from core import ID, Node, Version
 import messages as msg
 
 def test_parsing():
@@ -15,3 +19,83 @@ def test_parse_find_node_response():
     parsed_nodes = msg.Message.parse_protobuf(find_node_response)
 
     assert parsed_nodes.nodes == nodes[0:]
+
+def test_parse_empty_find_node_response():
+    node = Node('localhost', 3000, ID(10))
+    find_node_response = msg.FindNodeResponse(b'', []).finalize(node)
+    parsed = msg.Message.parse_protobuf(find_node_response)
+    assert parsed.nodes == []
+
+def test_packed_neighbours():
+    sender = Node('localhost', 3000, ID(10))
+    nodes = [
+        Node('10.0.0.1', 3001, ID(1)),
+        Node('2001:db8::1', 3002, ID(2**159)),
+        Node('localhost', 3003, ID(3)),  # which can't be packed
+    ]
+    loose = msg.FindNodeResponse(b'', nodes).finalize(sender)
+    packed = msg.FindNodeResponse(b'', nodes, compact=True).finalize(sender)
+    assert packed.ByteSize() < loose.ByteSize()
+
+    parsed = msg.decode(packed.SerializeToString())
+    assert parsed.nodes == [nodes[2], nodes[0], nodes[1]]
+
+    packed.findNodeResponse.packed = packed.findNodeResponse.packed[:-1]
+    with pytest.raises(msg.MalformedMessage):
+        msg.decode(packed.SerializeToString())
+
+def test_find_node_response_fit():
+    sender = Node('localhost', 3000, ID(10))
+    nodes = [Node(f'10.0.0.{i}', 3000 + i, ID(i)) for i in range(50)]
+    for compact in (False, True):
+        response = msg.FindNodeResponse(b'', list(nodes), compact).fit(sender, 600)
+        assert 0 < len(response.nodes) < 50
+        assert response.nodes == nodes[:len(response.nodes)]  # the furthest are dropped
+        assert response.finalize(sender).ByteSize() <= 600
+        assert msg.FindNodeResponse(b'', nodes[:len(response.nodes) + 1], compact).finalize(
+            sender
+        ).ByteSize() > 600
+
+def test_decode():
+    node = Node('localhost', 3000, ID(10))
+    data = msg.Store(ID(5), b'value').finalize(node).SerializeToString()
+    parsed = msg.decode(data)
+    assert parsed.key == ID(5)
+    assert parsed.value == b'value'
+    assert parsed.sender == node
+
+def test_versions():
+    node = Node('localhost', 3000, ID(10))
+    version = Version(12345, ID(10).to_bytes())
+    for message in [
+            msg.Store(ID(5), b'value', version),
+            msg.FoundValue(b'nonce', ID(5), b'value', version),
+            msg.StoreResponse(b'nonce', False, version),
+    ]:
+        parsed = msg.decode(message.finalize(node).SerializeToString())
+        assert parsed.version == version
+
+    # messages from nodes which don't version their values
+    legacy = msg.StoreResponse(b'nonce').finalize(node)
+    legacy.storeResponse.Clear()
+    legacy.storeResponse.SetInParent()
+    parsed = msg.decode(legacy.SerializeToString())
+    assert parsed.stored
+
+    refused = msg.StoreResponse(b'nonce', False, version, 'too large').finalize(node)
+    assert msg.decode(refused.SerializeToString()).refused == 'too large'
+
+def test_decode_malformed():
+    with pytest.raises(msg.MalformedMessage):
+        msg.decode(b'\xff\xff\xff')
+    with pytest.raises(msg.MalformedMessage):
+        msg.decode(b'')  # parses, but holds no message we know of
+
+    message = msg.FindNode(ID(10)).finalize(Node('localhost', 3000, ID(10)))
+    message.findNode.key = b'\xff' * 21  # too long to be an id
+    with pytest.raises(msg.MalformedMessage):
+        msg.decode(message.SerializeToString())
+
+def test_codec_is_loaded_lazily():
+    check = 'import sys, kademlia; assert "protobuf.rpc_pb2" not in sys.modules'
+    subprocess.run([sys.executable, '-c', check], check=True)
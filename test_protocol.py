@@ -3,9 +3,11 @@ import logging
 import pytest
 import random
 
+import antientropy
 import core
 import messages
 import protocol
+import transports
 
 from protobuf.rpc_pb2 import Message
 
@@ -245,6 +247,48 @@ async def test_responds_to_store():
     assert 0b100 in server.storage
     assert server.storage[0b100] == b'abc'
 
+@pytest.mark.asyncio
+async def test_refuses_versions_from_the_future():
+    'Otherwise a single STORE could stop a key from ever being written again'
+    constants = core.Constants(max_version_skew=60)
+    server = protocol.Server(mynodeid=ID(0b1000), constants=constants)
+    remote = protocol.Server(mynodeid=ID(0b1001))
+    await server.listen('localhost', 3000)
+    await remote.listen('localhost', 3002)
+
+    now = core.Version.now(remote.nodeid)
+    soon = now._replace(timestamp=now.timestamp + 30 * 10**6)
+    later = now._replace(timestamp=now.timestamp + 3600 * 10**6)
+
+    response = await asyncio.wait_for(remote.store(server.node, ID(5), b'a', soon), 0.5)
+    assert response.stored and not response.refused
+
+    response = await asyncio.wait_for(remote.store(server.node, ID(5), b'b', later), 0.5)
+    assert not response.stored
+    assert response.refused == 'the version is from the future'
+    assert response.version == soon
+    assert server.storage[5] == b'a'
+
+    server.stop()
+    remote.stop()
+
+@pytest.mark.asyncio
+async def test_unexpected_responses():
+    'A peer which answers with the wrong kind of message is an error, not an assertion'
+    mockserver = await startmockserver(3000)
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+    remote = core.Node(addr='localhost', port=3001, nodeid=ID(0b1001))
+
+    stored = asyncio.ensure_future(server.store(remote, ID(5), b'value'))
+    request = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    mockserver.send(messages.Pong(request.nonce).finalize(remote))
+
+    with pytest.raises(protocol.UnexpectedResponse):
+        await asyncio.wait_for(stored, timeout=0.1)
+    assert server.rpc_stats['unexpected_responses'] == 1
+    server.stop()
+
 @pytest.mark.asyncio
 async def test_responds_to_find_value_when_no_value():
     'When you run a Server and send it just FIND_VALUE it gives you nearby nodes'
@@ -379,3 +423,549 @@ async def test_node_lookup_finds_peer_through_peers():
 
     assert server.table.last_seen_for(second_hop.node.nodeid) is not None
     assert server.table.last_seen_for(targetid) is not None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_are_coalesced():
+    'Lookups for the same key which overlap share a single set of RPCs'
+    mockserver = await startmockserver(3000)
+
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+
+    remote = core.Node(addr='localhost', port=3001, nodeid=ID(0b1001))
+    server.table.node_seen(remote)
+
+    first = asyncio.ensure_future(server.node_lookup(ID(0b1010)))
+    second = asyncio.ensure_future(server.node_lookup(ID(0b1010)))
+
+    request = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    response = messages.FindNodeResponse(request.nonce, []).finalize(remote)
+    mockserver.send(response)
+
+    first, second = await asyncio.wait_for(asyncio.gather(first, second), timeout=0.1)
+    assert first == second == []
+    assert len(mockserver.messages) == 1  # remote was only asked once
+
+    # now that the lookup is finished the next one starts from scratch
+    third = asyncio.ensure_future(server.node_lookup(ID(0b1010)))
+    await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert len(mockserver.messages) == 2
+
+    # its only caller gave up, so the shared lookup and its RPCs are cancelled
+    shared = list(server.lookups.inflight.values()) + list(server.rpcs.inflight.values())
+    third.cancel()
+    await asyncio.wait(shared, timeout=0.1)
+    assert all(task.cancelled() for task in shared)
+    server.stop()
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancellation():
+    'One of the callers giving up does not cancel the work for the others'
+    flight = protocol.SingleFlight()
+    started = []
+
+    async def work():
+        started.append(True)
+        await asyncio.sleep(0.05)
+        return 'done'
+
+    first = asyncio.ensure_future(flight.run('key', work))
+    second = asyncio.ensure_future(flight.run('key', work))
+    await asyncio.sleep(0)
+
+    first.cancel()
+    assert await asyncio.wait_for(second, timeout=0.1) == 'done'
+    assert len(started) == 1
+    assert len(flight.inflight) == 0
+
+    # but once all of them have given up there's no point in finishing it
+    third = asyncio.ensure_future(flight.run('key', work))
+    await asyncio.sleep(0)
+    task = flight.inflight['key']
+    third.cancel()
+    await asyncio.wait([task], timeout=0.1)
+    assert task.cancelled()
+    assert len(flight.inflight) == 0
+    assert len(flight.waiters) == 0
+
+
+@pytest.mark.asyncio
+async def test_node_lookup_unresponsive_peer():
+    'Peers which never respond are given up on, and left out of the result'
+    mockserver = await startmockserver(3000)
+
+    server = protocol.Server(mynodeid=ID(0b1000), constants=core.Constants(rpc_timeout=0.1))
+    await server.listen('localhost', 3000)
+
+    remote = protocol.Server(mynodeid=ID(0b1001))
+    await remote.listen('localhost', 3002)
+
+    silent = core.Node(addr='localhost', port=3001, nodeid=ID(0b1011))
+    server.table.node_seen(silent)
+    server.table.node_seen(remote.node)
+    remote.table.node_seen(silent)
+
+    # remote tells us about silent, but we've already given up on it
+    result = await asyncio.wait_for(server.node_lookup(ID(0b1010)), timeout=0.5)
+    assert silent not in result
+    assert len(mockserver.messages) == 1  # silent was only asked once
+
+    assert len(server.protocol.outstanding_requests) == 0
+
+
+@pytest.mark.asyncio
+async def test_lookup_survives_unexpected_responses():
+    'A peer which answers a lookup with the wrong kind of message is treated as unresponsive'
+    mockserver = await startmockserver(3000)
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+
+    confused = core.Node(addr='localhost', port=3001, nodeid=ID(0b1011))
+    server.table.node_seen(confused)
+
+    async def answer_with_pong(lookup):
+        pending = asyncio.ensure_future(lookup(ID(0b1010)))
+        request = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+        mockserver.send(messages.Pong(request.nonce).finalize(confused))
+        return await asyncio.wait_for(pending, timeout=0.1)
+
+    assert confused not in await answer_with_pong(server.node_lookup)
+    assert await answer_with_pong(server.value_lookup) is None
+
+    assert server.rpc_stats['unexpected_responses'] == 2
+    server.stop()
+    mockserver.transport.close()
+
+
+@pytest.mark.asyncio
+async def test_tune():
+    server = protocol.Server(mynodeid=ID(0b1000))
+    server.tune(k=5, peer_request_rate=1, storage_budget=10**6)
+
+    assert server.constants.k == 5
+    assert server.table.k == 5
+    assert server.storage.budget == 10**6
+    assert server.limiter.everyone.rate == server.constants.global_request_rate
+
+
+@pytest.mark.asyncio
+async def test_replies_go_to_the_observed_address():
+    'A node which claims the wrong address still gets responses, and is remembered'
+    mockserver = await startmockserver(3000)
+
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+
+    # the mock listens on 3001, this node is lying (or behind a NAT)
+    remoteid = ID(0b1001)
+    claimed = core.Node(addr='localhost', port=4000, nodeid=remoteid)
+    ping = messages.Ping().finalize(claimed)
+    mockserver.send(ping)
+
+    pong = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert pong.nonce == ping.nonce
+
+    entry = server.table.entry_for(remoteid)
+    assert entry.node.port == 3001
+    assert entry.claimed == ('localhost', 4000)
+    assert server.protocol.address_conflicts == 1
+
+    # we also use the observed address when we talk to it
+    future = mockserver.next_message_future()
+    server.send(messages.Ping(), entry.node)
+    await asyncio.wait_for(future, timeout=0.1)
+
+    # once it stops lying we forget the old claim
+    mockserver.send(messages.Ping().finalize(claimed._replace(port=3001)))
+    await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    entry = server.table.entry_for(remoteid)
+    assert entry.node == core.Node(addr='localhost', port=3001, nodeid=remoteid)
+    assert entry.claimed is None
+    assert server.protocol.address_conflicts == 1
+
+
+def test_addresses_conflict():
+    conflict = protocol.Protocol._addresses_conflict
+    assert not conflict(('127.0.0.1', 1), ('127.0.0.1', 1))
+    assert not conflict(('localhost', 1), ('127.0.0.1', 1))
+    assert not conflict(('::1', 1), ('0:0::1', 1))
+    assert conflict(('localhost', 1), ('127.0.0.1', 2))
+    assert conflict(('10.0.0.1', 1), ('8.8.8.8', 1))
+
+
+@pytest.mark.asyncio
+async def test_signed_messages():
+    pytest.importorskip('cryptography')
+    import signing
+
+    constants = core.Constants(signed_messages=True)
+    identities = [signing.Identity(), signing.Identity()]
+    server = protocol.Server(identities[0].nodeid, constants, identities[0])
+    await server.listen('localhost', 3000)
+    remote = protocol.Server(identities[1].nodeid, constants, identities[1])
+    await remote.listen('localhost', 3002)
+
+    await server.ping('localhost', 3002)
+    assert server.table.entry_for(identities[1].nodeid)
+    assert remote.verifier.stats['cache_misses'] == 1
+
+    # unsigned messages are dropped
+    mockserver = await startmockserver(3000)
+    mockserver.send(messages.Ping().finalize(core.Node('localhost', 3001, ID(0b1001))))
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert server.verifier.stats['rejected'] == 1
+
+    with pytest.raises(ValueError):
+        protocol.Server(ID(), constants, identities[0])
+
+    server.stop()
+    remote.stop()
+
+
+@pytest.mark.asyncio
+async def test_puzzles_are_checked():
+    import puzzles
+
+    constants = core.Constants(static_puzzle_bits=4, dynamic_puzzle_bits=4)
+    ours = puzzles.solve(constants)
+    with pytest.raises(ValueError):
+        protocol.Server(ours.nodeid, constants)  # we didn't pass our own solution
+
+    server = protocol.Server(ours.nodeid, constants, puzzle=ours.puzzle)
+    await server.listen('localhost', 3000)
+    mockserver = await startmockserver(3000)
+
+    # a node which hasn't solved the puzzles is ignored
+    theirs = puzzles.solve(constants)
+    remote = core.Node(addr='localhost', port=3001, nodeid=theirs.nodeid)
+    mockserver.send(messages.Ping().finalize(remote))
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert list(server.table.nodes()) == []
+
+    ping = messages.Ping().finalize(remote)
+    ping.sender.puzzle = theirs.puzzle
+    mockserver.send(ping)
+    pong = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert pong.sender.puzzle == ours.puzzle
+    assert list(server.table.nodes()) == [remote]
+
+    server.stop()
+
+
+@pytest.mark.asyncio
+async def test_slow_peers_are_hedged():
+    constants = core.Constants(alpha=1, k=4, rpc_timeout=0.5)
+    server = protocol.Server(mynodeid=ID(0b1000), constants=constants)
+    await server.listen('localhost', 3000)
+    fast = protocol.Server(mynodeid=ID(0b1010))
+    await fast.listen('localhost', 3002)
+    mockserver = await startmockserver(3000)  # never answers
+
+    slow_node = core.Node('localhost', 3001, ID(0b1001))
+    server.table.node_seen(slow_node)
+    server.table.node_seen(fast.node)
+
+    # the slow node is closer, so it is asked first. Once it's slower than most peers
+    # have been we ask the fast one too
+    for _ in range(20):
+        server.concurrency.responded(0.01)
+    server.concurrency.hedge_tokens = 1
+
+    found = await asyncio.wait_for(server.node_lookup(ID(0b1011)), timeout=1)
+    assert server.rpc_stats['hedges'] == 1
+    assert fast.node not in found  # it only knows about us
+    assert slow_node not in found  # it never answered
+    assert len(mockserver.messages) == 1  # and was not asked again
+
+    await asyncio.sleep(0.5)  # for the slow request to time out
+    server.stop()
+    fast.stop()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_lookups_cancel_their_queries():
+    'Cancelling a lookup while it waits to hedge also cancels the query it waits for'
+    constants = core.Constants(alpha=1, k=4, rpc_timeout=5)
+    server = protocol.Server(mynodeid=ID(0b1000), constants=constants)
+    await server.listen('localhost', 3000)
+    mockserver = await startmockserver(3000)  # never answers
+
+    server.table.node_seen(core.Node('localhost', 3001, ID(0b1001)))
+    for _ in range(20):
+        server.concurrency.responded(1)
+
+    lookup = asyncio.ensure_future(server.node_lookup(ID(0b1011)))
+    await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    lookup.cancel()
+    await asyncio.sleep(0.01)
+
+    assert server.concurrency.inflight == 0
+    assert len(server.protocol.outstanding_requests) == 0
+    server.stop()
+    mockserver.transport.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_with():
+    base = 2**20
+    # without handoffs, or remote would hand server the key 2**40 as soon as they met
+    constants = core.Constants(handoff=False)
+    server = protocol.Server(ID(base), constants)
+    remote = protocol.Server(ID(base + 2**10), constants)
+    await server.listen('localhost', 3000)
+    await remote.listen('localhost', 3001)
+
+    old, new = core.Version(1, b'a'), core.Version(2, b'a')
+    server.storage.put(base + 1, b'new', new)
+    server.storage.put(base + 5, b'only ours', old)
+    remote.storage.put(base + 1, b'old', old)
+    remote.storage.put(base + 2**10 + 3, b'only theirs', new)
+    remote.storage.put(2**40, b'not ours to hold', new)
+
+    pushed, pulled = await asyncio.wait_for(server.sync_with(remote.node), timeout=0.5)
+    assert (pushed, pulled) == (2, 1)
+    assert remote.storage[base + 1] == b'new'
+    assert remote.storage[base + 5] == b'only ours'
+    assert server.storage[base + 2**10 + 3] == b'only theirs'
+    assert server.storage.version_of(base + 2**10 + 3) == new
+    assert 2**40 not in server.storage
+
+    # now there's nothing left to do
+    assert await asyncio.wait_for(remote.sync_with(server.node), timeout=0.5) == (0, 0)
+
+    server.stop()
+    remote.stop()
+
+
+@pytest.mark.asyncio
+async def test_sync_digests_only_cover_shared_keys():
+    'Nodes refuse to digest keys they do not share with the requester'
+    mockserver = await startmockserver(3000)
+    base = 2**20
+    server = protocol.Server(ID(base))
+    await server.listen('localhost', 3000)
+    remote = core.Node('localhost', 3001, ID(base + 2**10))
+
+    request = messages.SyncDigest(ID(0), 0, [0]).finalize(remote)  # every key we hold
+    mockserver.send(request)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+
+    prefix, depth = antientropy.shared_range(server.nodeid, remote.nodeid)
+    request = messages.SyncDigest(ID(prefix), depth, [0]).finalize(remote)
+    mockserver.send(request)
+    response = await asyncio.wait_for(mockserver.next_message_future(), timeout=0.1)
+    assert response.HasField('syncDigestResponse')
+
+    server.stop()
+    mockserver.transport.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_responses_are_bounded():
+    'A part with more than sync_max_keys keys is listed a run at a time'
+    base = 2**20
+    constants = core.Constants(handoff=False, sync_parts=1, sync_max_keys=4)
+    server = protocol.Server(ID(base), constants)
+    remote = protocol.Server(ID(base + 2**10), constants)
+    await server.listen('localhost', 3000)
+    await remote.listen('localhost', 3001)
+
+    version = core.Version(1, b'a')
+    theirs = [base + 2 * key for key in range(10)]
+    for key in theirs:
+        remote.storage.put(key, b'theirs', version)
+    server.storage.put(base + 3, b'ours', version)
+
+    for _ in range(100):
+        pushed, pulled = await asyncio.wait_for(server.sync_with(remote.node), timeout=0.5)
+        assert pulled <= 4
+        if set(server.storage) == set(remote.storage):
+            break
+    assert sorted(server.storage) == sorted(theirs + [base + 3])
+
+    server.stop()
+    remote.stop()
+
+
+@pytest.mark.asyncio
+async def test_keys_are_handed_off_to_new_nodes():
+    base = 2**20
+    server = protocol.Server(ID(base))
+    await server.listen('localhost', 3000)
+    server.table.node_seen(core.Node('localhost', 3005, ID(base + 2**10 + 2)))
+
+    near_them, near_us, far = base + 2**10 + 1, base + 1, 2**30
+    for key in (near_them, near_us, far):
+        server.storage.put(key, b'value', core.Version(1, b'a'))
+
+    newcomer = protocol.Server(ID(base + 2**10))
+    await newcomer.listen('localhost', 3001)
+    await asyncio.wait_for(newcomer.ping('localhost', 3000), timeout=0.5)
+    await asyncio.sleep(0.05)  # the handoff happens in the background
+
+    # the other node is closer to near_them, it's the one which should hand it off
+    assert sorted(newcomer.storage) == [near_us, far]
+    assert newcomer.storage.version_of(far) == core.Version(1, b'a')
+    assert server.rpc_stats['handed_off'] == 2
+    assert not server.handoffs
+
+    server.stop()
+    newcomer.stop()
+
+
+def test_only_the_closest_holder_hands_off():
+    'When another node we know of is closer to the key than we are, it sends the key'
+    base = 2**20
+    server = protocol.Server(ID(base))
+    newcomer = core.Node('localhost', 3001, ID(base + 2**10))
+    holder = core.Node('localhost', 3002, ID(base + 2**10 + 2))
+    server.table.node_seen(holder)
+    server.table.node_seen(newcomer)
+
+    # newcomer is the closest to both keys, holder is closer than us to the first
+    near_them, near_us = base + 2**10 + 1, base + 1
+    assert not server._hands_off(near_them, newcomer)
+    assert server._hands_off(near_us, newcomer)
+
+
+@pytest.mark.asyncio
+async def test_handoff_keys_are_found_lazily():
+    'Right after we join we might have to check every key, other work runs meanwhile'
+    base = 2**20
+    server = protocol.Server(ID(base))
+    newcomer = core.Node('localhost', 3001, ID(base + 1))
+    server.table.node_seen(newcomer)
+    for key in range(3 * protocol.HANDOFF_SCAN):
+        server.storage.put(base + 2 + key, b'value')
+
+    ticks = 0
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+    ticking = asyncio.ensure_future(ticker())
+
+    keys = [key async for key in server.handoff_keys(newcomer)]
+    ticking.cancel()
+    assert len(keys) == 3 * protocol.HANDOFF_SCAN
+    assert ticks >= 3
+
+
+class RecordingTransport(transports.Transport):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_outbox_sends_by_priority():
+    transport = RecordingTransport()
+    constants = core.Constants(maintenance_send_rate=100)  # bursts of 10
+    outbox = protocol.Outbox(transport, constants)
+    Priority = protocol.Priority
+
+    for index in range(15):
+        outbox.sendto(b'maintenance', ('localhost', 1), Priority.MAINTENANCE)
+    outbox.sendto(b'interactive', ('localhost', 1), Priority.INTERACTIVE)
+    outbox.sendto(b'response', ('localhost', 1), Priority.RESPONSE)
+    assert transport.sent == []  # nothing goes out until the loop comes around
+
+    await asyncio.sleep(0)
+    assert transport.sent[:2] == [b'response', b'interactive']
+    assert len(transport.sent) == 12  # the rest of the maintenance traffic has to wait
+    assert len(outbox) == 5
+
+    await asyncio.sleep(0.1)
+    assert len(transport.sent) == 17
+    assert outbox.sent[Priority.MAINTENANCE] == 15
+
+
+@pytest.mark.asyncio
+async def test_outbox_drops_stale_messages():
+    now = 0
+    transport = RecordingTransport()
+    constants = core.Constants(send_queue_limit=2, rpc_timeout=1)
+    outbox = protocol.Outbox(transport, constants, clock=lambda: now)
+    Priority = protocol.Priority
+
+    # a full queue makes room by dropping its oldest message
+    for data in (b'first', b'second', b'third'):
+        outbox.sendto(data, ('localhost', 1), Priority.INTERACTIVE)
+    await asyncio.sleep(0)
+    assert transport.sent == [b'second', b'third']
+
+    # nobody waits for the response to this request anymore
+    future = asyncio.get_running_loop().create_future()
+    outbox.sendto(b'abandoned', ('localhost', 1), Priority.INTERACTIVE, future)
+    future.cancel()
+
+    # and this has waited so long its requester will have given up
+    outbox.sendto(b'late', ('localhost', 1), Priority.RESPONSE)
+    now = 2
+    await asyncio.sleep(0)
+    assert transport.sent == [b'second', b'third']
+    assert outbox.dropped == {Priority.INTERACTIVE: 2, Priority.RESPONSE: 1}
+    assert len(outbox) == 0
+
+
+@pytest.mark.asyncio
+async def test_maintenance_priority():
+    sent = []
+    server = protocol.Server(ID(0b1000))
+    await server.listen('localhost', 3000)
+    sendto = server.outbox.sendto
+    server.outbox.sendto = lambda data, addr, priority, future=None: (
+        sent.append(priority), sendto(data, addr, priority, future)
+    )
+
+    with pytest.raises(asyncio.TimeoutError):
+        await protocol.as_maintenance(server.ping('localhost', 3001, timeout=0.01))
+    with pytest.raises(asyncio.TimeoutError):
+        await server.ping('localhost', 3001, timeout=0.01)
+    assert sent == [protocol.Priority.MAINTENANCE, protocol.Priority.INTERACTIVE]
+
+    # the maintenance work ran in a task of its own, our priority never changed
+    assert protocol._priority.get() == protocol.Priority.INTERACTIVE
+
+    server.stop()
+
+
+@pytest.mark.asyncio
+async def test_find_node_count_and_size():
+    mockserver = await startmockserver(3000)
+
+    constants = core.Constants(k=20, max_datagram_size=600)
+    server = protocol.Server(ID(0b1000), constants)
+    await server.listen('localhost', 3000)
+    for index in range(4, 100):
+        server.table.node_seen(core.Node(f'10.0.0.{index}', 4000, ID(2**index)))
+
+    remote_node = core.Node(addr='localhost', port=3001, nodeid=ID(0b1001))
+    async def ask(request):
+        mockserver.send(request.finalize(remote_node))
+        await mockserver.next_message_future()
+        response = mockserver.messages.pop()
+        return response, messages.Message.parse_protobuf(response)
+
+    _, response = await ask(messages.FindNode(ID(0), count=5))
+    assert len(response.nodes) == 5
+
+    # asking for more than fits into a datagram gets the closest of them which do
+    data, response = await ask(messages.FindNode(ID(0), count=50, compact=True))
+    assert data.ByteSize() <= 600
+    assert data.findNodeResponse.HasField('packed')
+    assert 5 < len(response.nodes) < 50
+    assert response.nodes == server.table.closest(ID(0), len(response.nodes))
+
+    server.stop()
@@ -0,0 +1,54 @@
+import functools
+
+import pytest
+
+import core
+import puzzles
+
+
+def test_puzzles_can_be_turned_off():
+    assert puzzles.static_ok(core.ID(), 0)
+    assert puzzles.dynamic_ok(core.ID(), None, 0)
+    assert not puzzles.required(core.Constants())
+
+    with pytest.raises(ValueError):
+        core.Constants(static_puzzle_bits=161)
+
+
+def test_solve():
+    constants = core.Constants(static_puzzle_bits=8, dynamic_puzzle_bits=8)
+    credentials = puzzles.solve(constants)
+    assert puzzles.admissible(constants, credentials.nodeid, credentials.puzzle)
+    assert credentials.identity is None
+
+    # with overwhelming likelihood, somebody else's solution won't do
+    assert not puzzles.dynamic_ok(core.ID(credentials.nodeid.value ^ 1), credentials.puzzle, 8)
+    assert not puzzles.dynamic_ok(credentials.nodeid, None, 8)
+
+
+def test_solve_signed():
+    pytest.importorskip('cryptography')
+    constants = core.Constants(signed_messages=True, static_puzzle_bits=4)
+    credentials = puzzles.solve(constants)
+    assert credentials.identity.nodeid == credentials.nodeid
+    assert puzzles.static_ok(credentials.nodeid, 4)
+
+
+@pytest.mark.asyncio
+async def test_solve_in_pool():
+    constants = core.Constants(static_puzzle_bits=10, dynamic_puzzle_bits=10)
+    credentials = await puzzles.solve_in_pool(constants, workers=2)
+    assert puzzles.admissible(constants, credentials.nodeid, credentials.puzzle)
+
+
+def test_routing_table_admission():
+    constants = core.Constants(dynamic_puzzle_bits=8)
+    admission = functools.partial(puzzles.admissible, constants)
+    table = core.RoutingTable(2, core.ID(), admission)
+
+    credentials = puzzles.solve(constants)
+    node = core.Node('localhost', 1, credentials.nodeid)
+    with pytest.raises(core.NotAdmitted):
+        table.node_seen(node)
+    table.node_seen(node, puzzle=credentials.puzzle)
+    assert list(table.nodes()) == [node]
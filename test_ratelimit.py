@@ -0,0 +1,100 @@
+import core
+import messages
+import ratelimit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+
+def Limits():
+    return core.Constants(
+        peer_request_rate=1,
+        peer_request_burst=2,
+        global_request_rate=10,
+        global_request_burst=10,
+        overload_reserve=0.5,
+    )
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = ratelimit.TokenBucket(rate=2, burst=4, clock=clock)
+
+    assert all(bucket.take() for _ in range(4))
+    assert not bucket.take()  # we've used up the burst
+
+    clock.now += 1  # two more tokens trickle in
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+
+    clock.now += 100  # it never holds more than the burst
+    assert bucket.level == 1
+    assert all(bucket.take() for _ in range(4))
+    assert not bucket.take()
+
+
+def test_limiter_is_per_peer_and_per_type():
+    limiter = ratelimit.RequestLimiter(Limits(), clock=FakeClock())
+
+    assert limiter.admit(messages.Ping(), ('a', 1))
+    assert limiter.admit(messages.Ping(), ('a', 1))
+    assert not limiter.admit(messages.Ping(), ('a', 1))
+
+    # other peers, and other kinds of requests, have their own budgets
+    assert limiter.admit(messages.Ping(), ('b', 1))
+    assert limiter.admit(messages.FindNode(core.ID(1)), ('a', 1))
+
+    assert limiter.dropped == {('peer', 'Ping'): 1}
+
+
+def test_limiter_sheds_low_priority_requests_when_overloaded():
+    limiter = ratelimit.RequestLimiter(Limits(), clock=FakeClock())
+
+    # use up more than half of the global budget
+    for peer in 'acdefg':
+        assert limiter.admit(messages.Ping(), (peer, 1))
+    assert limiter.overloaded()
+
+    assert not limiter.admit(messages.Ping(), ('b', 1))
+    assert not limiter.admit(messages.FindNode(core.ID(1)), ('b', 1))
+    assert limiter.admit(messages.Store(core.ID(1), b'value'), ('b', 1))
+
+    assert limiter.dropped == {('overload', 'Ping'): 1, ('overload', 'FindNode'): 1}
+
+
+def test_limiter_forgets_old_peers():
+    limiter = ratelimit.RequestLimiter(Limits(), clock=FakeClock(), max_peers=2)
+
+    for peer in 'abc':
+        limiter.admit(messages.Ping(), (peer, 1))
+    assert list(limiter.peers) == [('b', messages.Ping), ('c', messages.Ping)]
+
+
+def test_limiter_ignores_source_ports():
+    'Picking a new port for every request does not get you a new budget'
+    limiter = ratelimit.RequestLimiter(Limits(), clock=FakeClock())
+
+    assert limiter.admit(messages.Ping(), ('10.0.0.1', 1))
+    assert limiter.admit(messages.Ping(), ('10.0.0.1', 2))
+    assert not limiter.admit(messages.Ping(), ('10.0.0.1', 3))
+    assert limiter.admit(messages.Ping(), ('10.0.0.2', 3))
+
+    # nor does picking a new address out of your /64
+    assert limiter.admit(messages.Ping(), ('2001:db8::1', 1))
+    assert limiter.admit(messages.Ping(), ('2001:db8::2', 1))
+    assert not limiter.admit(messages.Ping(), ('2001:db8::3', 1))
+    assert limiter.admit(messages.Ping(), ('2001:db8:0:1::1', 1))
+
+    assert len(limiter.peers) == 4
+
+    # the nodes running on this machine are told apart by their ports
+    limiter = ratelimit.RequestLimiter(Limits(), clock=FakeClock())
+    assert limiter.admit(messages.Ping(), ('127.0.0.1', 1))
+    assert limiter.admit(messages.Ping(), ('127.0.0.1', 1))
+    assert not limiter.admit(messages.Ping(), ('127.0.0.1', 1))
+    assert limiter.admit(messages.Ping(), ('127.0.0.1', 2))
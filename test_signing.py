@@ -0,0 +1,99 @@
+import hashlib
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import core
+import messages
+import signing
+
+
+def signed(identity: signing.Identity, message: messages.Message, port: int = 1) -> bytes:
+    node = core.Node('localhost', port, identity.nodeid)
+    finalized = message.finalize(node)
+    identity.sign(finalized)
+    return finalized.SerializeToString()
+
+
+def test_nodeid_comes_from_the_public_key():
+    identity = signing.Identity()
+    assert len(identity.publickey) == 32
+    assert identity.nodeid.to_bytes() == hashlib.sha1(identity.publickey).digest()
+    assert signing.nodeid_for(identity.publickey) == identity.nodeid
+
+
+def test_verify():
+    identity = signing.Identity()
+    data = signed(identity, messages.Store(core.ID(5), b'value'))
+
+    message = signing.Verifier().verify(data)
+    assert message.value == b'value'
+    assert message.sender.nodeid == identity.nodeid
+
+
+def test_verify_rejects():
+    identity, impostor = signing.Identity(), signing.Identity()
+    verifier = signing.Verifier()
+
+    unsigned = messages.Ping().finalize(core.Node('localhost', 1, identity.nodeid))
+    with pytest.raises(signing.SignatureError):
+        verifier.verify(unsigned.SerializeToString())
+
+    # the contents were changed after they were signed
+    protobuf = messages.parse(signed(identity, messages.Store(core.ID(5), b'value')))
+    protobuf.store.value = b'other'
+    with pytest.raises(signing.SignatureError):
+        verifier.verify(protobuf.SerializeToString())
+
+    # a correct signature, from a key which doesn't belong to the claimed node id
+    protobuf = messages.parse(signed(impostor, messages.Ping()))
+    protobuf.sender.nodeid = identity.nodeid.to_bytes()
+    with pytest.raises(signing.SignatureError):
+        verifier.verify(protobuf.SerializeToString())
+
+    # a rejected message is also a malformed one, to anyone who doesn't care why
+    with pytest.raises(messages.MalformedMessage):
+        verifier.verify(b'\xff\xff')
+
+
+def test_verified_keys_are_cached():
+    identities = [signing.Identity() for _ in range(3)]
+    verifier = signing.Verifier(cache_size=2)
+
+    verifier.verify(signed(identities[0], messages.Ping()))
+    verifier.verify(signed(identities[0], messages.Ping()))
+    assert verifier.stats['cache_misses'] == 1
+    assert verifier.stats['cache_hits'] == 1
+
+    verifier.verify(signed(identities[1], messages.Ping()))
+    verifier.verify(signed(identities[2], messages.Ping()))
+    assert len(verifier.keys) == 2
+    assert identities[0].nodeid.to_bytes() not in verifier.keys
+
+
+def test_verify_batch():
+    identity = signing.Identity()
+    batch = [signed(identity, messages.Ping()), b'\xff\xff', signed(identity, messages.Ping())]
+
+    results = signing.Verifier().verify_batch(batch)
+    assert isinstance(results[0], messages.Ping)
+    assert isinstance(results[1], messages.MalformedMessage)
+    assert isinstance(results[2], messages.Ping)
+
+
+def test_verify_batch_survives_undecodable_messages():
+    'A correctly signed message which fails to decode only costs us that message'
+    identity = signing.Identity()
+    protobuf = messages.FindNode(core.ID(5)).finalize(
+        core.Node('localhost', 1, identity.nodeid)
+    )
+    protobuf.findNode.key = b'\xff' * 21  # one byte too long to be an id
+    identity.sign(protobuf)
+    batch = [signed(identity, messages.Ping()), protobuf.SerializeToString()]
+
+    verifier = signing.Verifier()
+    results = verifier.verify_batch(batch)
+    assert isinstance(results[0], messages.Ping)
+    assert isinstance(results[1], messages.MalformedMessage)
+    assert verifier.stats['rejected'] == 1
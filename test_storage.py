@@ -0,0 +1,141 @@
+import random
+
+import pytest
+
+from core import ID, NO_VERSION, Version
+from storage import Storage
+
+
+def test_behaves_like_a_dict():
+    store = Storage(ID(0), budget=2**20)
+
+    store[1] = b'one'
+    store[2] = b'two'
+    assert 1 in store
+    assert store[1] == b'one'
+    assert sorted(store) == [1, 2]
+    assert len(store) == 2
+
+    store[1] = b'uno'
+    assert store[1] == b'uno'
+    assert len(store) == 2
+
+    del store[1]
+    assert 1 not in store
+    with pytest.raises(KeyError):
+        store[1]
+
+    # the freed slot is reused
+    store[3] = b'three'
+    assert store[3] == b'three'
+    assert store.used == Storage.size_of(b'two') + Storage.size_of(b'three')
+
+
+def test_lru_eviction():
+    value = b'x' * 100
+    size = Storage.size_of(value)
+    store = Storage(ID(0), budget=size * 4, shards=1, low_water=1)
+
+    for key in range(4):
+        store[key] = value
+    store[0]  # reading a key counts as using it
+
+    store[4] = value
+    assert sorted(store) == [0, 2, 3, 4]
+    assert store.used <= store.budget
+    assert list(store.shards[0].recency) == [2, 3, 0, 4]  # the next to go comes first
+
+    stats = store.stats()
+    assert stats.keys == 4
+    assert stats.evictions == 1
+    assert stats.hits == 1
+
+
+def test_distance_eviction():
+    value = b'x' * 100
+    size = Storage.size_of(value)
+    store = Storage(ID(0b1000), budget=size * 3, shards=1, policy='distance', low_water=1)
+
+    store[0b1001] = value
+    store[0b0000] = value
+    store[0b1010] = value
+
+    # the key furthest from us is the one which goes, even if it's the newest
+    store[0b1111_0000] = value
+    assert sorted(store) == [0b0000, 0b1001, 0b1010]
+
+    store[0b1011] = value
+    assert sorted(store) == [0b1001, 0b1010, 0b1011]
+
+
+def test_rejects_values_larger_than_budget():
+    store = Storage(ID(0), budget=1000, shards=1)
+    with pytest.raises(ValueError):
+        store[1] = b'x' * 1000
+    assert store.stats().rejected == 1
+    assert len(store) == 0
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Storage(ID(0), budget=1000, policy='random')
+
+
+def test_retune():
+    value = b'x' * 100
+    size = Storage.size_of(value)
+    store = Storage(ID(0b1000), budget=size * 4, shards=1, low_water=1)
+
+    for key in range(4):
+        store[key] = value
+
+    store.retune(size * 2, 'distance')
+    assert sorted(store) == [0, 1]  # the keys closest to 0b1000
+    assert store.used <= store.budget
+
+
+def test_put_only_overwrites_older_versions():
+    store = Storage(ID(0), budget=2**20)
+    old, new = Version(1, b'a'), Version(2, b'a')
+
+    assert store.put(1, b'new', new)
+    assert not store.put(1, b'old', old)
+    assert store[1] == b'new'
+    assert store.version_of(1) == new
+
+    assert store.put(1, b'new', new)  # we already hold it
+    assert store.put(1, b'newer', Version(2, b'b'))  # the publisher breaks ties
+    assert store[1] == b'newer'
+
+    # unversioned values replace each other, but not versioned ones
+    assert store.put(2, b'one') and store.put(2, b'two')
+    assert store[2] == b'two'
+    assert not store.put(1, b'unversioned')
+
+    store[1] = b'forced'
+    assert store.version_of(1) == NO_VERSION
+    assert store.version_of(3) is None
+
+
+def test_key_index():
+    store = Storage(ID(0), budget=2**20, shards=4)
+    keys = [random.getrandbits(160) for _ in range(200)] + [0, 2**160 - 1]
+    for key in keys:
+        store[key] = b'v'
+    for key in keys[:50]:
+        del store[key]
+    keys = keys[50:]
+
+    assert list(store.keys_in_range(0, 2**160)) == sorted(keys)
+    low, high = sorted(keys)[10], sorted(keys)[20]
+    assert list(store.keys_in_range(low, high)) == sorted(keys)[10:20]
+
+    prefix = 0b101 << 157
+    assert list(store.keys_with_prefix(prefix | 12345, 3)) == sorted(
+        key for key in keys if key >> 157 == 0b101
+    )
+
+    for target in (0, 2**160 - 1, keys[0], random.getrandbits(160)):
+        assert list(store.nearest(target)) == sorted(keys, key=lambda key: key ^ target)
+
+    assert [key for key, _ in store.entries(low, high)] == sorted(keys)[10:20]
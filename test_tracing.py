@@ -0,0 +1,60 @@
+import asyncio
+import json
+import pytest
+
+import core
+import protocol
+import tracing
+
+ID = core.ID
+
+
+@pytest.mark.asyncio
+async def test_trace_records_each_rpc():
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+
+    first_hop = protocol.Server(mynodeid=ID(0b1001))
+    await first_hop.listen('localhost', 3001)
+
+    second_hop = protocol.Server(mynodeid=ID(0b1010))
+    await second_hop.listen('localhost', 3002)
+
+    server.table.node_seen(first_hop.node)
+    first_hop.table.node_seen(second_hop.node)
+    second_hop.storage[0b1011] = b'hello'
+
+    trace = tracing.LookupTrace(ID(0b1011))
+    value = await asyncio.wait_for(server.value_lookup(ID(0b1011), trace), timeout=0.5)
+    assert value == b'hello'
+
+    assert trace.looking_for_value
+    assert trace.termination == 'value found'
+    assert len(trace.rounds) == 2
+
+    first, second = trace.rpcs
+    assert (first.peer, first.round, first.outcome) == (first_hop.node, 0, 'response')
+    assert first.nodes_returned == 2  # second_hop, and us
+    assert first.closer
+    assert (second.peer, second.round, second.outcome) == (second_hop.node, 1, 'value')
+    assert 0 <= first.sent <= first.received <= second.sent <= second.received <= trace.ended
+
+    exported = json.loads(trace.to_json())
+    assert exported['termination'] == 'value found'
+    assert exported['rpcs'][1]['peer']['port'] == 3002
+
+    timeline = trace.timeline()
+    assert 'round 1' in timeline
+    assert 'localhost:3002' in timeline
+
+
+@pytest.mark.asyncio
+async def test_trace_of_a_lookup_with_no_peers():
+    server = protocol.Server(mynodeid=ID(0b1000))
+    await server.listen('localhost', 3000)
+
+    trace = tracing.LookupTrace(ID(0b1011))
+    await server.node_lookup(ID(0b1011), trace)
+    assert trace.termination == 'no peers'
+    assert trace.rpcs == []
+    trace.timeline()
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+
+import core
+import protocol
+import transports
+
+ID = core.ID
+
+
+class RecordingTransport(transports.Transport):
+    def __init__(self):
+        self.sent = list()
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+    def close(self):
+        pass
+
+
+def test_fallback_transport_picks_a_transport():
+    datagrams, stream = RecordingTransport(), RecordingTransport()
+    constants = core.Constants(max_datagram_size=10, stream_fallback_after=2)
+    transport = transports.FallbackTransport(datagrams, stream, constants)
+
+    transport.sendto(b'small', ('a', 1))
+    transport.sendto(b'much too large', ('a', 1))
+    assert datagrams.sent == [(b'small', ('a', 1))]
+    assert stream.sent == [(b'much too large', ('a', 1))]
+
+    # a peer which keeps ignoring our datagrams is sent everything over the stream
+    transport.timed_out(('a', 1))
+    transport.responded(('a', 1))
+    transport.timed_out(('a', 1))
+    assert not transport.prefers_stream(('a', 1))  # the timeouts must be in a row
+
+    transport.timed_out(('a', 1))
+    assert transport.prefers_stream(('a', 1))
+    transport.sendto(b'small', ('a', 1))
+    assert stream.sent[-1] == (b'small', ('a', 1))
+
+    transport.responded(('a', 1))
+    assert transport.prefers_stream(('a', 1))
+
+
+def test_fallback_transport_forgets_timeouts():
+    now = 0
+    constants = core.Constants(
+        stream_fallback_after=1, stream_fallback_ttl=10, stream_fallback_memory=2
+    )
+    transport = transports.FallbackTransport(
+        RecordingTransport(), RecordingTransport(), constants, clock=lambda: now
+    )
+
+    # after a while, peers which switched to the stream are sent datagrams again
+    transport.timed_out(('a', 1))
+    now = 5
+    assert transport.prefers_stream(('a', 1))
+    now = 10
+    assert not transport.prefers_stream(('a', 1))
+    assert len(transport.timeouts) == 0
+
+    # and only the peers which timed out most recently are remembered
+    for port in range(3):
+        transport.timed_out(('b', port))
+    assert list(transport.timeouts) == [('b', 1), ('b', 2)]
+
+    with pytest.raises(TypeError):
+        transports.Transport()
+
+
+@pytest.mark.asyncio
+async def test_stream_transport_sends_frames():
+    received = list()
+    listener = transports.StreamTransport(lambda data, addr: received.append(data))
+    await listener.listen('localhost', 3001)
+
+    sender = transports.StreamTransport(lambda data, addr: None, pool_size=1)
+    sender.sendto(b'hello', ('localhost', 3001))
+    sender.sendto(b'', ('localhost', 3001))
+    sender.sendto(b'x' * 100000, ('localhost', 3001))
+
+    await asyncio.sleep(0.1)
+    assert received == [b'hello', b'', b'x' * 100000]
+    assert len(sender.connections) == 1  # the connection was reused
+
+    sender.close()
+    listener.close()
+
+
+@pytest.mark.asyncio
+async def test_large_values_are_sent_over_a_stream():
+    constants = core.Constants(max_datagram_size=500)
+    first = protocol.Server(mynodeid=ID(0b1000), constants=constants)
+    second = protocol.Server(mynodeid=ID(0b1001), constants=constants)
+    await first.listen('localhost', 3000)
+    await second.listen('localhost', 3001)
+
+    value = b'x' * 100000  # this would never fit into a datagram
+    await asyncio.wait_for(first.store(second.node, ID(0b100), value), timeout=0.5)
+    assert second.storage[0b100] == value
+
+    # and the response comes back over a stream too
+    with pytest.raises(protocol.ValueFound) as excinfo:
+        await asyncio.wait_for(first.find_value(second.node, ID(0b100)), timeout=0.5)
+    assert excinfo.value.value == value
+
+    first.stop()
+    second.stop()
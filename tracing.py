@@ -0,0 +1,128 @@
+'''
+Records what a single lookup did: each RPC it sent, when the answer came back and whether
+it got us any closer, so slow lookups can be picked apart.
+
+    trace = tracing.LookupTrace(key)
+    await node.find_value(key, trace=trace)
+    print(trace.timeline())
+'''
+import dataclasses
+import json
+import time
+import typing
+
+import core
+
+
+@dataclasses.dataclass
+class RPCRecord:
+    peer: core.Node
+    round: int
+    sent: float  # seconds since the lookup started
+    received: typing.Optional[float] = None
+    outcome: str = 'pending'  # then one of 'response', 'value', 'timeout', 'cancelled'
+    nodes_returned: int = 0
+    closer: bool = False  # did it tell us about a node closer than any we knew of?
+    hedge: bool = False  # was it sent because another peer was slow to answer?
+
+    @property
+    def duration(self) -> typing.Optional[float]:
+        if self.received is None:
+            return None
+        return self.received - self.sent
+
+
+class LookupTrace:
+    def __init__(self, target: core.ID, clock=time.perf_counter):
+        self.target = target
+        self.clock = clock
+        self.looking_for_value: bool = None
+
+        self.started = clock()
+        self.ended: typing.Optional[float] = None
+        self.rounds: typing.List[float] = list()  # when each round started
+        self.rpcs: typing.List[RPCRecord] = list()
+        self.termination: typing.Optional[str] = None
+
+    def _now(self) -> float:
+        return self.clock() - self.started
+
+    def round_started(self):
+        self.rounds.append(self._now())
+
+    def rpc_sent(self, peer: core.Node, hedge: bool = False) -> RPCRecord:
+        record = RPCRecord(
+            peer=peer, round=len(self.rounds) - 1, sent=self._now(), hedge=hedge
+        )
+        self.rpcs.append(record)
+        return record
+
+    def rpc_finished(self, record: RPCRecord, outcome: str, nodes_returned: int = 0,
+                     closer: bool = False):
+        record.received = self._now()
+        record.outcome = outcome
+        record.nodes_returned = nodes_returned
+        record.closer = closer
+
+    def finished(self, reason: str):
+        self.ended = self._now()
+        self.termination = reason
+
+    def to_dict(self) -> dict:
+        def rpc(record: RPCRecord) -> dict:
+            return {
+                'peer': {
+                    'addr': record.peer.addr,
+                    'port': record.peer.port,
+                    'nodeid': record.peer.nodeid.to_bytes().hex(),
+                },
+                'round': record.round,
+                'sent': record.sent,
+                'received': record.received,
+                'outcome': record.outcome,
+                'nodes_returned': record.nodes_returned,
+                'closer': record.closer,
+                'hedge': record.hedge,
+            }
+
+        return {
+            'target': self.target.to_bytes().hex(),
+            'looking_for_value': self.looking_for_value,
+            'duration': self.ended,
+            'termination': self.termination,
+            'rounds': self.rounds,
+            'rpcs': [rpc(record) for record in self.rpcs],
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def timeline(self, width: int = 50) -> str:
+        '''
+        Renders the lookup as one bar per RPC, grouped by round, like a flame graph lying
+        on its side. '=' is time spent waiting for a response, a '+' at the end of a bar
+        means the response got us closer to the target, '$' that it held the value we were
+        looking for, 'x' that the peer timed out and '-' that we stopped waiting because a
+        hedged request answered first.
+        '''
+        total = self.ended if self.ended is not None else self._now()
+        scale = width / total if total > 0 else 0
+        column = lambda seconds: min(width - 1, int(seconds * scale))
+
+        lines = [
+            f'lookup for {self.target.to_bytes().hex()[:12]}: {total * 1000:.1f}ms, '
+            f'{len(self.rounds)} rounds, {len(self.rpcs)} rpcs, ended: {self.termination}'
+        ]
+        for index in range(len(self.rounds)):
+            lines.append(f'round {index}')
+            for record in (record for record in self.rpcs if record.round == index):
+                end = record.received if record.received is not None else total
+                start_col, end_col = column(record.sent), column(end)
+                marker = {'timeout': 'x', 'value': '$', 'cancelled': '-'}.get(
+                    record.outcome, '+' if record.closer else '|'
+                )
+                bar = ' ' * start_col + '=' * (end_col - start_col) + marker
+                duration = f'{(end - record.sent) * 1000:.1f}ms'
+                peer = f'{record.peer.addr}:{record.peer.port}'
+                lines.append(f'  {peer:>21} {bar:<{width + 1}} {duration} {record.outcome}')
+        return '\n'.join(lines)
@@ -0,0 +1,224 @@
+'''
+The ways Server can get bytes to another node.
+
+Every node listens for UDP datagrams and, on the same port number, for TCP connections.
+Most messages are sent as datagrams, the StreamTransport is used for messages too large to
+fit into one and for peers which never seem to receive our datagrams.
+'''
+import abc
+import asyncio
+import collections
+import logging
+import time
+import typing
+
+import core
+
+
+logger = logging.getLogger('kademlia')
+
+Addr = typing.Tuple[str, int]
+FrameHandler = typing.Callable[[bytes, Addr], None]
+
+HEADER_SIZE = 4  # frames are prefixed with their length, as a big-endian uint32
+
+
+class Transport(abc.ABC):
+    'The interface Server sends messages through'
+
+    @abc.abstractmethod
+    def sendto(self, data: bytes, addr: Addr):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    def responded(self, addr: Addr):
+        'The peer at addr responded to one of our requests'
+
+    def timed_out(self, addr: Addr):
+        'The peer at addr did not respond to one of our requests in time'
+
+
+class DatagramTransport(Transport):
+    def __init__(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def sendto(self, data: bytes, addr: Addr):
+        self.transport.sendto(data, addr)
+
+    def close(self):
+        self.transport.close()
+
+
+class _Connection:
+    'An outgoing connection, frames sent before it has connected are buffered'
+
+    def __init__(self, stream: 'StreamTransport', addr: Addr):
+        self.stream = stream
+        self.addr = addr
+        self.writer: asyncio.StreamWriter = None
+        self.pending: typing.List[bytes] = list()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def send(self, frame: bytes):
+        if self.writer is None:
+            self.pending.append(frame)
+        else:
+            self.writer.write(frame)
+
+    async def _run(self):
+        try:
+            reader, self.writer = await asyncio.open_connection(*self.addr)
+            for frame in self.pending:
+                self.writer.write(frame)
+            self.pending = None
+
+            # the peer usually responds over its own connection to us, but it may as well
+            # use this one
+            await self.stream.read_frames(reader, self.addr)
+        except OSError as ex:
+            logger.warning(f'stream connection to {self.addr} failed: {ex}')
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            self.stream.forget(self)
+
+    def close(self):
+        self.task.cancel()  # _run cleans up after itself
+
+
+class StreamTransport(Transport):
+    '''
+    Sends each message as a length-prefixed frame over a TCP connection. Connections are
+    kept open and reused, at most pool_size of them, the least recently used one is
+    closed to make room for a new one.
+    '''
+
+    def __init__(self, on_frame: FrameHandler, pool_size: int = 64,
+                 max_frame_size: int = 16 * 1024 * 1024):
+        self.on_frame = on_frame
+        self.pool_size = pool_size
+        self.max_frame_size = max_frame_size
+
+        self.server: asyncio.AbstractServer = None
+        self.connections: typing.MutableMapping[Addr, _Connection] = collections.OrderedDict()
+        self.incoming: typing.Set[asyncio.Task] = set()
+
+    async def listen(self, addr: str, port: int):
+        self.server = await asyncio.start_server(self._accepted, addr, port)
+
+    @staticmethod
+    def frame(data: bytes) -> bytes:
+        return len(data).to_bytes(HEADER_SIZE, byteorder='big') + data
+
+    async def read_frames(self, reader: asyncio.StreamReader, addr: Addr):
+        'Passes each frame read from reader to on_frame, until the connection closes'
+        while True:
+            try:
+                header = await reader.readexactly(HEADER_SIZE)
+                length = int.from_bytes(header, byteorder='big')
+                if length > self.max_frame_size:
+                    logger.warning(f'{addr} sent a frame of {length} bytes, hanging up')
+                    return
+                data = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return  # they hung up
+            self.on_frame(data, addr)
+
+    async def _accepted(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.incoming.add(task)
+        addr = writer.get_extra_info('peername')[:2]
+        try:
+            await self.read_frames(reader, addr)
+        except OSError as ex:
+            logger.warning(f'stream connection from {addr} failed: {ex}')
+        finally:
+            writer.close()
+            self.incoming.discard(task)
+
+    def sendto(self, data: bytes, addr: Addr):
+        connection = self.connections.get(addr)
+        if connection is None:
+            if len(self.connections) >= self.pool_size:
+                _, oldest = self.connections.popitem(last=False)
+                oldest.close()
+            connection = self.connections[addr] = _Connection(self, addr)
+        else:
+            self.connections.move_to_end(addr)
+        connection.send(self.frame(data))
+
+    def forget(self, connection: _Connection):
+        if self.connections.get(connection.addr) is connection:
+            del self.connections[connection.addr]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.connections.clear()
+        for task in self.incoming:
+            task.cancel()
+
+
+class FallbackTransport(Transport):
+    '''
+    Sends datagrams, unless the message is larger than max_datagram_size or the peer has
+    failed to respond to stream_fallback_after datagrams in a row. Those go over the
+    StreamTransport. A peer's timeouts are forgotten stream_fallback_ttl seconds after the
+    last one, and then we try datagrams again. Only the stream_fallback_memory peers which
+    timed out most recently are remembered.
+    '''
+
+    def __init__(self, datagrams: Transport, stream: Transport,
+                 constants: core.Constants, clock=time.monotonic):
+        self.datagrams = datagrams
+        self.stream = stream
+        self.constants = constants
+        self.clock = clock
+
+        # addr -> (timeouts in a row, when the last one was), the least recent first
+        self.timeouts: typing.MutableMapping[Addr, typing.Tuple[int, float]] = (
+            collections.OrderedDict()
+        )
+
+    def _timeouts(self, addr: Addr) -> int:
+        entry = self.timeouts.get(addr)
+        if entry is None:
+            return 0
+        count, when = entry
+        if self.clock() - when >= self.constants.stream_fallback_ttl:
+            del self.timeouts[addr]
+            return 0
+        return count
+
+    def prefers_stream(self, addr: Addr) -> bool:
+        return self._timeouts(addr) >= self.constants.stream_fallback_after
+
+    def sendto(self, data: bytes, addr: Addr):
+        if len(data) > self.constants.max_datagram_size or self.prefers_stream(addr):
+            self.stream.sendto(data, addr)
+        else:
+            self.datagrams.sendto(data, addr)
+
+    def responded(self, addr: Addr):
+        # a peer which has switched to the stream stays there until stream_fallback_ttl
+        # has passed since its last timeout, we don't know whether datagrams would work
+        # again before then
+        if not self.prefers_stream(addr):
+            self.timeouts.pop(addr, None)
+
+    def timed_out(self, addr: Addr):
+        count = self._timeouts(addr) + 1
+        self.timeouts.pop(addr, None)
+        self.timeouts[addr] = (count, self.clock())
+        while len(self.timeouts) > self.constants.stream_fallback_memory:
+            self.timeouts.popitem(last=False)
+
+    def close(self):
+        self.datagrams.close()
+        self.stream.close()